@@ -0,0 +1,540 @@
+import math
+import operator
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from models import datetime_to_ns
+
+try:
+    import numpy as np
+except ImportError:  # batch calcs fall back to plain python loops over array columns
+    np = None
+
+
+class RollingWindow:
+    """
+    running sums of quantity and quantity*price over the trades of one stock inside a sliding time window
+    trades are kept in timestamp order and expire off the head as time moves forward
+    written by one thread at a time (the symbol's shard lock), read lock-free through `snapshot`
+    """
+    compact_after = 1024  # expired entries tolerated at the head before the lists are trimmed
+
+    def __init__(self, interval_in_mins: float):
+        self.interval_in_mins = interval_in_mins
+        self.window_ns = int(timedelta(minutes=interval_in_mins) // timedelta(microseconds=1)) * 1000
+        self.clear()
+
+    def __len__(self):
+        return len(self.timestamps) - self.head
+
+    def clear(self) -> None:
+        self.timestamps, self.quantities, self.notionals = [], [], []
+        self.head, self.total_quantity, self.total_notional = 0, 0, 0.0
+        self.publish()
+
+    def publish(self) -> None:
+        # readers only ever look at this tuple, it is replaced as a whole once a change is complete;
+        # lists in it are only appended to afterwards, trimming or inserting builds new lists
+        self.snapshot = (self.timestamps, self.quantities, self.notionals, self.head, len(self.timestamps),
+                         self.total_quantity, self.total_notional)
+
+    def add(self, timestamp_ns: int, quantity: int, price: float, now_ns: int = None) -> None:
+        notional = quantity * price
+        if len(self) == 0 or timestamp_ns >= self.timestamps[-1]:
+            self.timestamps.append(timestamp_ns)
+            self.quantities.append(quantity)
+            self.notionals.append(notional)
+        else:
+            # late trade, rare: keep the window sorted so expiry can keep popping from the head
+            position = bisect_right(self.timestamps, timestamp_ns, self.head)
+            self.timestamps = self.timestamps[:position] + [timestamp_ns] + self.timestamps[position:]
+            self.quantities = self.quantities[:position] + [quantity] + self.quantities[position:]
+            self.notionals = self.notionals[:position] + [notional] + self.notionals[position:]
+        self.total_quantity += quantity
+        self.total_notional += notional
+        # nothing older than the window before now can come back into a window; a trade dated after now
+        # (clock skew) must not push out trades that are still inside the window at now
+        newest_ns = self.timestamps[-1]
+        self.expire((newest_ns if now_ns is None else min(newest_ns, now_ns)) - self.window_ns)
+
+    def expire(self, cutoff_ns: int) -> None:
+        """
+        drops trades older than cutoff_ns, each trade is expired exactly once
+        """
+        timestamps = self.timestamps
+        head = self.head
+        end = len(timestamps)
+        while head < end and timestamps[head] < cutoff_ns:
+            self.total_quantity -= self.quantities[head]
+            self.total_notional -= self.notionals[head]
+            head += 1
+        if head == end:
+            # empty window: start again from exact zeros so float error can not accumulate
+            self.clear()
+            return
+        if head >= self.compact_after and head * 2 >= end:
+            self.timestamps, self.quantities, self.notionals = timestamps[head:], self.quantities[head:], self.notionals[head:]
+            head = 0
+        self.head = head
+        self.publish()
+
+    def volume_weighted_price(self, now: datetime) -> float:
+        """
+        raises ZeroDivisionError when no shares were traded inside the window
+        works on the published snapshot and never changes the window, so it is safe next to a writer;
+        trades that aged out since the last write are skipped rather than expired
+        """
+        return self.volume_weighted_price_until(now)[0]
+
+    def volume_weighted_price_until(self, now: datetime) -> tuple[float, int]:
+        """
+        (VWSP at now, latest epoch-ns "now" it still holds for without another trade): the price only moves
+        once the oldest trade inside the window ages out
+        """
+        timestamps, quantities, notionals, head, end, total_quantity, total_notional = self.snapshot
+        cutoff_ns = datetime_to_ns(now) - self.window_ns
+        while head < end and timestamps[head] < cutoff_ns:
+            total_quantity -= quantities[head]
+            total_notional -= notionals[head]
+            head += 1
+        if head == end:
+            raise ZeroDivisionError("no trades inside the window")
+        return total_notional / total_quantity, timestamps[head] + self.window_ns
+
+
+class VWSPEngine:
+    """
+    per-symbol rolling windows, updated on every recorded trade so a VWSP query does not rescan history
+    several window lengths can be maintained per symbol, each is created on first use
+    writers hold the symbol's shard lock, VWSP reads do not take any lock once the window exists
+    """
+    default_intervals_in_mins = (5,)
+
+    def __init__(self, trade_store, trade_shards, clock):
+        self.trade_store = trade_store
+        self.trade_shards = trade_shards
+        self.clock = clock  # anchors windows seeded from the store
+        self.windows = {}  # {symbol: {interval_in_mins: RollingWindow}}
+        trade_store.reload_listeners.append(self.reset)
+
+    def reset(self) -> None:
+        """
+        the whole trade store was replaced, windows are seeded again from the store as they are needed
+        """
+        self.windows = {}
+
+    def seed_window(self, symbol: str, interval_in_mins: float) -> RollingWindow:
+        window = RollingWindow(interval_in_mins)
+        now_ns = datetime_to_ns(self.clock.now())
+        symbol_trades, rows = self.trade_store.read_symbol_rows(symbol, now_ns - window.window_ns)
+        if rows:
+            timestamps, quantities, prices = symbol_trades.timestamps, symbol_trades.quantities, symbol_trades.prices
+            # rows come in timestamp order, so the window can be filled directly without re-sorting
+            window.timestamps = [timestamps[row] for row in rows]
+            window.quantities = [quantities[row] for row in rows]
+            window.notionals = [quantities[row] * prices[row] for row in rows]
+            window.total_quantity = sum(window.quantities)
+            window.total_notional = math.fsum(window.notionals)
+            window.expire(min(window.timestamps[-1], now_ns) - window.window_ns)
+        return window
+
+    def on_trade(self, symbol: str, timestamp_ns: int, quantity: int, price: float, now_ns: int = None) -> None:
+        """
+        called with the symbol's shard lock held, after the trade has been appended to the store
+        """
+        if now_ns is None:
+            now_ns = datetime_to_ns(self.clock.now())
+        symbol_windows = self.windows.get(symbol)
+        if symbol_windows is None:
+            # first trade seen for this symbol, seeding from the store already picks up this trade
+            self.windows[symbol] = {interval: self.seed_window(symbol, interval)
+                                    for interval in self.default_intervals_in_mins}
+            return
+        for window in list(symbol_windows.values()):
+            window.add(timestamp_ns, quantity, price, now_ns)
+
+    def on_trades(self, rows: list) -> None:
+        """
+        batch variant of on_trade for (symbol, timestamp_ns, type, price, quantity) rows already in the store,
+        called with the shard lock of every symbol in rows held
+        """
+        seeded = set()
+        now_ns = datetime_to_ns(self.clock.now())
+        for symbol, timestamp_ns, _, price, quantity in rows:
+            symbol_windows = self.windows.get(symbol)
+            if symbol_windows is None:
+                self.on_trade(symbol, timestamp_ns, quantity, price, now_ns)
+                seeded.add(symbol)
+            elif symbol not in seeded:
+                for window in list(symbol_windows.values()):
+                    window.add(timestamp_ns, quantity, price, now_ns)
+
+    def get_window(self, symbol: str, interval_in_mins: float = 5) -> RollingWindow | None:
+        """
+        returns None if the symbol has never been traded
+        """
+        symbol_windows = self.windows.get(symbol)
+        window = symbol_windows.get(interval_in_mins) if symbol_windows is not None else None
+        if window is not None:
+            return window
+        # first query for this window length: seeded under the shard lock so no trade can slip in between
+        with self.trade_shards.lock_for(symbol):
+            symbol_windows = self.windows.get(symbol)
+            if symbol_windows is None:
+                if not self.trade_store.has_trades(symbol):
+                    return None
+                symbol_windows = self.windows[symbol] = {}
+            window = symbol_windows.get(interval_in_mins)
+            if window is None:
+                window = symbol_windows[interval_in_mins] = self.seed_window(symbol, interval_in_mins)
+            return window
+
+
+class ChangeLog:
+    """
+    symbols in the order their price changed: writers append in O(1), each reader keeps its own position and
+    catches up when it is read; past capacity the oldest half is dropped and a reader left behind starts over
+    """
+
+    def __init__(self, capacity: int = 65536):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.symbols = []
+        self.base = 0  # position of symbols[0] since the log was created
+
+    def append(self, symbol: str) -> None:
+        with self.lock:
+            self.symbols.append(symbol)
+            if len(self.symbols) > self.capacity:
+                dropped = len(self.symbols) // 2
+                del self.symbols[:dropped]
+                self.base += dropped
+
+    def end(self) -> int:
+        with self.lock:
+            return self.base + len(self.symbols)
+
+    def since(self, position: int) -> tuple:
+        """
+        (symbols changed since position, position to read from next time), the symbols are None
+        when the log no longer reaches back that far
+        """
+        with self.lock:
+            end = self.base + len(self.symbols)
+            if position < self.base:
+                return None, end
+            return set(self.symbols[position - self.base:]), end
+
+
+class IndexEngine:
+    """
+    GBCE All Share Index: geometric mean of the whole-population VWSP of every traded stock
+    per-constituent sums and a running sum of log prices are updated for the traded stock only,
+    so the index value is available in constant time after each trade
+    the log price sums are kept per shard, so writers on different shards never share state
+    every re-priced constituent is also noted in change_log, which the custom indices of an IndexRegistry catch up from
+    """
+
+    def __init__(self, trade_store, trade_shards):
+        self.trade_store = trade_store
+        self.trade_shards = trade_shards
+        self.rebuild()
+        trade_store.reload_listeners.append(self.rebuild)
+
+    def rebuild(self) -> None:
+        """
+        recomputes every constituent from the store, called with every shard lock held
+        """
+        self.total_quantity = {}  # {symbol: shares traded}
+        self.total_notional = {}  # {symbol: sum of quantity * price}
+        self.log_prices = {}  # {symbol: log(vwsp)} for constituents with a positive vwsp
+        self.zero_priced = set()  # constituents whose vwsp is 0, they pull the geometric mean to 0
+        self.change_log = ChangeLog()  # a new log tells custom indices that every price has to be read again
+        # per shard (sum of log prices, constituents priced above 0, constituents priced at 0), replaced as a whole
+        self.shard_totals = [(0.0, 0, 0)] * self.trade_shards.shard_count
+        for symbol, (quantity, notional) in self.trade_store.trade_totals().items():
+            self.total_quantity[symbol] = quantity
+            self.total_notional[symbol] = notional
+            self.update_constituent(symbol)
+
+    def update_constituent(self, symbol: str) -> None:
+        shard = self.trade_shards.shard_of(symbol)
+        sum_log_prices, priced, zero_priced = self.shard_totals[shard]
+        old_log_price = self.log_prices.pop(symbol, None)
+        if old_log_price is not None:
+            sum_log_prices -= old_log_price
+            priced -= 1
+        if symbol in self.zero_priced:
+            self.zero_priced.discard(symbol)
+            zero_priced -= 1
+        quantity = self.total_quantity[symbol]
+        if quantity != 0:  # otherwise only zero-quantity trades, no price for this stock yet
+            vwsp = self.total_notional[symbol] / quantity
+            if vwsp > 0:
+                self.log_prices[symbol] = math.log(vwsp)
+                sum_log_prices += self.log_prices[symbol]
+                priced += 1
+            else:
+                self.zero_priced.add(symbol)
+                zero_priced += 1
+        self.shard_totals[shard] = (sum_log_prices, priced, zero_priced)
+        self.change_log.append(symbol)
+
+    def on_trade(self, symbol: str, quantity: int, price: float) -> None:
+        """
+        called with the symbol's shard lock held, after the trade has been appended to the store
+        """
+        self.total_quantity[symbol] = self.total_quantity.get(symbol, 0) + quantity
+        self.total_notional[symbol] = self.total_notional.get(symbol, 0.0) + quantity * price
+        self.update_constituent(symbol)
+
+    def on_trades(self, rows: list) -> None:
+        """
+        batch variant of on_trade for (symbol, timestamp_ns, type, price, quantity) rows already in the store
+        each traded constituent is re-priced once per batch
+        """
+        traded = set()
+        for symbol, _, _, price, quantity in rows:
+            self.total_quantity[symbol] = self.total_quantity.get(symbol, 0) + quantity
+            self.total_notional[symbol] = self.total_notional.get(symbol, 0.0) + quantity * price
+            traded.add(symbol)
+        for symbol in traded:
+            self.update_constituent(symbol)
+
+    def constituent_count(self) -> int:
+        return sum(priced + zero_priced for _, priced, zero_priced in self.shard_totals)
+
+    def constituent_price(self, symbol: str) -> float:
+        """
+        whole-population VWSP of one constituent, raises KeyError/ZeroDivisionError like the VWSP calc
+        """
+        return self.total_notional[symbol] / self.total_quantity[symbol]
+
+    def value(self) -> float | None:
+        """
+        None while no stock has a price yet, reads the per-shard sums without taking any lock
+        """
+        shard_totals = self.shard_totals
+        if any(zero_priced for _, _, zero_priced in shard_totals):
+            return 0.0
+        priced = sum(priced for _, priced, _ in shard_totals)
+        if not priced:
+            return None
+        return math.exp(math.fsum(sum_log_prices for sum_log_prices, _, _ in shard_totals) / priced)
+
+
+MISSING = object()  # a custom index constituent that has no price yet
+
+
+class CustomIndex:
+    """
+    weighted geometric mean of the whole-population VWSPs of a set of stocks, exp(sum(w * log p) / sum(w)),
+    over the constituents that have been traded: 0.0 if any of them is priced at 0, None while none is priced
+    the sums only move when the index is read, by the constituents re-priced since the last read
+    """
+
+    def __init__(self, name: str, weights: dict):
+        self.name = name
+        self.weights = weights  # {symbol: weight}
+        self.lock = threading.Lock()
+        self.change_log = None  # the IndexEngine log the sums are current with, None until the first read
+        self.position = 0
+        self.contributions = {}  # {symbol: log price, None for a constituent priced at 0}, priced constituents only
+        self.weighted_log_sum = 0.0
+        self.priced_weight = 0.0
+        self.priced = 0
+        self.zero_priced = 0
+
+    @staticmethod
+    def log_price(index_engine, symbol: str):
+        """
+        log of the symbol's VWSP, None when it is priced at 0, MISSING when it has no price
+        """
+        log_price = index_engine.log_prices.get(symbol)
+        if log_price is None and symbol not in index_engine.zero_priced:
+            return MISSING
+        return log_price
+
+    def recompute(self, index_engine) -> None:
+        contributions = {symbol: self.log_price(index_engine, symbol) for symbol in self.weights}
+        self.contributions = {symbol: log_price for symbol, log_price in contributions.items() if log_price is not MISSING}
+        priced = [(self.weights[symbol], log_price) for symbol, log_price in self.contributions.items() if log_price is not None]
+        self.weighted_log_sum = math.fsum(weight * log_price for weight, log_price in priced)
+        self.priced_weight = math.fsum(weight for weight, _ in priced)
+        self.priced, self.zero_priced = len(priced), len(self.contributions) - len(priced)
+
+    def refresh(self, index_engine) -> None:
+        change_log = index_engine.change_log
+        if change_log is self.change_log:
+            changed, position = change_log.since(self.position)
+        else:  # first read, or the trade store was reloaded
+            changed, position = None, change_log.end()
+        if changed is None or len(changed) * 2 > len(self.weights):
+            self.recompute(index_engine)
+        else:
+            for symbol in changed.intersection(self.weights):
+                weight = self.weights[symbol]
+                old_log_price = self.contributions.pop(symbol, MISSING)
+                if old_log_price is None:
+                    self.zero_priced -= 1
+                elif old_log_price is not MISSING:
+                    self.weighted_log_sum -= weight * old_log_price
+                    self.priced_weight -= weight
+                    self.priced -= 1
+                log_price = self.log_price(index_engine, symbol)
+                if log_price is MISSING:
+                    continue
+                self.contributions[symbol] = log_price
+                if log_price is None:
+                    self.zero_priced += 1
+                else:
+                    self.weighted_log_sum += weight * log_price
+                    self.priced_weight += weight
+                    self.priced += 1
+            if not self.priced:  # start again from exact zeros so float error can not accumulate
+                self.weighted_log_sum = self.priced_weight = 0.0
+        self.change_log, self.position = change_log, position
+
+    def value(self, index_engine) -> float | None:
+        with self.lock:
+            self.refresh(index_engine)
+            if self.zero_priced:
+                return 0.0
+            if not self.priced:
+                return None
+            return math.exp(self.weighted_log_sum / self.priced_weight)
+
+
+class IndexRegistry:
+    """
+    named custom indices (sector sub-indices, client baskets) next to the All Share Index, all fed by the
+    per-stock prices IndexEngine keeps: a trade costs the same however many indices are defined,
+    each index catches up on the constituents re-priced since it was last read
+    """
+
+    def __init__(self, index_engine):
+        self.index_engine = index_engine
+        self.indices = {}  # {name: CustomIndex}
+
+    def define(self, index_model) -> CustomIndex:
+        """
+        adds or replaces the index described by a GBCEIndexModel
+        """
+        index = CustomIndex(index_model.get_name(), {symbol: float(index_model.get_weight(symbol))
+                                                     for symbol in index_model.index_constituents})
+        self.indices[index.name] = index
+        return index
+
+    def remove(self, name: str) -> bool:
+        return self.indices.pop(name, None) is not None
+
+    def value(self, name: str) -> float | None:
+        """
+        raises KeyError for an index that is not defined
+        """
+        return self.indices[name].value(self.index_engine)
+
+    def values(self) -> dict:
+        return {name: index.value(self.index_engine) for name, index in list(self.indices.items())}
+
+
+class StockParameterTable:
+    """
+    dividend parameters of every configured stock as columns, row per symbol, for the batch calcs
+    copied once from the symbol registry's columns and reused until the config changes
+    """
+
+    def __init__(self, registry):
+        with registry.lock:
+            self.rows = dict(registry.ids)  # {symbol: row}
+            last_dividend, fixed_dividend, par_value = (array('d', registry.last_dividends), array('d', registry.fixed_dividends),
+                                                        array('d', registry.par_values))
+            common = registry.type_codes.get("Common", -1)
+            type_ids = array('h', registry.type_ids)
+        if np is not None:
+            self.last_dividend = np.frombuffer(last_dividend, dtype=np.float64)
+            self.preferred_dividend = np.frombuffer(fixed_dividend, dtype=np.float64) * np.frombuffer(par_value, dtype=np.float64)
+            self.is_common = np.frombuffer(type_ids, dtype=np.int16) == common
+            return
+        self.last_dividend = last_dividend
+        self.preferred_dividend = array('d', map(operator.mul, fixed_dividend, par_value))  # fixed dividend * par value
+        self.is_common = array('b', [type_id == common for type_id in type_ids])
+
+    def lookup(self, symbols):
+        """
+        row per symbol, -1 for symbols that are not configured
+        """
+        if np is None:
+            return array('q', [self.rows.get(symbol, -1) for symbol in symbols])
+        symbols = np.asarray(symbols, dtype=str)
+        unique_symbols, inverse = np.unique(symbols.ravel(), return_inverse=True)
+        unique_rows = np.array([self.rows.get(symbol, -1) for symbol in unique_symbols.tolist()], dtype=np.int64)
+        return unique_rows[inverse].reshape(symbols.shape)
+
+    def broadcast(self, symbols, prices) -> tuple:
+        """
+        (rows, prices) of equal length, a single symbol or price applies to every element of the other
+        with NumPy, rows from lookup() can be passed instead of symbols and the usual broadcasting rules apply,
+        so a symbols column against a prices grid only resolves the symbols once
+        """
+        if isinstance(symbols, str):
+            rows = [self.rows.get(symbols, -1)]
+        elif np is not None and isinstance(symbols, np.ndarray) and symbols.dtype.kind in 'iu':
+            rows = symbols
+        else:
+            rows = self.lookup(symbols)
+        if np is not None:
+            return np.broadcast_arrays(np.asarray(rows, dtype=np.int64), np.asarray(prices, dtype=np.float64))
+        prices = [float(prices)] if isinstance(prices, (int, float)) else [float(price) for price in prices]
+        if len(rows) == 1:
+            rows = rows * len(prices)
+        elif len(prices) == 1:
+            prices = prices * len(rows)
+        if len(rows) != len(prices):
+            raise ValueError(f"{len(rows)} symbols can not be paired with {len(prices)} prices")
+        return rows, prices
+
+    def dividend_yield(self, symbols, prices) -> tuple:
+        """
+        (yields, valid): NaN and valid False where the stock is unknown or the price is not positive
+        """
+        rows, prices = self.broadcast(symbols, prices)
+        if np is not None:
+            valid = (rows >= 0) & (prices > 0)
+            safe_rows = np.where(valid, rows, 0)
+            dividends = np.where(self.is_common[safe_rows], self.last_dividend[safe_rows], self.preferred_dividend[safe_rows])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.where(valid, dividends / prices, np.nan), valid
+        yields, valid = array('d'), array('b')
+        for row, price in zip(rows, prices):
+            if row < 0 or not price > 0:
+                yields.append(math.nan)
+                valid.append(False)
+                continue
+            dividend = self.last_dividend[row] if self.is_common[row] else self.preferred_dividend[row]
+            yields.append(dividend / price)
+            valid.append(True)
+        return yields, valid
+
+    def pe_ratio(self, symbols, prices) -> tuple:
+        """
+        (ratios, valid): NaN and valid False where the stock is unknown, a zero dividend gives a ratio of 0
+        """
+        rows, prices = self.broadcast(symbols, prices)
+        if np is not None:
+            valid = rows >= 0
+            last_dividend = self.last_dividend[np.where(valid, rows, 0)]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratios = np.where(last_dividend != 0, prices / last_dividend, 0.0)
+            return np.where(valid, ratios, np.nan), valid
+        ratios, valid = array('d'), array('b')
+        for row, price in zip(rows, prices):
+            if row < 0:
+                ratios.append(math.nan)
+                valid.append(False)
+                continue
+            last_dividend = self.last_dividend[row]
+            ratios.append(price / last_dividend if last_dividend != 0 else 0.0)
+            valid.append(True)
+        return ratios, valid
@@ -0,0 +1,356 @@
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from models import SIDE_CODES, ns_to_datetime
+
+NS_PER_MINUTE = 60 * 1000 ** 3
+# each resolution is a whole multiple of the next finer one, so a window can be split into whole bars level by level
+BAR_RESOLUTIONS = {"1m": NS_PER_MINUTE, "5m": 5 * NS_PER_MINUTE, "1h": 60 * NS_PER_MINUTE, "1d": 24 * 60 * NS_PER_MINUTE}
+
+
+class Bar:
+    """
+    open/high/low/close, volume, notional, trade count and buy/sell volume of the trades in a time span
+    open and close follow trade timestamps, not the order trades were recorded in
+    """
+    __slots__ = ('start_ns', 'end_ns', 'first_ns', 'last_ns', 'open', 'high', 'low', 'close',
+                 'volume', 'notional', 'trades', 'buy_volume', 'sell_volume')
+
+    def __init__(self, start_ns: int, end_ns: int):
+        self.start_ns, self.end_ns = start_ns, end_ns
+        self.first_ns = self.last_ns = None
+        self.open = self.high = self.low = self.close = None
+        self.volume = self.trades = self.buy_volume = self.sell_volume = 0
+        self.notional = 0.0
+
+    def add(self, timestamp_ns: int, side: int, price: float, quantity: int) -> None:
+        if not self.trades:
+            self.first_ns = self.last_ns = timestamp_ns
+            self.open = self.high = self.low = self.close = price
+        else:
+            if timestamp_ns < self.first_ns:
+                self.first_ns, self.open = timestamp_ns, price
+            if timestamp_ns >= self.last_ns:
+                self.last_ns, self.close = timestamp_ns, price
+            self.high = max(self.high, price)
+            self.low = min(self.low, price)
+        self.trades += 1
+        self.volume += quantity
+        self.notional += quantity * price
+        if side > 0:
+            self.buy_volume += quantity
+        elif side < 0:
+            self.sell_volume += quantity
+
+    def merge(self, other: 'Bar') -> 'Bar':
+        """
+        folds in the trades of another bar, returns self
+        """
+        if not other.trades:
+            return self
+        if not self.trades:
+            self.first_ns, self.open, self.high, self.low = other.first_ns, other.open, other.high, other.low
+            self.last_ns, self.close = other.last_ns, other.close
+        else:
+            if other.first_ns < self.first_ns:
+                self.first_ns, self.open = other.first_ns, other.open
+            if other.last_ns >= self.last_ns:
+                self.last_ns, self.close = other.last_ns, other.close
+            self.high = max(self.high, other.high)
+            self.low = min(self.low, other.low)
+        self.trades += other.trades
+        self.volume += other.volume
+        self.notional += other.notional
+        self.buy_volume += other.buy_volume
+        self.sell_volume += other.sell_volume
+        return self
+
+    def vwap(self) -> float:
+        """
+        raises ZeroDivisionError when no shares were traded
+        """
+        return self.notional / self.volume
+
+    def as_dict(self) -> dict:
+        return {"start": ns_to_datetime(self.start_ns), "end": ns_to_datetime(self.end_ns), "open": self.open,
+                "high": self.high, "low": self.low, "close": self.close, "volume": self.volume, "notional": self.notional,
+                "trades": self.trades, "buy_volume": self.buy_volume, "sell_volume": self.sell_volume,
+                "vwap": self.notional / self.volume if self.volume else None}
+
+
+class BarSeries:
+    """
+    bars of one stock at one resolution as typed columns, one row per bucket that saw a trade, rows in bucket order
+    buckets start at whole multiples of the resolution since the epoch
+    """
+    __slots__ = ('resolution_ns', 'starts', 'first_ns', 'last_ns', 'opens', 'highs', 'lows', 'closes',
+                 'volumes', 'notionals', 'trades', 'buy_volumes', 'sell_volumes')
+
+    def __init__(self, resolution_ns: int):
+        self.resolution_ns = resolution_ns
+        self.starts, self.first_ns, self.last_ns = array('q'), array('q'), array('q')
+        self.opens, self.highs, self.lows, self.closes = array('d'), array('d'), array('d'), array('d')
+        self.volumes, self.notionals, self.trades = array('q'), array('d'), array('q')
+        self.buy_volumes, self.sell_volumes = array('q'), array('q')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def columns(self) -> tuple:
+        return (self.starts, self.first_ns, self.last_ns, self.opens, self.highs, self.lows, self.closes,
+                self.volumes, self.notionals, self.trades, self.buy_volumes, self.sell_volumes)
+
+    def add(self, timestamp_ns: int, side: int, price: float, quantity: int) -> None:
+        start_ns = timestamp_ns - timestamp_ns % self.resolution_ns
+        starts = self.starts
+        if starts and start_ns == starts[-1]:
+            row, new_bucket = len(starts) - 1, False
+        elif not starts or start_ns > starts[-1]:
+            row, new_bucket = len(starts), True
+        else:  # late trade for an older bucket
+            row = bisect_left(starts, start_ns)
+            new_bucket = starts[row] != start_ns
+        if new_bucket:
+            for column, value in zip(self.columns(), (start_ns, timestamp_ns, timestamp_ns, price, price, price, price,
+                                                      quantity, quantity * price, 1, quantity if side > 0 else 0,
+                                                      quantity if side < 0 else 0)):
+                column.insert(row, value)
+            return
+        if timestamp_ns < self.first_ns[row]:
+            self.first_ns[row], self.opens[row] = timestamp_ns, price
+        if timestamp_ns >= self.last_ns[row]:
+            self.last_ns[row], self.closes[row] = timestamp_ns, price
+        if price > self.highs[row]:
+            self.highs[row] = price
+        if price < self.lows[row]:
+            self.lows[row] = price
+        self.volumes[row] += quantity
+        self.notionals[row] += quantity * price
+        self.trades[row] += 1
+        if side > 0:
+            self.buy_volumes[row] += quantity
+        elif side < 0:
+            self.sell_volumes[row] += quantity
+
+    def rows_between(self, start_ns: int, end_ns: int) -> range:
+        """
+        rows of the bars starting at/after start_ns and before end_ns
+        """
+        first = bisect_left(self.starts, start_ns)
+        return range(first, bisect_left(self.starts, end_ns, first))
+
+    def bar(self, row: int) -> Bar:
+        bar = Bar(self.starts[row], self.starts[row] + self.resolution_ns)
+        bar.first_ns, bar.last_ns = self.first_ns[row], self.last_ns[row]
+        bar.open, bar.high, bar.low, bar.close = self.opens[row], self.highs[row], self.lows[row], self.closes[row]
+        bar.volume, bar.notional, bar.trades = self.volumes[row], self.notionals[row], self.trades[row]
+        bar.buy_volume, bar.sell_volume = self.buy_volumes[row], self.sell_volumes[row]
+        return bar
+
+
+class BarEngine:
+    """
+    per-symbol OHLCV bars at every resolution in BAR_RESOLUTIONS, updated on every recorded trade
+    a window query adds up whole bars of the coarsest resolution that fits, finer bars towards the edges,
+    and only reads raw trades from the store for the part of the finest bucket the window cuts through
+    writers hold the symbol's shard lock, bars are built from the store on first use of a symbol
+    readers take no lock: bars are updated in place, so a reader checks the stock's write sequence (odd while a writer
+    is inside an update) before and after reading and retries a read that overlapped a write
+    """
+    read_attempts = 8  # lock-free tries before a read of a stock that keeps being written falls back to its shard lock
+
+    def __init__(self, trade_store, trade_shards, resolutions: dict = None):
+        self.trade_store = trade_store
+        self.trade_shards = trade_shards
+        self.resolutions = dict(sorted((resolutions or BAR_RESOLUTIONS).items(), key=lambda item: item[1]))  # finest first
+        self.series = {}  # {symbol: {resolution: BarSeries}}
+        self.sequences = {}  # {symbol: updates started + updates finished}
+        trade_store.reload_listeners.append(self.reset)
+
+    def reset(self) -> None:
+        """
+        the whole trade store was replaced, bars are rebuilt from the store as symbols are used
+        """
+        self.series = {}
+
+    def seed(self, symbol: str) -> dict | None:
+        """
+        bars of one stock built from the store, None if it has never been traded; called with the shard lock held
+        """
+        symbol_trades, rows = self.trade_store.read_symbol_rows(symbol, -2**63)
+        if symbol_trades is None:
+            return None
+        symbol_series = {resolution: BarSeries(resolution_ns) for resolution, resolution_ns in self.resolutions.items()}
+        timestamps, sides, prices, quantities = symbol_trades.timestamps, symbol_trades.sides, symbol_trades.prices, symbol_trades.quantities
+        for series in symbol_series.values():
+            for row in rows:
+                series.add(timestamps[row], sides[row], prices[row], quantities[row])
+        self.series[symbol] = symbol_series
+        return symbol_series
+
+    def on_trade(self, symbol: str, timestamp_ns: int, buy_or_sell: str, quantity: int, price: float) -> None:
+        """
+        called with the symbol's shard lock held, after the trade has been appended to the store
+        """
+        symbol_series = self.series.get(symbol)
+        if symbol_series is None:
+            self.seed(symbol)  # already picks up this trade
+            return
+        side = SIDE_CODES.get(buy_or_sell, 0)
+        sequence = self.sequences[symbol] = self.sequences.get(symbol, 0) + 1
+        for series in symbol_series.values():
+            series.add(timestamp_ns, side, price, quantity)
+        self.sequences[symbol] = sequence + 1
+
+    def on_trades(self, rows: list) -> None:
+        """
+        batch variant of on_trade for (symbol, timestamp_ns, type, price, quantity) rows already in the store
+        """
+        seeded = set()
+        with self.updating({row[0] for row in rows}):
+            for symbol, timestamp_ns, buy_or_sell, price, quantity in rows:
+                symbol_series = self.series.get(symbol)
+                if symbol_series is None:
+                    self.seed(symbol)
+                    seeded.add(symbol)
+                elif symbol not in seeded:
+                    side = SIDE_CODES.get(buy_or_sell, 0)
+                    for series in symbol_series.values():
+                        series.add(timestamp_ns, side, price, quantity)
+
+    @contextmanager
+    def updating(self, symbols):
+        """
+        marks the bars of symbols, and the raw trades readers take bar edges from, as being written to
+        for its duration; reads running meanwhile are retried. called with the symbols' shard locks held
+        """
+        for symbol in symbols:
+            self.sequences[symbol] = self.sequences.get(symbol, 0) + 1
+        try:
+            yield
+        finally:
+            for symbol in symbols:
+                self.sequences[symbol] += 1
+
+    def symbol_series(self, symbol: str) -> dict | None:
+        """
+        called with the shard lock held
+        """
+        symbol_series = self.series.get(symbol)
+        return symbol_series if symbol_series is not None else self.seed(symbol)
+
+    def read(self, symbol: str, query):
+        """
+        query(symbol's {resolution: BarSeries}) run without the shard lock, None if the stock has never been traded
+        a read that overlapped a write is thrown away and run again, the last attempt (or the first read of a stock,
+        which builds its bars) holds the shard lock
+        """
+        for _ in range(self.read_attempts):
+            sequence = self.sequences.get(symbol, 0)
+            symbol_series = self.series.get(symbol)
+            if symbol_series is None:
+                break
+            if sequence % 2:
+                continue
+            try:
+                result = query(symbol_series)
+            except (IndexError, TypeError):  # a bar caught half way through an update, the sequence has moved on
+                continue
+            if self.sequences.get(symbol, 0) == sequence:
+                return result
+        with self.trade_shards.lock_for(symbol):
+            symbol_series = self.symbol_series(symbol)
+            return query(symbol_series) if symbol_series is not None else None
+
+    def bars(self, symbol: str, resolution: str, start_ns: int, end_ns: int) -> list:
+        """
+        bars of one resolution whose buckets start in [start_ns, end_ns), empty if the stock has never been traded
+        raises KeyError for an unknown resolution
+        """
+        resolution_ns = self.resolutions[resolution]
+
+        def read_bars(symbol_series: dict) -> list:
+            series = symbol_series[resolution]
+            return [series.bar(row) for row in series.rows_between(start_ns - start_ns % resolution_ns, end_ns)]
+        return self.read(symbol, read_bars) or []
+
+    def summary(self, symbol: str, start_ns: int, end_ns: int) -> Bar | None:
+        """
+        one bar for the trades with start_ns <= timestamp < end_ns, None if the stock has never been traded
+        """
+        def read_summary(symbol_series: dict) -> Bar:
+            summary = Bar(start_ns, end_ns)
+            self.cover(symbol, [symbol_series[resolution] for resolution in reversed(self.resolutions)], start_ns, end_ns, summary)
+            return summary
+        return self.read(symbol, read_summary)
+
+    def window_summary(self, symbol: str, start_ns: int, end_ns: int, window_ns: int) -> tuple | None:
+        """
+        (summary like summary(), valid_until_ns like valid_until_ns()) taken in one read, so a compaction can not
+        move the raw trades between the two; None if the stock has never been traded
+        """
+        def read_window(symbol_series: dict) -> tuple:
+            summary = Bar(start_ns, end_ns)
+            self.cover(symbol, [symbol_series[resolution] for resolution in reversed(self.resolutions)], start_ns, end_ns, summary)
+            return summary, self.valid_until_ns(symbol, start_ns, window_ns)
+        return self.read(symbol, read_window)
+
+    def valid_until_ns(self, symbol: str, start_ns: int, window_ns: int) -> int | None:
+        """
+        latest "now" a VWSP added up from the bars since start_ns holds for: until the oldest trade in it ages out,
+        or until the start leaves its minute while that edge is rounded to a whole bar of compacted trades
+        reads the raw trades, so it runs inside read like the edges of a summary
+        """
+        symbol_trades, rows = self.trade_store.read_symbol_rows(symbol, start_ns)
+        if symbol_trades is None:
+            return None
+        valid_until_ns = symbol_trades.timestamps[rows[0]] + window_ns if rows else None
+        if start_ns < symbol_trades.compacted_until_ns:
+            minute_end_ns = start_ns - start_ns % NS_PER_MINUTE + NS_PER_MINUTE - 1 + window_ns
+            valid_until_ns = minute_end_ns if valid_until_ns is None else min(valid_until_ns, minute_end_ns)
+        return valid_until_ns
+
+    def cover(self, symbol: str, levels: list, start_ns: int, end_ns: int, summary: Bar) -> None:
+        """
+        merges [start_ns, end_ns) into summary: whole bars of levels[0] where they fit, the edges one level finer
+        """
+        if start_ns >= end_ns:
+            return
+        series = levels[0]
+        whole_start = -(-start_ns // series.resolution_ns) * series.resolution_ns
+        whole_end = end_ns - end_ns % series.resolution_ns
+        if whole_start > whole_end:  # inside a single bucket of this resolution
+            if len(levels) > 1:
+                self.cover(symbol, levels[1:], start_ns, end_ns, summary)
+            else:
+                self.merge_edge(symbol, series, start_ns, end_ns, summary)
+            return
+        for row in series.rows_between(whole_start, whole_end):
+            summary.merge(series.bar(row))
+        for edge_start, edge_end in ((start_ns, whole_start), (whole_end, end_ns)):
+            if len(levels) > 1:
+                self.cover(symbol, levels[1:], edge_start, edge_end, summary)
+            elif edge_start < edge_end:
+                self.merge_edge(symbol, series, edge_start, edge_end, summary)
+
+    def merge_edge(self, symbol: str, series: BarSeries, start_ns: int, end_ns: int, summary: Bar) -> None:
+        """
+        merges trades in [start_ns, end_ns), a part of one finest bucket: the whole bar when all of its trades fall
+        inside, raw trades from the store otherwise; once the bucket's raw trades have been compacted away
+        the whole bar is used, so edges older than the retention horizon are rounded out to the bucket
+        """
+        bucket_start = start_ns - start_ns % series.resolution_ns
+        rows = series.rows_between(bucket_start, bucket_start + 1)
+        if not rows:
+            return
+        bar = series.bar(rows[0])
+        if start_ns <= bar.first_ns and bar.last_ns < end_ns:
+            summary.merge(bar)
+            return
+        symbol_trades, trade_rows = self.trade_store.read_symbol_rows(symbol, start_ns, end_ns)
+        if start_ns < symbol_trades.compacted_until_ns:
+            summary.merge(bar)
+            return
+        for row in trade_rows:
+            summary.add(symbol_trades.timestamps[row], symbol_trades.sides[row], symbol_trades.prices[row],
+                        symbol_trades.quantities[row])
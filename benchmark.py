@@ -0,0 +1,199 @@
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from services import FileDatabase, GBCEIndex, StockService, TradeService, query_cache, service_clock
+
+
+class SyntheticMarket:
+    """
+    seeded synthetic trade generator: a geometric random walk price per symbol and Poisson arrivals,
+    with a share of trades arriving in bursts right after the previous trade
+    """
+
+    def __init__(self, seed: int = 42, symbol_count: int = 50, trades_per_sec: float = 1000.0, volatility: float = 0.001,
+                 burstiness: float = 0.3, start: datetime = None):
+        """
+        volatility is the standard deviation of the log price move per trade,
+        burstiness the share of trades that arrive within a microsecond-scale gap of the previous one
+        """
+        self.random = random.Random(seed)
+        self.symbols = [f"S{number:05d}" for number in range(symbol_count)]
+        self.trades_per_sec = trades_per_sec
+        self.volatility = volatility
+        self.burstiness = burstiness
+        self.clock = start or datetime(2024, 1, 2, 8, 0, 0)
+        self.prices = {symbol: self.random.uniform(5, 500) for symbol in self.symbols}
+
+    def configure_stocks(self) -> None:
+        for symbol in self.symbols:
+            StockService.stock_config_operations(symbol, "Common", round(self.random.uniform(0, 20), 2), 0, 100)
+
+    def trades(self, count: int):
+        """
+        yields count (symbol, quantity, buy_or_sell, trade_price, timestamp) trades in timestamp order
+        """
+        rand = self.random
+        for _ in range(count):
+            if rand.random() < self.burstiness:
+                gap = rand.uniform(0, 1e-5)
+            else:
+                gap = rand.expovariate(self.trades_per_sec)
+            self.clock += timedelta(seconds=gap)
+            symbol = rand.choice(self.symbols)
+            price = self.prices[symbol] = self.prices[symbol] * math.exp(rand.gauss(0, self.volatility))
+            yield symbol, rand.randint(1, 1000), rand.choice(("BUY", "SELL")), round(price, 4), self.clock
+
+
+def reset_trades() -> None:
+    FileDatabase.close_journal()
+    FileDatabase.write_activity_to_localmem({})
+
+
+def latency_summary(samples: list) -> dict:
+    samples = sorted(samples)
+    return {"calls": len(samples), "mean_us": statistics.fmean(samples) * 1e6, "p50_us": samples[len(samples) // 2] * 1e6,
+            "p99_us": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6}
+
+
+def scenario_ingestion(market: SyntheticMarket, trades: int) -> dict:
+    """
+    trades/s through record_trade one at a time and through record_trades in batches
+    """
+    reset_trades()
+    single = list(market.trades(min(trades, 50000)))
+    start = time.perf_counter()
+    for trade in single:
+        TradeService.record_trade(*trade)
+    per_trade = len(single) / (time.perf_counter() - start)
+
+    reset_trades()
+    bulk = list(market.trades(trades))
+    start = time.perf_counter()
+    for offset in range(0, len(bulk), 100000):
+        TradeService.record_trades(bulk[offset:offset + 100000])
+    batched = len(bulk) / (time.perf_counter() - start)
+    return {"record_trade_per_sec": per_trade, "record_trades_per_sec": batched, "trades": trades}
+
+
+def scenario_query_latency(market: SyntheticMarket, history_sizes: list, calls: int = 2000) -> dict:
+    """
+    latency of the public VWSP and All Share Index calls as the recorded history grows: uncached (the query cache
+    is emptied before the call) and cached (the same call again, with no trade in between)
+    """
+    reset_trades()
+    results, loaded = [], 0
+    try:
+        for history_size in history_sizes:
+            trades = list(market.trades(history_size - loaded))
+            loaded = history_size
+            service_clock.set(market.clock)  # windows end at the last synthetic trade, not at wall-clock time
+            TradeService.record_trades(trades)
+            samples = {"vwsp": [], "vwsp_uncached": [], "all_share_index": [], "all_share_index_uncached": []}
+            for _ in range(calls):
+                symbol = market.random.choice(market.symbols)
+                for name, call in (("vwsp", lambda: StockService.volume_weighted_stock_price(symbol)),
+                                   ("all_share_index", GBCEIndex.all_share_index)):
+                    query_cache.invalidate()
+                    for cached in (False, True):
+                        start = time.perf_counter()
+                        call()
+                        samples[name if cached else f"{name}_uncached"].append(time.perf_counter() - start)
+            results.append({"history": history_size, **{name: latency_summary(times) for name, times in samples.items()}})
+    finally:
+        service_clock.release()
+    return {"by_history_size": results}
+
+
+def scenario_memory(market: SyntheticMarket, trades: int) -> dict:
+    """
+    bytes per trade: column bytes in the trade store and traced allocations while ingesting
+    """
+    reset_trades()
+    batch = list(market.trades(trades))
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    TradeService.record_trades(batch)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"trades": trades, "store_bytes_per_trade": FileDatabase.trade_store.nbytes() / trades,
+            "traced_bytes_per_trade": (after - before) / trades, "peak_traced_bytes_per_trade": (peak - before) / trades}
+
+
+def scenario_startup(market: SyntheticMarket, trades: int) -> dict:
+    """
+    seconds to reopen a journal of the given size and answer the first index and VWSP queries
+    """
+    reset_trades()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        journal_file = os.path.join(tmp_dir, "bench.journal")
+        FileDatabase.open_journal(journal_file)
+        for offset in range(0, trades, 100000):
+            TradeService.record_trades(list(market.trades(min(100000, trades - offset))))
+        FileDatabase.close_journal()
+        start = time.perf_counter()
+        replayed = FileDatabase.open_journal(journal_file)
+        GBCEIndex.all_share_index()
+        StockService.vwsp_engine.get_window(market.symbols[0])
+        seconds = time.perf_counter() - start
+        FileDatabase.close_journal()
+        journal_bytes = os.path.getsize(journal_file)
+    reset_trades()
+    return {"trades": replayed, "startup_seconds": seconds, "journal_bytes_per_trade": journal_bytes / replayed if replayed else None}
+
+
+SCENARIOS = ("ingestion", "query_latency", "memory", "startup")
+
+
+def run(scenarios, trades: int, symbol_count: int, seed: int, burstiness: float, trades_per_sec: float = 1000.0,
+        volatility: float = 0.001) -> dict:
+    market = SyntheticMarket(seed=seed, symbol_count=symbol_count, trades_per_sec=trades_per_sec, volatility=volatility,
+                             burstiness=burstiness)
+    market.configure_stocks()
+    results = []
+    for scenario in scenarios:
+        start = time.perf_counter()
+        if scenario == "ingestion":
+            metrics = scenario_ingestion(market, trades)
+        elif scenario == "query_latency":
+            metrics = scenario_query_latency(market, [size for size in (1000, 10000, 100000, 1000000) if size <= trades] or [trades])
+        elif scenario == "memory":
+            metrics = scenario_memory(market, trades)
+        else:
+            metrics = scenario_startup(market, trades)
+        results.append({"scenario": scenario, "seconds": time.perf_counter() - start, "metrics": metrics})
+    return {"meta": {"python": sys.version.split()[0], "platform": platform.platform(), "run_at": datetime.now().isoformat(),
+                     "seed": seed, "trades": trades, "symbols": symbol_count, "burstiness": burstiness,
+                     "trades_per_sec": trades_per_sec, "volatility": volatility},
+            "results": results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="GBCE benchmarks on a seeded synthetic market, results as JSON")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--trades", type=int, default=100000)
+    parser.add_argument("--symbols", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--burstiness", type=float, default=0.3)
+    parser.add_argument("--rate", type=float, default=1000.0, help="mean trades per second of the synthetic market")
+    parser.add_argument("--volatility", type=float, default=0.001, help="standard deviation of the log price move per trade")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    report = run(SCENARIOS if args.scenario == "all" else (args.scenario,), args.trades, args.symbols, args.seed, args.burstiness,
+                 args.rate, args.volatility)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
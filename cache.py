@@ -0,0 +1,116 @@
+import threading
+from collections import OrderedDict
+
+MISS = object()  # lookup result for a key with no valid entry, None is a value that can be cached
+
+
+class QueryCache:
+    """
+    LRU cache of query results keyed by (operation, symbol, parameters)
+    entries are stamped with the version they were computed at: a symbol's version moves on every trade or config
+    change of that symbol, the sequence on every change of any symbol, so nothing is ever served stale;
+    results computed from the config alone (dividend yield, P/E) are stamped with the symbol's config version instead,
+    which trades leave alone;
+    results that also depend on the time (VWSP windows) carry the span of "now" they hold for
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {key: (version, valid_from_ns, valid_until_ns, value)}, least recent first
+        self.symbol_versions = {}  # {symbol: changes seen}
+        self.config_versions = {}  # {symbol: config changes seen}
+        self.sequence = 0  # changes seen over every symbol, what whole-market results are stamped with
+        self.epoch = 0  # moved when everything is invalidated at once
+        self.hits = self.misses = self.evictions = 0
+
+    def version(self, symbol: str = None) -> tuple:
+        """
+        version to stamp a result with, read before computing it: a change made while it is computed
+        moves the version on and the result is never served
+        """
+        if symbol is None:
+            return self.epoch, self.sequence
+        return self.epoch, self.symbol_versions.get(symbol, 0)
+
+    def config_version(self, symbol: str) -> tuple:
+        """
+        version to stamp a result that only depends on the config of symbol with
+        """
+        return self.epoch, self.config_versions.get(symbol, 0)
+
+    def bump_config(self, symbol: str) -> None:
+        """
+        called after the config of symbol changed, along with bump
+        """
+        with self.lock:
+            self.config_versions[symbol] = self.config_versions.get(symbol, 0) + 1
+
+    def bump(self, symbol: str) -> None:
+        """
+        called after the trades or the config of symbol changed
+        """
+        with self.lock:
+            self.symbol_versions[symbol] = self.symbol_versions.get(symbol, 0) + 1
+            self.sequence += 1
+
+    def bump_many(self, symbols) -> None:
+        with self.lock:
+            for symbol in symbols:
+                self.symbol_versions[symbol] = self.symbol_versions.get(symbol, 0) + 1
+            self.sequence += 1
+
+    def invalidate(self) -> None:
+        """
+        drops every entry, e.g. once the whole trade store was replaced
+        """
+        with self.lock:
+            self.entries.clear()
+            self.epoch += 1
+
+    def get(self, key: tuple, version: tuple, now_ns: int = None):
+        """
+        the cached value for key if it was computed at version (and holds at now_ns), MISS otherwise
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry_version, valid_from_ns, valid_until_ns, value = entry
+                if entry_version == version and (now_ns is None or (valid_from_ns is None or valid_from_ns <= now_ns)
+                                                 and (valid_until_ns is None or now_ns <= valid_until_ns)):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return MISS
+
+    def put(self, key: tuple, version: tuple, value, valid_from_ns: int = None, valid_until_ns: int = None) -> None:
+        """
+        stores value computed at version, valid for valid_from_ns <= now <= valid_until_ns (None: unbounded)
+        """
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (version, valid_from_ns, valid_until_ns, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def resize(self, max_entries: int) -> None:
+        with self.lock:
+            self.max_entries = max_entries
+            while len(self.entries) > max(max_entries, 0):
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+
+class Clock:
+    """
+    source of "now" for the services: wall-clock time unless it has been pinned to a simulated time
+    a replay pins it to each trade's timestamp, so VWSP windows and default trade times follow the tape
+    """
+
+    def __init__(self):
+        self.simulated_time = None
+
+    def now(self) -> datetime:
+        simulated_time = self.simulated_time
+        return simulated_time if simulated_time is not None else datetime.now()
+
+    @property
+    def simulated(self) -> bool:
+        return self.simulated_time is not None
+
+    def set(self, timestamp: datetime) -> None:
+        """
+        pins now() to timestamp until the next set() or release()
+        """
+        self.simulated_time = timestamp
+
+    def release(self) -> None:
+        """
+        back to wall-clock time
+        """
+        self.simulated_time = None
@@ -0,0 +1,237 @@
+import json
+import math
+from datetime import datetime
+from typing import Iterable, Iterator, List
+from services import GBCEIndex, StockService, StatsService, TradeService, service_clock
+
+# argument order of each op in command form, e.g. "record_trade TEA 100 BUY 9.5" or "vwsp TEA 15"
+COMMAND_ARGUMENTS = {
+    "record_trade": ("symbol", "quantity", "type", "price", "timestamp"),
+    "vwsp": ("symbol", "interval_in_mins"),
+    "dividend_yield": ("symbol", "price"),
+    "pe_ratio": ("symbol", "price"),
+    "trade_summary": ("symbol", "start", "end"),
+    "bars": ("symbol", "resolution", "start", "end"),
+    "trades": ("symbol", "start", "end"),
+    "side_summary": ("symbol", "start", "end"),
+    "latest_trades": ("symbol", "count"),
+    "largest_trades": ("symbol", "count", "start", "end"),
+    "all_share_index": (),
+    "define_index": ("name", "constituents"),
+    "index": ("name",),
+    "indices": (),
+    "stats": (),
+}
+
+
+def finite(value, name: str):
+    """
+    value if it is a finite number, raises ValueError otherwise (JSON numbers such as 1e400 parse as infinity)
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f"{name} must be a finite number, not {value!r}")
+    return value
+
+
+def parse_trade(request: dict) -> tuple:
+    """
+    (symbol, quantity, buy_or_sell, trade_price, timestamp) from a record_trade request, raises KeyError/ValueError/TypeError
+    timestamps are naive trade times, one with a time zone is rejected here rather than failing the batch it joins
+    """
+    buy_or_sell = str(request["type"]).upper()
+    if buy_or_sell not in {"BUY", "SELL"}:
+        raise ValueError(f"type must be BUY or SELL, not {request['type']}")
+    quantity = request["quantity"]
+    if not isinstance(quantity, int) or isinstance(quantity, bool):
+        raise TypeError(f"quantity must be a whole number, not {quantity!r}")
+    timestamp = parse_time(request, "timestamp")
+    return (str(request["symbol"]).upper(), quantity, buy_or_sell, finite(float(request["price"]), "price"),
+            timestamp or service_clock.now())
+
+
+def parse_time(request: dict, key: str) -> datetime | None:
+    if not request.get(key):
+        return None
+    timestamp = datetime.fromisoformat(request[key])
+    if timestamp.tzinfo is not None:
+        raise ValueError(f"{key} {request[key]} has a time zone, times are naive")
+    return timestamp
+
+
+def bar_to_json(bar: dict) -> dict:
+    return {**bar, "start": bar["start"].isoformat(), "end": bar["end"].isoformat()}
+
+
+def trade_to_json(trade: dict) -> dict:
+    return {**trade, "timestamp": trade["timestamp"].isoformat()}
+
+
+def response(request: dict, status: str, result=None, error: str = None) -> dict:
+    reply = {"id": request.get("id"), "status": status, "result": result}
+    if error is not None:
+        reply["error"] = error
+    return reply
+
+
+def execute(request: dict) -> dict:
+    """
+    runs one operation request against the services and returns its response
+    requests are dicts with an "op" and its arguments, an optional "id" is echoed back:
+        {"op": "record_trade", "symbol": "TEA", "quantity": 100, "type": "BUY", "price": 9.5, "timestamp": "2024-01-02T10:00:00"}
+        {"op": "vwsp", "symbol": "TEA", "interval_in_mins": 5}
+        {"op": "dividend_yield", "symbol": "TEA", "price": 9.5}
+        {"op": "pe_ratio", "symbol": "TEA", "price": 9.5}
+        {"op": "trade_summary", "symbol": "TEA", "start": "2024-01-02T08:00:00", "end": "2024-01-02T16:30:00"}
+        {"op": "bars", "symbol": "TEA", "resolution": "5m", "start": "2024-01-02T08:00:00"}
+        {"op": "trades", "symbol": "TEA", "start": "2024-01-02T10:00:00", "end": "2024-01-02T10:05:00"}
+        {"op": "side_summary", "symbol": "TEA", "start": "2024-01-02T08:00:00"}
+        {"op": "latest_trades", "symbol": "TEA", "count": 20}
+        {"op": "largest_trades", "symbol": "TEA", "count": 5, "start": "2024-01-02T08:00:00"}
+        {"op": "all_share_index"}
+        {"op": "define_index", "name": "STOUTS", "constituents": ["TEA", "POP"], "weights": {"TEA": 2}}
+        {"op": "index", "name": "STOUTS"}
+        {"op": "indices"}
+        {"op": "stats"}
+    responses are {"id": ..., "status": "Success" | "Failure", "result": ...} plus an "error" for malformed requests,
+    a request with numbers out of range (a count of 1e400, an interval past the calendar) is answered like a malformed one
+    """
+    operation = request.get("op")
+    try:
+        if operation == "record_trade":
+            return response(request, TradeService.record_trade(*parse_trade(request)))
+        if operation == "vwsp":
+            status, vwsp = StockService.volume_weighted_stock_price(str(request["symbol"]).upper(),
+                                                                    finite(request.get("interval_in_mins", 5), "interval_in_mins"))
+            return response(request, status, vwsp)
+        if operation == "dividend_yield":
+            status, dividend_yield = StockService.calculate_dividend_yield(str(request["symbol"]).upper(),
+                                                                          finite(float(request["price"]), "price"))
+            return response(request, status, dividend_yield)
+        if operation == "pe_ratio":
+            status, pe_ratio = StockService.calculate_pe_ratio(str(request["symbol"]).upper(), finite(float(request["price"]), "price"))
+            return response(request, status, pe_ratio)
+        if operation == "trade_summary":
+            status, summary = StockService.trade_summary(str(request["symbol"]).upper(), parse_time(request, "start") or datetime.min,
+                                                         parse_time(request, "end"))
+            return response(request, status, bar_to_json(summary) if summary is not None else None)
+        if operation == "bars":
+            status, bars = StockService.ohlcv_bars(str(request["symbol"]).upper(), request.get("resolution", "1m"),
+                                                   parse_time(request, "start"), parse_time(request, "end"))
+            return response(request, status, [bar_to_json(bar) for bar in bars])
+        if operation == "trades":
+            status, trades = StockService.trades_between(str(request["symbol"]).upper(), parse_time(request, "start") or datetime.min,
+                                                         parse_time(request, "end"))
+            return response(request, status, [trade_to_json(trade) for trade in trades])
+        if operation == "side_summary":
+            status, sides = StockService.side_summary(str(request["symbol"]).upper(), parse_time(request, "start") or datetime.min,
+                                                      parse_time(request, "end"))
+            return response(request, status, sides)
+        if operation == "latest_trades":
+            status, trades = StockService.latest_trades(str(request["symbol"]).upper(), int(request.get("count", 10)))
+            return response(request, status, [trade_to_json(trade) for trade in trades])
+        if operation == "largest_trades":
+            status, trades = StockService.largest_trades(str(request["symbol"]).upper(), int(request.get("count", 10)),
+                                                         parse_time(request, "start"), parse_time(request, "end"))
+            return response(request, status, [trade_to_json(trade) for trade in trades])
+        if operation == "all_share_index":
+            gbce_all_share_index = GBCEIndex.all_share_index()
+            return response(request, "Success" if gbce_all_share_index is not None else "Failure", gbce_all_share_index)
+        if operation == "define_index":
+            constituents = request["constituents"]
+            if isinstance(constituents, str):  # command form: comma separated
+                constituents = constituents.split(",")
+            weights = {str(symbol).upper(): weight for symbol, weight in dict(request.get("weights") or {}).items()}
+            return response(request, GBCEIndex.define_index(str(request["name"]),
+                                                            [str(symbol).upper() for symbol in constituents], weights))
+        if operation == "index":
+            status, index_value = GBCEIndex.index_value(str(request["name"]))
+            return response(request, status, index_value)
+        if operation == "indices":
+            return response(request, "Success", GBCEIndex.index_values())
+        if operation == "stats":
+            return response(request, "Success", StatsService.stats())
+        return response(request, "Failure", error=f"unknown op {operation!r}")
+    except (KeyError, ValueError, TypeError, ArithmeticError) as why:
+        return response(request, "Failure", error=f"bad {operation} request: {why!r}")
+
+
+def parse_command(line: str) -> dict:
+    """
+    request for a command line: the op, then its arguments in COMMAND_ARGUMENTS order, numbers as numbers
+    """
+    op, *arguments = line.split()
+    names = COMMAND_ARGUMENTS.get(op)
+    if names is None:
+        raise ValueError(f"unknown command {op!r}")
+    if len(arguments) > len(names):
+        raise ValueError(f"{op} takes at most {len(names)} arguments: {' '.join(names)}")
+    request = {"op": op}
+    for name, argument in zip(names, arguments):
+        try:
+            value = json.loads(argument)
+            request[name] = value if isinstance(value, (int, float)) and not isinstance(value, bool) else argument
+        except ValueError:
+            request[name] = argument
+    return request
+
+
+def parse_line(line: str, line_number: int) -> dict | None:
+    """
+    request for one line of a batch, a JSON request object or a command; None for blank lines and # comments
+    command requests are given their line number as id
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+        return request
+    return {"id": line_number, **parse_command(line)}
+
+
+def record_trade_run(trade_run: List[tuple]) -> List[dict]:
+    """
+    responses for consecutive record_trade requests, the valid trades are recorded with one record_trades_each call
+    and every request is answered with its own trade's result, a caller retrying the failures records nothing twice
+    """
+    trades = [trade for _, trade in trade_run if isinstance(trade, tuple)]
+    _, errors = TradeService.record_trades_each(trades) if trades else ("Success", [])
+    errors = iter(errors)
+    responses = []
+    for request, trade in trade_run:
+        error = next(errors) if isinstance(trade, tuple) else f"bad record_trade request: {trade!r}"
+        responses.append(response(request, "Success") if error is None else response(request, "Failure", error=error))
+    return responses
+
+
+def execute_batch(lines: Iterable[str], max_trade_run: int = 10000) -> Iterator[dict]:
+    """
+    responses, in order, for a script of request lines (see parse_line); runs of record_trade requests are recorded
+    in bulk, every query sees the trades of the lines before it
+    """
+    trade_run = []  # [(request, trade or parse error)] not recorded yet
+    for line_number, line in enumerate(lines, 1):
+        try:
+            request = parse_line(line, line_number)
+        except ValueError as why:
+            yield from record_trade_run(trade_run)
+            trade_run = []
+            yield response({"id": line_number}, "Failure", error=f"bad request line {line_number}: {why}")
+            continue
+        if request is None:
+            continue
+        if request.get("op") == "record_trade":
+            try:
+                trade_run.append((request, parse_trade(request)))
+            except (KeyError, ValueError, TypeError, ArithmeticError) as why:
+                trade_run.append((request, why))
+            if len(trade_run) >= max_trade_run:
+                yield from record_trade_run(trade_run)
+                trade_run = []
+            continue
+        yield from record_trade_run(trade_run)
+        trade_run = []
+        yield execute(request)
+    yield from record_trade_run(trade_run)
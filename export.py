@@ -0,0 +1,170 @@
+import ast
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Iterable
+from models import SIDE_NAMES
+
+try:
+    import numpy as np
+except ImportError:  # columns are loaded as memoryviews over the mapped files
+    np = None
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_FORMAT = "gbce-columns/1"
+NPY_MAGIC = b"\x93NUMPY\x01\x00"  # .npy format version 1.0
+NPY_ALIGNMENT = 64  # the data of every column starts on a 64 byte boundary, as numpy writes it
+BYTE_ORDER = "<" if sys.byteorder == "little" else ">"
+DESCRS = {"q": BYTE_ORDER + "i8", "d": BYTE_ORDER + "f8", "b": "|i1"}
+TYPECODES = {descr: typecode for typecode, descr in DESCRS.items()}
+# every stock's trades end to end in the order recorded, rows symbol_offsets[i]:symbol_offsets[i + 1] are the trades of symbols[i]
+TRADE_COLUMNS = (("timestamps", "q"), ("prices", "d"), ("quantities", "q"), ("sides", "b"))
+# one row per stock over its whole history, compacted trades included; vwsps are nan for stocks without quantity
+SYMBOL_COLUMNS = (("symbol_offsets", "q"), ("trade_counts", "q"), ("total_quantities", "q"), ("total_notionals", "d"),
+                  ("vwsps", "d"))
+
+
+def npy_header(typecode: str, length: int) -> bytes:
+    """
+    .npy header of a one dimensional column of length values
+    """
+    header = f"{{'descr': '{DESCRS[typecode]}', 'fortran_order': False, 'shape': ({length},), }}"
+    header += " " * (-(len(NPY_MAGIC) + 2 + len(header) + 1) % NPY_ALIGNMENT) + "\n"
+    return NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def write_column(path: str, typecode: str, length: int, chunks: Iterable[array]) -> int:
+    """
+    writes the chunks, length values in all, end to end as one .npy file, returns the file size
+    written next to path first and moved over it, so a reader never maps half a column
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as column:
+        column.write(npy_header(typecode, length))
+        for chunk in chunks:
+            column.write(chunk)  # straight from the array's buffer
+        size = column.tell()
+    os.replace(temporary_path, path)
+    return size
+
+
+def snapshot_trade_store(trade_store) -> dict:
+    """
+    copies of the trade columns of trade_store and its per-stock aggregates, everything write_export needs;
+    the caller keeps writers out while it runs, it copies memory only so the disk write can happen after
+    """
+    symbol_trades = [trade_store.symbols[symbol] for symbol in sorted(trade_store.symbols)]
+    offsets = array("q", [0])
+    for trades in symbol_trades:
+        offsets.append(offsets[-1] + len(trades))
+    quantities = [trades.total_quantity() for trades in symbol_trades]
+    notionals = [trades.total_notional() for trades in symbol_trades]
+    symbol_columns = {
+        "symbol_offsets": offsets,
+        "trade_counts": array("q", [len(trades) + trades.compacted_trades for trades in symbol_trades]),
+        "total_quantities": array("q", quantities),
+        "total_notionals": array("d", notionals),
+        "vwsps": array("d", [notional / quantity if quantity else math.nan for quantity, notional in zip(quantities, notionals)]),
+    }
+    return {"symbols": [trades.symbol for trades in symbol_trades], "symbol_columns": symbol_columns,
+            "trade_columns": {name: [getattr(trades, name)[:] for trades in symbol_trades] for name, _ in TRADE_COLUMNS}}
+
+
+def write_export(snapshot: dict, directory: str, exported_at_ns: int = None) -> dict:
+    """
+    writes a snapshot_trade_store snapshot to directory as .npy columns plus a manifest, returns the manifest;
+    the manifest is written last
+    """
+    os.makedirs(directory, exist_ok=True)
+    symbol_columns = snapshot["symbol_columns"]
+    offsets = symbol_columns["symbol_offsets"]
+    columns = {}
+    for name, typecode in TRADE_COLUMNS:
+        size = write_column(os.path.join(directory, f"{name}.npy"), typecode, offsets[-1], snapshot["trade_columns"][name])
+        columns[name] = {"file": f"{name}.npy", "descr": DESCRS[typecode], "length": offsets[-1], "bytes": size}
+    for name, typecode in SYMBOL_COLUMNS:
+        size = write_column(os.path.join(directory, f"{name}.npy"), typecode, len(symbol_columns[name]), (symbol_columns[name],))
+        columns[name] = {"file": f"{name}.npy", "descr": DESCRS[typecode], "length": len(symbol_columns[name]), "bytes": size}
+    manifest = {"format": MANIFEST_FORMAT, "exported_at_ns": exported_at_ns, "trades": offsets[-1],
+                "symbols": snapshot["symbols"], "sides": {str(code): name for code, name in SIDE_NAMES.items()},
+                "columns": columns}
+    temporary_path = os.path.join(directory, f"{MANIFEST_FILE}.tmp")
+    with open(temporary_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temporary_path, os.path.join(directory, MANIFEST_FILE))
+    return manifest
+
+
+def export_trade_store(trade_store, directory: str, exported_at_ns: int = None) -> dict:
+    """
+    snapshot_trade_store and write_export in one go, for a trade store no one is writing to
+    """
+    return write_export(snapshot_trade_store(trade_store), directory, exported_at_ns)
+
+
+def map_column(path: str):
+    """
+    read-only memoryview over the values of a .npy column written by write_column, no numpy needed
+    """
+    with open(path, "rb") as column:
+        mapped = mmap.mmap(column.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(NPY_MAGIC)] != NPY_MAGIC:
+        raise ValueError(f"{path} is not a version 1.0 .npy file")
+    header_length, = struct.unpack_from("<H", mapped, len(NPY_MAGIC))
+    offset = len(NPY_MAGIC) + 2 + header_length
+    header = ast.literal_eval(mapped[len(NPY_MAGIC) + 2:offset].decode("latin1"))
+    typecode = TYPECODES.get(header["descr"])
+    if typecode is None or header["fortran_order"] or len(header["shape"]) != 1:
+        raise ValueError(f"{path} holds a {header['descr']} {header['shape']} column this machine can not map")
+    return memoryview(mapped)[offset:].cast(typecode)
+
+
+class ColumnarExport:
+    """
+    an export written by write_export, opened without copying: every column is a read-only memory map,
+    a numpy memmap when numpy is installed (use_numpy=False forces the fallback) or a memoryview otherwise
+    """
+
+    def __init__(self, directory: str, use_numpy: bool = True):
+        with open(os.path.join(directory, MANIFEST_FILE)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        if self.manifest.get("format") != MANIFEST_FORMAT:
+            raise ValueError(f"{directory} holds a {self.manifest.get('format')} export, not {MANIFEST_FORMAT}")
+        self.directory = directory
+        self.symbols = self.manifest["symbols"]
+        self.rows_of = {symbol: row for row, symbol in enumerate(self.symbols)}
+        self.columns = {}
+        for name, column in self.manifest["columns"].items():
+            path = os.path.join(directory, column["file"])
+            if os.path.getsize(path) != column["bytes"]:
+                raise ValueError(f"{path} is {os.path.getsize(path)} bytes, the manifest says {column['bytes']}")
+            self.columns[name] = np.load(path, mmap_mode="r") if np is not None and use_numpy else map_column(path)
+            if len(self.columns[name]) != column["length"]:
+                raise ValueError(f"{path} holds {len(self.columns[name])} values, the manifest says {column['length']}")
+
+    def __getitem__(self, name: str):
+        return self.columns[name]
+
+    def __len__(self):
+        return self.manifest["trades"]
+
+    def trades(self, symbol: str) -> dict:
+        """
+        {trade column: slice of it holding the trades of symbol}, still without copying
+        """
+        row = self.rows_of[symbol]
+        offsets = self.columns["symbol_offsets"]
+        start, end = int(offsets[row]), int(offsets[row + 1])
+        return {name: self.columns[name][start:end] for name, _ in TRADE_COLUMNS}
+
+    def aggregates(self, symbol: str) -> dict:
+        """
+        {per-stock column: value} of symbol
+        """
+        row = self.rows_of[symbol]
+        values = {name: self.columns[name][row] for name, _ in SYMBOL_COLUMNS[1:]}
+        return {name: value.item() if hasattr(value, "item") else value for name, value in values.items()}
@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import json
+import logging
+from commands import execute, parse_trade, response
+from services import FileDatabase, StockService, TradeService, stock_config_snapshot_file
+
+
+class TradeGateway:
+    """
+    asyncio server for line-delimited JSON requests over TCP, see commands.execute for the request format
+    - requests on a connection are pipelined, responses come back in request order
+    - record_trade requests arriving in the same event-loop tick, from any connection, are recorded as one batch
+    - backpressure: a connection stops being read once max_in_flight responses are waiting to be sent
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, max_in_flight: int = 1024, max_line_bytes: int = 64 * 1024):
+        self.host = host
+        self.port = port
+        self.max_in_flight = max_in_flight
+        self.max_line_bytes = max_line_bytes
+        self.pending_trades = []  # [(trade, request, future)] waiting for the end of the tick
+        self.server = None
+
+    async def start(self) -> asyncio.Server:
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port, limit=self.max_line_bytes)
+        self.port = self.server.sockets[0].getsockname()[1]  # the port actually bound when asked for port 0
+        logging.info(f"trade gateway listening on {self.host}:{self.port}")
+        return self.server
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    @staticmethod
+    def completed(reply: dict) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(reply)
+        return future
+
+    def enqueue_trade(self, request: dict) -> asyncio.Future:
+        try:
+            trade = parse_trade(request)
+        except (KeyError, ValueError, TypeError) as why:
+            return self.completed(response(request, "Failure", error=f"bad record_trade request: {why!r}"))
+        if trade[0] not in StockService.config_stocks_list:
+            return self.completed(response(request, "Failure", error=f"unknown symbol {trade[0]}"))
+        future = asyncio.get_running_loop().create_future()
+        if not self.pending_trades:
+            asyncio.get_running_loop().call_soon(self.flush_trades)
+        self.pending_trades.append((trade, request, future))
+        return future
+
+    def flush_trades(self) -> None:
+        """
+        records every pending trade with a single record_trades_each call, each trade is answered with its own result
+        """
+        pending_trades, self.pending_trades = self.pending_trades, []
+        if not pending_trades:
+            return
+        _, errors = TradeService.record_trades_each([trade for trade, _, _ in pending_trades])
+        for (_, request, future), error in zip(pending_trades, errors):
+            if not future.done():
+                future.set_result(response(request, "Success") if error is None else response(request, "Failure", error=error))
+
+    def submit(self, line: bytes) -> asyncio.Future:
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+        except ValueError as why:
+            return self.completed(response({}, "Failure", error=f"bad request line: {why}"))
+        if request.get("op") == "record_trade":
+            return self.enqueue_trade(request)
+        # queries see every trade received before them
+        self.flush_trades()
+        return self.completed(execute(request))
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        responses = asyncio.Queue(maxsize=self.max_in_flight)
+        writer_task = asyncio.create_task(self.write_responses(responses, writer))
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:  # line longer than max_line_bytes
+                    await responses.put(self.completed(response({}, "Failure", error="request line too long")))
+                    break
+                if not line:
+                    break
+                if line.strip():
+                    await responses.put(self.submit(line))  # waits here while the client is not reading
+        except ConnectionError:
+            pass
+        finally:
+            await responses.put(None)
+            await writer_task
+            writer.close()
+
+    async def write_responses(self, responses: asyncio.Queue, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                future = await responses.get()
+                if future is None:
+                    break
+                writer.write(json.dumps(await future).encode() + b"\n")
+                if responses.empty():
+                    await writer.drain()  # coalesces writes while more responses are ready
+            await writer.drain()
+        except ConnectionError:
+            while (await responses.get()) is not None:  # keep the reader from blocking on a dead client
+                pass
+
+
+async def serve(host: str, port: int) -> None:
+    gateway = TradeGateway(host, port)
+    server = await gateway.start()
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="GBCE trade capture and query gateway (line-delimited JSON over TCP)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--journal", help="trade journal file: trades in it are replayed on startup and new trades are appended")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    StockService.load_stock_config(snapshot_file=stock_config_snapshot_file)
+    if args.journal:
+        FileDatabase.open_journal(args.journal)
+    asyncio.run(serve(args.host, args.port))
@@ -0,0 +1,177 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import Iterable, Iterator
+from models import SIDE_CODES
+
+try:
+    import numpy as np
+except ImportError:  # replay falls back to unpacking the records one by one
+    np = None
+
+JOURNAL_MAGIC = b"GBCETJ01"
+JOURNAL_HEADER = struct.Struct("<8sII")  # magic, record size, reserved
+# symbol, timestamp_ns, price, quantity, side, padding, crc32 of everything before it
+JOURNAL_RECORD = struct.Struct("<16sqdqb3xI")
+CHECKED_BYTES = JOURNAL_RECORD.size - 4
+SYMBOL_BYTES = 16
+
+
+class TradeJournal:
+    """
+    append-only binary journal of fixed-size, checksummed trade records on local disk
+    reads go through a memory map, a torn or corrupt tail left by a crash is cut off when the journal is opened
+    """
+
+    def __init__(self, path: str, fsync: bool = False, verify_all: bool = False):
+        """
+        fsync=True syncs every append to the device, otherwise appends survive a process crash but not a power cut
+        verify_all=True checks the crc of every record on open instead of only the tail
+        """
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.Lock()  # appends come from every shard
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < JOURNAL_HEADER.size:
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_RECORD.size, 0))
+        else:
+            magic, record_size, _ = JOURNAL_HEADER.unpack(os.pread(self.fd, JOURNAL_HEADER.size, 0))
+            if magic != JOURNAL_MAGIC or record_size != JOURNAL_RECORD.size:
+                os.close(self.fd)
+                raise ValueError(f"{path} is not a trade journal (or was written with another record layout)")
+        self.record_count = self.recover(verify_all)
+        os.lseek(self.fd, 0, os.SEEK_END)
+
+    def __len__(self):
+        return self.record_count
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @staticmethod
+    def record_ok(record: memoryview) -> bool:
+        return zlib.crc32(record[:CHECKED_BYTES]) == int.from_bytes(record[CHECKED_BYTES:], "little")
+
+    def recover(self, verify_all: bool) -> int:
+        """
+        number of intact records, the file is truncated right after the last one
+        appends only ever touch the end of the file, so unless verify_all is set only the tail is checked:
+        a partial record is dropped and trailing records failing their crc are dropped
+        """
+        size = os.fstat(self.fd).st_size
+        record_count = (size - JOURNAL_HEADER.size) // JOURNAL_RECORD.size
+        if record_count:
+            with mmap.mmap(self.fd, JOURNAL_HEADER.size + record_count * JOURNAL_RECORD.size, access=mmap.ACCESS_READ) as journal_map:
+                records = memoryview(journal_map)[JOURNAL_HEADER.size:]
+                try:
+                    if verify_all:
+                        for position in range(record_count):
+                            if not self.record_ok(records[position * JOURNAL_RECORD.size:(position + 1) * JOURNAL_RECORD.size]):
+                                record_count = position
+                                break
+                    else:
+                        while record_count and not self.record_ok(records[(record_count - 1) * JOURNAL_RECORD.size:
+                                                                          record_count * JOURNAL_RECORD.size]):
+                            record_count -= 1
+                finally:
+                    records.release()
+        valid_size = JOURNAL_HEADER.size + record_count * JOURNAL_RECORD.size
+        if valid_size != size:
+            os.ftruncate(self.fd, valid_size)
+        return record_count
+
+    @staticmethod
+    def pack(symbol: str, timestamp_ns: int, buy_or_sell: str, trade_price: float, quantity: int) -> bytes:
+        symbol_bytes = symbol.encode()
+        if len(symbol_bytes) > SYMBOL_BYTES:
+            raise ValueError(f"symbol {symbol} is longer than the {SYMBOL_BYTES} bytes a journal record holds")
+        record = JOURNAL_RECORD.pack(symbol_bytes, timestamp_ns, trade_price, quantity, SIDE_CODES.get(buy_or_sell, 0), 0)
+        return record[:CHECKED_BYTES] + zlib.crc32(record[:CHECKED_BYTES]).to_bytes(4, "little")
+
+    def write(self, data: bytes) -> None:
+        written = 0
+        while written < len(data):
+            written += os.write(self.fd, data[written:])
+        if self.fsync:
+            os.fsync(self.fd)
+
+    def append(self, symbol: str, timestamp_ns: int, buy_or_sell: str, trade_price: float, quantity: int) -> None:
+        record = self.pack(symbol, timestamp_ns, buy_or_sell, trade_price, quantity)
+        with self.lock:
+            self.write(record)
+            self.record_count += 1
+
+    def append_many(self, rows: Iterable[tuple]) -> None:
+        """
+        appends (symbol, timestamp_ns, type, price, quantity) rows with a single write
+        """
+        data = b"".join(self.pack(*row) for row in rows)
+        with self.lock:
+            self.write(data)
+            self.record_count += len(data) // JOURNAL_RECORD.size
+
+    def reset(self) -> None:
+        """
+        drops every record, keeps the header
+        """
+        with self.lock:
+            os.ftruncate(self.fd, JOURNAL_HEADER.size)
+            os.lseek(self.fd, 0, os.SEEK_END)
+            self.record_count = 0
+
+    def records(self) -> Iterator[tuple]:
+        """
+        (symbol, timestamp_ns, price, quantity, side) per record, read straight from the memory map
+        """
+        if not self.record_count:
+            return
+        with mmap.mmap(self.fd, JOURNAL_HEADER.size + self.record_count * JOURNAL_RECORD.size, access=mmap.ACCESS_READ) as journal_map:
+            records = memoryview(journal_map)[JOURNAL_HEADER.size:]
+            try:
+                for symbol, timestamp_ns, price, quantity, side, _ in JOURNAL_RECORD.iter_unpack(records):
+                    yield symbol.rstrip(b"\0").decode(), timestamp_ns, price, quantity, side
+            finally:
+                records.release()
+
+    def replay(self, trade_store) -> int:
+        """
+        loads every record into an empty TradeStore column by column, returns the number of trades loaded
+        """
+        if not self.record_count:
+            return 0
+        if np is None:
+            for symbol, timestamp_ns, price, quantity, side in self.records():
+                symbol_trades = trade_store.symbol_trades(symbol)
+                symbol_trades.quantities.append(quantity)
+                symbol_trades.timestamps.append(timestamp_ns)
+                symbol_trades.prices.append(price)
+                symbol_trades.sides.append(side)
+            for symbol_trades in trade_store.symbols.values():
+                symbol_trades.refresh_order()
+            return self.record_count
+        record_dtype = np.dtype({"names": ["symbol", "timestamp", "price", "quantity", "side"],
+                                 "formats": ["S16", "<i8", "<f8", "<i8", "i1"],
+                                 "offsets": [0, 16, 24, 32, 40], "itemsize": JOURNAL_RECORD.size})
+        with mmap.mmap(self.fd, JOURNAL_HEADER.size + self.record_count * JOURNAL_RECORD.size, access=mmap.ACCESS_READ) as journal_map:
+            records = np.frombuffer(journal_map, dtype=record_dtype, count=self.record_count, offset=JOURNAL_HEADER.size)
+            try:
+                symbols, symbol_ids = np.unique(records["symbol"], return_inverse=True)
+                order = np.argsort(symbol_ids, kind="stable")  # keeps journal order within each symbol
+                bounds = np.searchsorted(symbol_ids[order], np.arange(len(symbols) + 1))
+                for symbol_id, symbol in enumerate(symbols.tolist()):
+                    rows = order[bounds[symbol_id]:bounds[symbol_id + 1]]
+                    symbol_trades = trade_store.symbol_trades(symbol.decode())
+                    for column, field, typecode in ((symbol_trades.timestamps, "timestamp", "q"), (symbol_trades.prices, "price", "d"),
+                                                    (symbol_trades.quantities, "quantity", "q"), (symbol_trades.sides, "side", "b")):
+                        column.frombytes(np.ascontiguousarray(records[field][rows]).tobytes())
+                    timestamps = np.frombuffer(symbol_trades.timestamps, dtype=np.int64)
+                    symbol_trades.ordered = bool(np.all(timestamps[1:] >= timestamps[:-1]))
+                    del timestamps  # the column can only grow again once no buffer export is left
+            finally:
+                del records
+        return self.record_count
@@ -1,20 +1,35 @@
-from services import GBCEIndex, StockService, TradeService, FileDatabase
+import argparse
+import json
+import logging
+import sys
+from commands import execute_batch
+from services import GBCEIndex, StockService, StatsService, TradeService, FileDatabase, stock_config_snapshot_file
 
-def input_operations():
+def load_stock_config() -> list:
+    """
+    populates the stock config from the config file (or its cached snapshot) once, returns the configured symbols
+    """
+    StockService.load_stock_config(snapshot_file=stock_config_snapshot_file)
+    return list(StockService.config_stocks_list)
+
+def run_batch(script, output) -> int:
+    """
+    runs every request line of script (NDJSON requests or commands, see commands.execute_batch) and writes
+    one JSON response per line to output, returns the number of failed requests
+    """
+    failures = 0
+    for reply in execute_batch(script):
+        failures += reply["status"] != "Success"
+        output.write(json.dumps(reply) + "\n")
+    return failures
+
+def input_operations(config_stocks_list: list):
     """Input/Output Interaction
     Interacts with user for input and provides appropriate output.
     1. Enter a stock symbol
     2. Select the operation to be performed
     3. View/Check the output
     """
-    # Populate DB
-    stock_details_list = FileDatabase.load_stock_metadata_from_file()
-    for stock in stock_details_list:
-        StockService().stock_config_operations(*stock)
-    config_stocks_list = [row[0] for row in stock_details_list]
-    for stock in stock_details_list:
-            StockService().stock_config_operations(*stock)
-    print("Stock config/metadata populated from file")
 
     operations = """Select a number for corresponding operation:
                     1 for Calculating DIVIDEND yield.
@@ -22,6 +37,7 @@ def input_operations():
                     3 for Recording Trade.
                     4 for Calculating Volume Weighted Stock Price.
                     5 for Calculating the GBCE All Share Index.
+                    6 for Showing service stats (latency, counters, store size).
                     0 to exit, if you are done with all the operations.
                     ===============================================
                     Enter number:"""
@@ -96,6 +112,16 @@ def input_operations():
                 if gbce:
                     print("GBCE All Share Index:", gbce)
 
+            elif operation_num == 6:
+                print("You have selected to show service stats!")
+                print(json.dumps(StatsService.stats(), indent=2))
+                stats_file = input("Enter a file name to save the stats to, or nothing to skip:").strip()
+                if stats_file:
+                    if StatsService.dump_stats(stats_file) == success:
+                        print(f"Stats written to {stats_file}")
+                    else:
+                        print(re_enter)
+
             else:
                 print("Please try again, your selection of numbers may not be one of those expected!!!")
         except ValueError as VE:
@@ -109,4 +135,35 @@ def input_operations():
             print(re_enter)
 
 if __name__ == '__main__':
-    input_operations()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Super Simple Stock Market: Global Beverage Corporation Exchange")
+    parser.add_argument("--journal", help="trade journal file: trades in it are replayed on startup and new trades are appended")
+    parser.add_argument("--stats-file", help="write the service stats to this file as JSON on exit")
+    parser.add_argument("--batch", help="run the requests in this file (- for stdin) instead of the menu: NDJSON requests "
+                                        "or commands such as 'record_trade TEA 100 BUY 9.5' and 'vwsp TEA', one per line")
+    parser.add_argument("--output", help="write the batch responses to this file instead of stdout")
+    parser.add_argument("--export", help="write the trades and per-stock totals to this directory as .npy columns on exit")
+    args = parser.parse_args()
+    # batch responses own stdout, so only warnings go to stderr there
+    logging.basicConfig(level=logging.WARNING if args.batch else logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    config_stocks_list = load_stock_config()
+    if args.journal:
+        replayed = FileDatabase.open_journal(args.journal)
+        print(f"{replayed} trades replayed from {args.journal}", file=sys.stderr if args.batch else sys.stdout)
+    failures = 0
+    if args.batch:
+        script = sys.stdin if args.batch == "-" else open(args.batch)
+        output = open(args.output, "w") if args.output else sys.stdout
+        try:
+            failures = run_batch(script, output)
+        finally:
+            for stream in (script, output):
+                if stream not in (sys.stdin, sys.stdout):
+                    stream.close()
+    else:
+        print("Stock config/metadata populated from file")
+        input_operations(config_stocks_list)
+    if args.stats_file:
+        StatsService.dump_stats(args.stats_file)
+    if args.export:
+        failures += FileDatabase.export_columns(args.export) != "Success"
+    sys.exit(1 if failures else 0)
\ No newline at end of file
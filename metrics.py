@@ -0,0 +1,166 @@
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+
+
+class LatencyHistogram:
+    """
+    log-linear histogram of durations in nanoseconds: 4 buckets per power of two, so quantiles are within 25%
+    each recording thread writes its own buckets without taking a lock, they are only merged when read
+    """
+    SUB_BUCKETS = 4
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread_buckets = []  # [(counts, [total_ns, max_ns])] per thread that recorded
+
+    def own_buckets(self) -> tuple:
+        buckets = self.local.buckets = ([0] * (64 * self.SUB_BUCKETS), [0, 0])
+        with self.lock:
+            self.thread_buckets.append(buckets)
+        return buckets
+
+    def reset(self) -> None:
+        with self.lock:
+            for counts, totals in self.thread_buckets:
+                counts[:] = [0] * len(counts)
+                totals[:] = [0, 0]
+
+    def merged(self) -> tuple:
+        """
+        (counts, count, total_ns, max_ns) over every thread
+        """
+        with self.lock:
+            thread_buckets = list(self.thread_buckets)
+        counts = [sum(bucket_counts) for bucket_counts in zip(*(counts for counts, _ in thread_buckets))] or [0]
+        return (counts, sum(counts), sum(totals[0] for _, totals in thread_buckets),
+                max((totals[1] for _, totals in thread_buckets), default=0))
+
+    @staticmethod
+    def bucket_upper_ns(bucket: int) -> int:
+        if bucket < 4:
+            return bucket + 1
+        exponent, sub_bucket = divmod(bucket, 4)
+        return (5 + sub_bucket) << (exponent - 2)
+
+    def record(self, duration_ns: int) -> None:
+        try:
+            counts, totals = self.local.buckets
+        except AttributeError:
+            counts, totals = self.own_buckets()
+        if duration_ns < 4:
+            counts[max(duration_ns, 0)] += 1
+        else:  # top three bits pick the power of two and the quarter within it
+            exponent = duration_ns.bit_length() - 1
+            counts[exponent * 4 + ((duration_ns >> (exponent - 2)) & 3)] += 1
+        totals[0] += duration_ns
+        if duration_ns > totals[1]:
+            totals[1] = duration_ns
+
+    def quantile_ns(self, quantile: float, merged: tuple = None) -> int:
+        """
+        upper bound of the bucket holding the given quantile, capped at the largest duration seen
+        """
+        counts, count, _, max_ns = merged or self.merged()
+        rank = quantile * count
+        seen = 0
+        for bucket, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if bucket_count and seen >= rank:
+                return min(self.bucket_upper_ns(bucket), max_ns)
+        return max_ns
+
+    def snapshot(self) -> dict:
+        merged = self.merged()
+        _, count, total_ns, max_ns = merged
+        return {"count": count, "mean_us": total_ns / count / 1000 if count else 0.0,
+                "p50_us": self.quantile_ns(0.5, merged) / 1000, "p90_us": self.quantile_ns(0.9, merged) / 1000,
+                "p99_us": self.quantile_ns(0.99, merged) / 1000, "max_us": max_ns / 1000}
+
+
+class Metrics:
+    """
+    named latency histograms and counters, cheap enough to leave on for every service call
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.local = threading.local()
+        self.thread_counters = []  # one {name: count} per thread that counted, merged when read
+
+    def histogram(self, name: str) -> LatencyHistogram:
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            return self.histograms[name]
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        try:
+            counters = self.local.counters
+        except AttributeError:
+            counters = self.local.counters = defaultdict(int)
+            with self.lock:
+                self.thread_counters.append(counters)
+        counters[name] += amount
+
+    def counters(self) -> dict:
+        with self.lock:
+            thread_counters = list(self.thread_counters)
+        counters = defaultdict(int)
+        for own_counters in thread_counters:
+            for name, count in list(own_counters.items()):
+                counters[name] += count
+        return dict(sorted(counters.items()))
+
+    def reset(self) -> None:
+        """
+        zeroes everything in place, functions wrapped by instrumented keep their histograms
+        """
+        with self.lock:
+            for own_counters in self.thread_counters:
+                own_counters.clear()
+            histograms = list(self.histograms.values())
+        for histogram in histograms:
+            histogram.reset()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            histograms = dict(self.histograms)
+        return {"latency": {name: histogram.snapshot() for name, histogram in sorted(histograms.items())},
+                "counters": self.counters()}
+
+
+def failed(result) -> bool:
+    """
+    the services report failures as "Failure", ("Failure", value) or None
+    """
+    return result is None or result == "Failure" or (result.__class__ is tuple and result[0] == "Failure")
+
+
+def instrumented(metrics: Metrics, name: str):
+    """
+    decorator: records the call's duration in the name histogram and counts failed calls as name.failures
+    """
+    def decorate(function):
+        histogram = metrics.histogram(name)
+        failures = f"{name}.failures"
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter_ns()
+            result = function(*args, **kwargs)
+            histogram.record(time.perf_counter_ns() - start)
+            if failed(result):
+                metrics.increment(failures)
+            return result
+        return timed
+    return decorate
+
+
+def dump(stats: dict, filename: str) -> None:
+    with open(filename, "w") as stats_file:
+        json.dump(stats, stats_file, indent=2)
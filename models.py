@@ -1,4 +1,21 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def datetime_to_ns(timestamp: datetime) -> int:
+    """
+    converts a (naive) trade timestamp to integer nanoseconds since EPOCH, exact to the microsecond
+    """
+    return (timestamp - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def ns_to_datetime(timestamp_ns: int) -> datetime:
+    return EPOCH + timedelta(microseconds=timestamp_ns // 1000)
+
+
+SIDE_CODES = {"BUY": 1, "SELL": -1}  # trade type as stored in the 1-byte side column, anything else is 0
+SIDE_NAMES = {1: "BUY", -1: "SELL", 0: None}
 
 class StockModel:
     def __init__(self):
@@ -39,6 +56,33 @@ class StockModel:
         return self.par_value
 
 
+class StockView:
+    """
+    read-only stand-in for a StockModel, backed by one row of the array-backed symbol registry
+    """
+    __slots__ = ('registry', 'stock_symbol', 'row')
+
+    def __init__(self, registry, stock_symbol: str, row: int):
+        self.registry = registry
+        self.stock_symbol = stock_symbol
+        self.row = row
+
+    def get_stock_symbol(self) -> str:
+        return self.stock_symbol
+
+    def get_stock_type(self) -> str:
+        return self.registry.stock_type(self.row)
+
+    def get_last_dividend(self) -> float:
+        return self.registry.last_dividends[self.row]
+
+    def get_fixed_dividend(self) -> float:
+        return self.registry.fixed_dividends[self.row]
+
+    def get_par_value(self) -> float:
+        return self.registry.par_values[self.row]
+
+
 class TradeModel:
     def __init__(self):
         self.type = None
@@ -73,9 +117,62 @@ class TradeModel:
     def get_timestamp(self) -> datetime:
         return self.timestamp
 
+class TradeView:
+    """
+    read-only stand-in for a TradeModel, backed by one row of a per-symbol columnar trade store
+    """
+    __slots__ = ('trades', 'row')
+
+    def __init__(self, trades, row: int):
+        self.trades = trades
+        self.row = row
+
+    def __str__(self):
+        return f"type:{self.type}, price:{self.trade_price}, quantity:{self.quantity_of_shares}, time:{self.timestamp}"
+
+    @property
+    def type(self) -> str:
+        return SIDE_NAMES[self.trades.sides[self.row]]
+
+    @property
+    def trade_price(self) -> float:
+        return self.trades.prices[self.row]
+
+    @property
+    def quantity_of_shares(self) -> int:
+        return self.trades.quantities[self.row]
+
+    @property
+    def timestamp(self) -> datetime:
+        return ns_to_datetime(self.trades.timestamps[self.row])
+
+    def get_trade_type(self) -> str:
+        return self.type
+
+    def get_trade_price(self) -> float:
+        return self.trade_price
+
+    def get_quantity_shares(self) -> int:
+        return self.quantity_of_shares
+
+    def get_timestamp(self) -> datetime:
+        return self.timestamp
+
+    def as_dict(self) -> dict:
+        return {"timestamp": self.timestamp, "type": self.type, "price": self.trade_price, "quantity": self.quantity_of_shares}
+
+
 class GBCEIndexModel:
     """
-    Not in use quite yet
+    definition of an index: a name, its constituent stock symbols and optional weights (1 for a constituent without one)
     """
-    def __init__(self):
-        self.index_constituents = set()
\ No newline at end of file
+    def __init__(self, name: str = "ALL_SHARE", index_constituents=(), weights: dict = None):
+        self.name = name
+        self.index_constituents = set(index_constituents)
+        self.weights = dict(weights or {})
+
+    def get_name(self) -> str:
+        return self.name
+
+    def get_weight(self, symbol: str) -> float:
+        return self.weights.get(symbol, 1.0)
\ No newline at end of file
@@ -0,0 +1,180 @@
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from operator import mul
+from store import exact_partials
+
+try:
+    import numpy as np
+except ImportError:  # workers fall back to memoryview casts over the shared block
+    np = None
+
+# column layout of the shared block: every timestamp, then every price, then every quantity, 8 bytes each
+COLUMNS = (("timestamps", "q"), ("prices", "d"), ("quantities", "q"))
+# pool processes are never forked from the (multithreaded) service process, a fork could inherit a lock another thread holds
+POOL_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    """
+    opens an existing block, the creator unlinks it
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13 always tracks, harmless here: pool processes share their parent's resource tracker
+        return shared_memory.SharedMemory(name=name)
+
+
+def partial_aggregate(task: tuple) -> tuple:
+    """
+    (symbol, shares, trades, notional partials) for rows first..last of the shared block, optionally only
+    trades with start_ns <= timestamp < end_ns; runs in a pool process
+    """
+    name, total_rows, symbol, first, last, start_ns, end_ns = task
+    block = attach(name)
+    try:
+        if np is not None:
+            timestamps, prices, quantities = (np.frombuffer(block.buf, dtype=np.dtype(typecode), count=last - first,
+                                                            offset=(column * total_rows + first) * 8)
+                                              for column, (_, typecode) in enumerate(COLUMNS))
+            if start_ns is not None or end_ns is not None:
+                inside = np.ones(last - first, dtype=bool)
+                if start_ns is not None:
+                    inside &= timestamps >= start_ns
+                if end_ns is not None:
+                    inside &= timestamps < end_ns
+                prices, quantities = prices[inside], quantities[inside]
+            result = (symbol, int(quantities.sum()), len(quantities), exact_partials((quantities * prices).tolist()))
+            del timestamps, prices, quantities  # the block can only be closed once no array looks into it
+            return result
+        views = [memoryview(block.buf)[column * total_rows * 8:(column + 1) * total_rows * 8].cast(typecode)
+                 for column, (_, typecode) in enumerate(COLUMNS)]
+        try:
+            timestamps, prices, quantities = (view[first:last] for view in views)
+            rows = range(last - first)
+            if start_ns is not None or end_ns is not None:
+                rows = [row for row in rows if (start_ns is None or timestamps[row] >= start_ns)
+                        and (end_ns is None or timestamps[row] < end_ns)]
+                prices, quantities = [prices[row] for row in rows], [quantities[row] for row in rows]
+            result = (symbol, sum(quantities), len(rows), exact_partials(map(mul, quantities, prices)))
+            del timestamps, prices, quantities
+            return result
+        finally:
+            for view in views:
+                view.release()
+    finally:
+        block.close()
+
+
+class SharedTradeColumns:
+    """
+    copy of trade store columns in one shared memory block, so pool processes read the trades without pickling them
+    use as a context manager, the block is unlinked on exit
+    """
+
+    def __init__(self, trade_store, symbols=None):
+        """
+        copies the trades of symbols (every stock when None), the caller keeps writers out while this runs
+        """
+        self.ranges = {}  # {symbol: (first row, last row)}
+        self.compacted = {}  # {symbol: (shares, notional partials, trades)} of trades compacted out of the columns
+        columns = []
+        total_rows = 0
+        for symbol in (trade_store.symbols if symbols is None else symbols):
+            symbol_trades = trade_store.symbols.get(symbol)
+            if symbol_trades is None:
+                continue
+            if symbol_trades.compacted_trades:
+                self.compacted[symbol] = (symbol_trades.compacted_quantity, list(symbol_trades.compacted_notional),
+                                          symbol_trades.compacted_trades)
+            if not len(symbol_trades):
+                continue
+            rows = len(symbol_trades)
+            self.ranges[symbol] = (total_rows, total_rows + rows)
+            columns.append((symbol_trades, rows))
+            total_rows += rows
+        self.total_rows = total_rows
+        self.block = None
+        if not total_rows:
+            return
+        self.block = shared_memory.SharedMemory(create=True, size=total_rows * 8 * len(COLUMNS))
+        for column, (field, _) in enumerate(COLUMNS):
+            offset = column * total_rows * 8
+            for symbol_trades, rows in columns:
+                data = memoryview(getattr(symbol_trades, field)).cast('B')[:rows * 8]
+                self.block.buf[offset:offset + rows * 8] = data
+                data.release()
+                offset += rows * 8
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+    def tasks(self, chunk_rows: int, start_ns: int = None, end_ns: int = None) -> list:
+        """
+        one task per symbol, symbols with more than chunk_rows trades are split into row ranges
+        """
+        return [(self.block.name, self.total_rows, symbol, first, min(first + chunk_rows, last), start_ns, end_ns)
+                for symbol, (symbol_first, last) in self.ranges.items()
+                for first in range(symbol_first, last, chunk_rows)]
+
+
+class PartitionedAnalytics:
+    """
+    full-history aggregates over a process pool: the trades are shared with the workers through shared memory,
+    each worker sums one (symbol, row range) partition and the partial sums are merged exactly
+    """
+
+    def __init__(self, max_workers: int = None, chunk_rows: int = 1000000):
+        self.max_workers = max_workers or os.cpu_count()
+        self.chunk_rows = chunk_rows
+
+    def totals(self, shared_columns: SharedTradeColumns, start_ns: int = None, end_ns: int = None) -> dict:
+        """
+        {symbol: (shares, notional, trades)} for the shared trades, optionally only start_ns <= timestamp < end_ns
+        notional is the correctly rounded sum of quantity * price, the same as one fsum over every trade
+        whole-history totals include compacted trades, a time range only sees the trades still held in the columns
+        """
+        merged = {}
+        if start_ns is None and end_ns is None:
+            merged = {symbol: (quantity, list(partials), trades) for symbol, (quantity, partials, trades) in shared_columns.compacted.items()}
+        if shared_columns.block is None:
+            return {symbol: (quantity, math.fsum(partials), trades) for symbol, (quantity, partials, trades) in merged.items()}
+        tasks = shared_columns.tasks(self.chunk_rows, start_ns, end_ns)
+        with ProcessPoolExecutor(max_workers=min(self.max_workers, len(tasks)),
+                                 mp_context=multiprocessing.get_context(POOL_START_METHOD)) as pool:
+            for symbol, quantity, trades, partials in pool.map(partial_aggregate, tasks,
+                                                               chunksize=max(1, len(tasks) // (self.max_workers * 4))):
+                symbol_quantity, symbol_partials, symbol_trades = merged.get(symbol, (0, [], 0))
+                symbol_partials.extend(partials)
+                merged[symbol] = (symbol_quantity + quantity, symbol_partials, symbol_trades + trades)
+        return {symbol: (quantity, math.fsum(partials), trades) for symbol, (quantity, partials, trades) in merged.items()}
+
+    @staticmethod
+    def vwsps(totals: dict) -> dict:
+        """
+        {symbol: vwsp} for symbols with shares traded
+        """
+        return {symbol: notional / quantity for symbol, (quantity, notional, _) in totals.items() if quantity}
+
+    @staticmethod
+    def all_share_index(vwsps: dict) -> float | None:
+        """
+        geometric mean of {symbol: vwsp}, by the same rules as IndexEngine: None while nothing is priced, 0.0 if any price is 0
+        """
+        vwsps = vwsps.values()
+        if not vwsps:
+            return None
+        if any(vwsp <= 0 for vwsp in vwsps):
+            return 0.0
+        return math.exp(math.fsum(map(math.log, vwsps)) / len(vwsps))
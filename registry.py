@@ -0,0 +1,168 @@
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from collections.abc import Mapping
+from typing import Iterable, Iterator
+from models import StockView
+
+SNAPSHOT_MAGIC = b"GBCESR02"
+# magic, byte order, stocks, stock types, length of the symbol/type text, source file size and mtime, crc32 of the body
+SNAPSHOT_HEADER = struct.Struct("<8s1s3xIIQQqI")
+COLUMNS = (("type_ids", "h"), ("last_dividends", "d"), ("fixed_dividends", "d"), ("par_values", "d"))
+MAX_STOCK_TYPES = 2 ** 15  # type ids are int16
+
+
+class SymbolRegistry(Mapping):
+    """
+    stock config of the whole universe as typed columns, one row per stock: the row of a symbol is its interned id,
+    stock types are stored as small codes into stock_types
+    a {symbol: StockModel} mapping for the services, lookups return a StockView over the stock's row;
+    updates rewrite a stock's row in place, a reader racing an update of the same stock may mix old and new values
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()  # writers only
+        self.ids = {}  # {symbol: row}
+        self.symbols = []  # symbol per row
+        self.stock_types = []  # distinct stock type names, a type id is the position in this list
+        self.type_codes = {}  # {stock type name: type id}
+        self.type_ids = array('h')
+        self.last_dividends = array('d')
+        self.fixed_dividends = array('d')
+        self.par_values = array('d')
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.symbols))
+
+    def __contains__(self, symbol) -> bool:
+        return symbol in self.ids
+
+    def __getitem__(self, symbol: str) -> StockView:
+        return StockView(self, symbol, self.ids[symbol])
+
+    def row_of(self, symbol: str) -> int | None:
+        return self.ids.get(symbol)
+
+    def missing(self, symbols: Iterable[str]) -> set:
+        """
+        those of symbols that are not configured, costs O(len(symbols)) however many stocks are configured
+        """
+        ids = self.ids
+        return {symbol for symbol in symbols if symbol not in ids}
+
+    def stock_type(self, row: int) -> str:
+        return self.stock_types[self.type_ids[row]]
+
+    def type_code(self, stock_type: str) -> int:
+        """
+        type id of stock_type, registered on first use; raises ValueError past MAX_STOCK_TYPES, before registering it
+        """
+        type_code = self.type_codes.get(stock_type)
+        if type_code is None:
+            if len(self.stock_types) >= MAX_STOCK_TYPES:
+                raise ValueError(f"Stock type {stock_type!r} not added, there can be at most {MAX_STOCK_TYPES} stock types")
+            type_code = self.type_codes[stock_type] = len(self.stock_types)
+            self.stock_types.append(stock_type)
+        return type_code
+
+    def upsert(self, symbol: str, stock_type: str, last_dividend: float, fixed_dividend: float = 0, par_value: float = 0) -> int:
+        """
+        adds a stock or rewrites its row, returns its row
+        """
+        with self.lock:
+            return self.upsert_unlocked(symbol, stock_type, last_dividend, fixed_dividend, par_value)
+
+    def upsert_unlocked(self, symbol, stock_type, last_dividend, fixed_dividend, par_value) -> int:
+        # typed before touching any column so a bad value can not leave the columns different lengths,
+        # the stock type last: it is the only conversion that registers anything
+        last_dividend, fixed_dividend, par_value = float(last_dividend), float(fixed_dividend), float(par_value)
+        type_code = self.type_code(stock_type)
+        row = self.ids.get(symbol)
+        if row is None:
+            self.type_ids.append(type_code)
+            self.last_dividends.append(last_dividend)
+            self.fixed_dividends.append(fixed_dividend)
+            self.par_values.append(par_value)
+            self.symbols.append(symbol)
+            row = self.ids[symbol] = len(self.symbols) - 1
+            return row
+        self.type_ids[row] = type_code
+        self.last_dividends[row] = last_dividend
+        self.fixed_dividends[row] = fixed_dividend
+        self.par_values[row] = par_value
+        return row
+
+    def rows(self) -> Iterator[list]:
+        """
+        [symbol, type, last dividend, fixed dividend, par value] per stock, as update_many takes them
+        """
+        for row, symbol in enumerate(list(self.symbols)):
+            yield [symbol, self.stock_type(row), self.last_dividends[row], self.fixed_dividends[row], self.par_values[row]]
+
+    def update_many(self, stocks: Iterable[list]) -> int:
+        """
+        upserts [symbol, type, last dividend, fixed dividend, par value] rows, e.g. an intraday reference data file,
+        returns the number of rows applied
+        """
+        applied = 0
+        with self.lock:
+            for stock in stocks:
+                self.upsert_unlocked(*stock)
+                applied += 1
+        return applied
+
+    def save_snapshot(self, path: str, source_size: int = 0, source_mtime_ns: int = 0) -> None:
+        """
+        writes the registry to path in one binary file, stamped with the size and mtime of the file it was loaded from;
+        written next to path first and moved over it, so a reader never sees half a snapshot
+        """
+        with self.lock:
+            text = "\n".join(self.symbols).encode() + b"\0" + "\n".join(self.stock_types).encode()
+            body = b"".join([text] + [getattr(self, column).tobytes() for column, _ in COLUMNS])
+            header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, sys.byteorder[0].encode(), len(self.symbols), len(self.stock_types),
+                                          len(text), source_size, source_mtime_ns, zlib.crc32(body))
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as snapshot:
+            snapshot.write(header)
+            snapshot.write(body)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load_snapshot(cls, path: str, source_size: int = None, source_mtime_ns: int = None):
+        """
+        registry read back from a snapshot, None if it is missing, corrupt, from a machine of the other byte order
+        or was taken from a source file of a different size/mtime than the ones given
+        """
+        try:
+            with open(path, "rb") as snapshot:
+                data = snapshot.read()
+        except OSError:
+            return None
+        if len(data) < SNAPSHOT_HEADER.size:
+            return None
+        magic, byte_order, stocks, stock_types, text_length, size, mtime_ns, crc = SNAPSHOT_HEADER.unpack_from(data)
+        body = memoryview(data)[SNAPSHOT_HEADER.size:]
+        if magic != SNAPSHOT_MAGIC or byte_order != sys.byteorder[0].encode() or zlib.crc32(body) != crc \
+                or (source_size is not None and size != source_size) or (source_mtime_ns is not None and mtime_ns != source_mtime_ns):
+            return None
+        registry = cls()
+        symbols, _, types = bytes(body[:text_length]).partition(b"\0")
+        registry.symbols = symbols.decode().split("\n") if stocks else []
+        registry.stock_types = types.decode().split("\n") if stock_types else []
+        registry.type_codes = {stock_type: code for code, stock_type in enumerate(registry.stock_types)}
+        registry.ids = dict(zip(registry.symbols, range(stocks)))
+        offset = text_length
+        for column, typecode in COLUMNS:
+            values = array(typecode)
+            values.frombytes(body[offset:offset + stocks * values.itemsize])
+            offset += stocks * values.itemsize
+            setattr(registry, column, values)
+        if len(registry.ids) != stocks or offset != len(body):
+            return None
+        return registry
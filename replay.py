@@ -0,0 +1,141 @@
+import argparse
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, List
+from services import FileDatabase, GBCEIndex, StockService, TradeService, service_clock, stock_config_snapshot_file
+
+
+class ReplayEngine:
+    """
+    replays a trade tape through TradeService with service_clock pinned to the tape's time, as fast as the CPU allows
+    emits VWSP and All Share Index readings either after every trade or at fixed steps of tape time
+    the clock is shared by the services, so a replay is meant for a process that is not also taking live trades
+    """
+
+    def __init__(self, symbols: List[str] = None, interval_in_mins: float = 5, sample_every: timedelta = None):
+        """
+        symbols: stocks whose VWSP is reported in samples, every stock traded so far when None
+        sample_every: report at every multiple of this much tape time, trades in between are recorded in batches;
+        None reports after every single trade
+        """
+        self.symbols = symbols
+        self.interval_in_mins = interval_in_mins
+        self.sample_every = sample_every
+        self.traded = set()
+
+    @staticmethod
+    def reset() -> None:
+        """
+        empties the trade store so a backtest starts from nothing, refused while a journal is open (it would be wiped)
+        """
+        if FileDatabase.journal is not None:
+            raise ValueError("close the trade journal before replaying over an empty store, it would be truncated")
+        FileDatabase.write_activity_to_localmem({})
+
+    def vwsp(self, symbol: str, now: datetime) -> float | None:
+        """
+        VWSP of the replay interval at now, None when nothing traded inside it
+        """
+        window = StockService.vwsp_engine.get_window(symbol, self.interval_in_mins)
+        if window is None:
+            return None
+        try:
+            return window.volume_weighted_price(now)
+        except ZeroDivisionError:
+            return None
+
+    def sample(self, now: datetime) -> dict:
+        service_clock.set(now)
+        symbols = self.symbols if self.symbols is not None else sorted(self.traded)
+        return {"time": now, "vwsp": {symbol: self.vwsp(symbol, now) for symbol in symbols},
+                "index": GBCEIndex.index_engine.value()}
+
+    def run(self, trades: Iterable[tuple]) -> Iterator[dict]:
+        """
+        yields readings while recording (symbol, quantity, buy_or_sell, trade_price, timestamp) trades in tape order
+        per trade: {"time", "symbol", "price", "status", "vwsp", "index"}
+        sampled: {"time", "vwsp": {symbol: vwsp}, "index"} at each step, taken after every trade up to that time
+        the clock goes back to wall-clock time when the replay ends
+        """
+        try:
+            if self.sample_every is None:
+                yield from self.run_per_trade(trades)
+            else:
+                yield from self.run_sampled(trades)
+        finally:
+            service_clock.release()
+
+    def run_per_trade(self, trades: Iterable[tuple]) -> Iterator[dict]:
+        for symbol, quantity, buy_or_sell, trade_price, timestamp in trades:
+            service_clock.set(timestamp)
+            status = TradeService.record_trade(symbol, quantity, buy_or_sell, trade_price, timestamp)
+            if status == "Success":
+                self.traded.add(symbol)
+            yield {"time": timestamp, "symbol": symbol, "price": trade_price, "status": status,
+                   "vwsp": self.vwsp(symbol, timestamp), "index": GBCEIndex.index_engine.value()}
+
+    def record_batch(self, batch: List[tuple]) -> None:
+        if batch:
+            service_clock.set(batch[-1][4])
+            status, _ = TradeService.record_trades(batch)
+            if status == "Success":
+                self.traded.update(trade[0] for trade in batch)
+
+    def run_sampled(self, trades: Iterable[tuple]) -> Iterator[dict]:
+        next_sample = last_timestamp = None
+        batch = []  # trades since the last sample time, recorded with one record_trades call
+        for trade in trades:
+            timestamp = trade[4]
+            if next_sample is None:
+                next_sample = self.step_start(timestamp)
+            if next_sample < timestamp:
+                self.record_batch(batch)
+                batch = []
+                while next_sample < timestamp:
+                    yield self.sample(next_sample)
+                    next_sample += self.sample_every
+            batch.append(trade)
+            last_timestamp = timestamp
+        self.record_batch(batch)
+        while next_sample is not None and next_sample <= last_timestamp:
+            yield self.sample(next_sample)
+            next_sample += self.sample_every
+
+    def step_start(self, timestamp: datetime) -> datetime:
+        """
+        latest multiple of sample_every (counted from midnight) at/before timestamp
+        """
+        midnight = datetime.combine(timestamp.date(), datetime.min.time())
+        return midnight + (timestamp - midnight) // self.sample_every * self.sample_every
+
+    def run_file(self, filename: str, file_format: str = None) -> Iterator[dict]:
+        """
+        run() over a CSV/NDJSON trade file, see FileDatabase.stream_trades_from_file
+        """
+        return self.run(FileDatabase.stream_trades_from_file(filename, file_format))
+
+
+def reading_to_json(reading: dict) -> str:
+    return json.dumps({**reading, "time": reading["time"].isoformat()})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a trade file through the GBCE services under a simulated clock")
+    parser.add_argument("trade_file", help="CSV (symbol,quantity,type,price,timestamp) or NDJSON trade tape in time order")
+    parser.add_argument("--sample-secs", type=float, help="report every this many seconds of tape time instead of after every trade")
+    parser.add_argument("--symbols", help="comma separated stocks to report the VWSP of, default every traded stock")
+    parser.add_argument("--interval", type=float, default=5, help="VWSP window in minutes")
+    parser.add_argument("--output", help="write the readings as NDJSON to this file instead of stdout")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    StockService.load_stock_config(snapshot_file=stock_config_snapshot_file)
+    engine = ReplayEngine(args.symbols.upper().split(",") if args.symbols else None, args.interval,
+                          timedelta(seconds=args.sample_secs) if args.sample_secs else None)
+    output = open(args.output, "w") if args.output else None
+    try:
+        for reading in engine.run_file(args.trade_file):
+            print(reading_to_json(reading), file=output)
+    finally:
+        if output is not None:
+            output.close()
@@ -1,112 +1,341 @@
-import os, csv, pickle, sqlite3
+import os, csv, json, math, operator, threading, time
 from datetime import datetime, timedelta
-from models import StockModel, TradeModel, GBCEIndexModel
+from models import TradeModel, GBCEIndexModel, TradeView, datetime_to_ns
+from analytics import VWSPEngine, IndexEngine, IndexRegistry, StockParameterTable
+from bars import BarEngine
+from cache import QueryCache, MISS
+from clock import Clock
+from partitioned import PartitionedAnalytics, SharedTradeColumns
+from registry import SymbolRegistry
+from store import TradeStore, SymbolTrades
+from subscriptions import SubscriptionHub, Subscription
+from journal import TradeJournal
+from export import ColumnarExport, snapshot_trade_store, write_export
+from sharding import TradeShards
+from metrics import Metrics, instrumented, dump
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from typing import List
+from typing import Iterable, Iterator, List
+from itertools import islice
 
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-# logging.basicConfig(filename='log_filename.txt', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# logging is configured by the entry points (main.py, gateway.py), importing the services leaves it alone
 stock_config_file = "gbce_sample_data.csv"
-
-db_conn = sqlite3.connect(':memory:')
-with db_conn:
-    cur = db_conn.cursor()
-    try:
-        cur.execute("DROP TABLE IF EXISTS data")  # cleaning up
-        cur.execute("CREATE TABLE data(i)")
-    except Exception as why:
-        logging.debug(why)
+stock_config_snapshot_file = stock_config_file + ".snapshot"  # binary copy of the parsed config, see load_stock_config
+trade_shards = TradeShards()  # every write for a symbol happens under its shard lock
+service_metrics = Metrics()  # latency histograms and counters for the service calls, see StatsService
+service_clock = Clock()  # "now" for VWSP windows and trades recorded without a timestamp, pinned during a replay
+subscription_hub = SubscriptionHub(service_clock)  # pushes VWSP and index values after trades, see TradeService.subscribe_vwsp
+query_cache = QueryCache()  # results of vwsp, all_share_index, dividend_yield and pe_ratio until their inputs change
 
 
 class FileDatabase:
     """
-    memory(in-mem sqlite) and necessary file operations: i/o 
+    memory(columnar in-mem trade store) and necessary file operations: i/o 
     """    
     trading_details = {}
+    trade_store = TradeStore()  # one append-only set of typed columns per stock symbol
+    journal = None  # TradeJournal once persistent mode is switched on with open_journal
+    reload_listeners = [query_cache.invalidate]  # called (with every shard lock held) after the whole trade store was replaced
 
     @staticmethod
-    def load_stock_metadata_from_file(filename: str = stock_config_file) -> List[str | float]:
+    def config_path(filename: str = stock_config_file) -> str:
         """
-        loads metadata such as symbol, type, last dividend from a predefined path
+        config files are looked up next to this module unless the path is absolute
+        """
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+
+    @classmethod
+    def stream_stock_metadata(cls, filename: str = stock_config_file) -> Iterator[list]:
+        """
+        [symbol, type, last dividend, fixed dividend, par value] per stock of a config file, read a line at a time
         """
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        config_file = os.path.join(script_dir, filename)
+        config_file = cls.config_path(filename)
         if not os.path.isfile(config_file):
             logging.warning("file not found, config will contain zero stocks")
-            return []
+            return
         if os.stat(config_file).st_size == 0:
             logging.warning("file empty, config will contain zero stocks")
-            return []        
-        stock_details_list = list(csv.reader(open(config_file)))
-        if stock_details_list[0][-1] == 'par_value':  # The first row contains headers
-            stock_details_list = stock_details_list[1:]
-        stock_details_list = [[row[0],row[1],float(row[2]),float(row[3]),float(row[4])] for row in stock_details_list]
-        return stock_details_list
+            return
+        with open(config_file, newline="") as config:
+            rows = csv.reader(config)
+            for row in rows:
+                if rows.line_num == 1 and row and row[-1] == 'par_value':  # The first row contains headers
+                    continue
+                if row:
+                    yield [row[0], row[1], float(row[2]), float(row[3]), float(row[4])]
 
     @classmethod
-    def write_activity_to_localmem(cls, trade_details={}):
-        cls.trading_details = trade_details
+    def load_stock_metadata_from_file(cls, filename: str = stock_config_file) -> List[str | float]:
+        """
+        loads metadata such as symbol, type, last dividend from a predefined path
+        """
+        return list(cls.stream_stock_metadata(filename))
+
+    @staticmethod
+    def trade_to_row(symbol: str, trade_model_obj: TradeModel) -> tuple:
+        return (symbol, datetime_to_ns(trade_model_obj.get_timestamp()), trade_model_obj.get_trade_type(),
+                trade_model_obj.get_trade_price(), trade_model_obj.get_quantity_shares())
+
+    @classmethod
+    def append_trade(cls, symbol: str, trade_model_obj: TradeModel) -> bool:
+        """
+        appends a single trade to the trade store, cost does not depend on how many trades are already stored
+        """
+        try:
+            row = cls.trade_to_row(symbol, trade_model_obj)
+            if cls.journal is not None:
+                cls.journal.append(*row)  # on disk before it is visible in memory
+            cls.trade_store.append(*row)
+            return True
+        except Exception as why:
+            logging.error(why)
+            return False
+
+    @classmethod
+    def append_trades(cls, rows: List[tuple]) -> bool:
+        """
+        appends many (symbol, timestamp_ns, type, price, quantity) rows, all or none of them: the journal packs every row
+        before it writes, and a row the store can not take puts the store's columns back to their old lengths
+        """
         try:
-            with db_conn:
-                cur = db_conn.cursor()
-                cur.execute("DELETE FROM data",)  # not necessary but prevents db from balooning into a monster
-                cur.execute("INSERT INTO data VALUES(?)", (sqlite3.Binary(pickle.dumps(cls.trading_details)),))
-                logging.info('trade activity now written to temp memory !')
-                return True
+            if cls.journal is not None:
+                cls.journal.append_many(rows)
+            cls.trade_store.extend(rows)
+            return True
         except Exception as why:
             logging.error(why)
             return False
 
     @classmethod
-    def read_activity_from_localmem(cls):
+    def open_journal(cls, filename: str, fsync: bool = False, verify_all: bool = False) -> int:
+        """
+        switches on persistent mode: trades already in the journal file are loaded into an empty trade store,
+        every trade recorded from now on is appended to the journal before it is stored in memory
+        returns the number of trades replayed from the journal
+        """
+        with trade_shards.all_locks():
+            if cls.journal is not None:
+                cls.close_journal()
+            cls.journal = TradeJournal(filename, fsync=fsync, verify_all=verify_all)
+            cls.trade_store.clear()
+            replayed = cls.journal.replay(cls.trade_store)
+            # VWSP windows and the index are rebuilt from the replayed store
+            for listener in cls.reload_listeners:
+                listener()
+        logging.info(f"{replayed} trades replayed from journal {filename}")
+        return replayed
+
+    @classmethod
+    def close_journal(cls) -> None:
+        if cls.journal is not None:
+            cls.journal.close()
+            cls.journal = None
+
+    @staticmethod
+    def stream_trades_from_file(filename: str, file_format: str = None) -> Iterator[tuple]:
+        """
+        yields (symbol, quantity, buy_or_sell, trade_price, timestamp) from a CSV or NDJSON trade file
+        one line at a time, the file is never read into memory as a whole
+        CSV needs a header row with symbol,quantity,type,price,timestamp, NDJSON objects use the same keys
+        timestamp is ISO 8601 and optional (defaults to the time of import)
+        """
+        if file_format is None:
+            file_format = "ndjson" if os.path.splitext(filename)[1].lower() in (".ndjson", ".jsonl") else "csv"
+        with open(filename, newline='') as trade_file:
+            if file_format == "csv":
+                records = csv.DictReader(trade_file)
+            else:
+                records = (json.loads(line) for line in trade_file if line.strip())
+            for record in records:
+                timestamp = record.get("timestamp")
+                yield (record["symbol"].upper(), int(record["quantity"]), record["type"].upper(), float(record["price"]),
+                       datetime.fromisoformat(timestamp) if timestamp else service_clock.now())
+
+    @classmethod
+    def read_symbol_trades(cls, symbol: str, since: datetime = None) -> List[TradeView]:
+        """
+        trades for one stock symbol in timestamp order, optionally only those at/after `since`
+        only trades still held in memory, see RetentionService
+        """
+        since_ns = datetime_to_ns(since) if since is not None else -2**63
+        return cls.trade_store.trades_since(symbol, since_ns)
+
+    @classmethod
+    def read_symbol_rows(cls, symbol: str, since_ns: int, until_ns: int = None) -> tuple:
+        """
+        (SymbolTrades, rows in timestamp order) for the trades of one stock at/after since_ns and before until_ns
+        column access for the analytics engines, without building a view per trade
+        """
+        return cls.trade_store.rows_between(symbol, since_ns, until_ns)
+
+    @classmethod
+    def trade_totals(cls) -> dict:
+        """
+        {symbol: (total quantity, total quantity * price)} over the whole trade store
+        """
+        return cls.trade_store.totals()
+
+    @classmethod
+    def has_trades(cls, symbol: str) -> bool:
+        return symbol in cls.trade_store
+
+    @classmethod
+    def write_activity_to_localmem(cls, trade_details={}):
+        """
+        replaces the whole trade store with the given {symbol: {timestamp: TradeModel}} records
+        kept for callers that manage the dict themselves, TradeService appends via append_trade
+        """
         try:
-            with db_conn:
-                cur = db_conn.cursor()
-                cur.execute("select i from data")
-                db_content = [pickle.loads(row[0]) for row in cur]
-                cls.trading_details = db_content[-1]  # final record contains the latest data
-                return cls.trading_details
+            rows = [cls.trade_to_row(symbol, trade_model_obj)
+                    for symbol, symbol_trade_details in trade_details.items()
+                    for trade_model_obj in symbol_trade_details.values()]
+            with trade_shards.all_locks():
+                cls.trade_store.clear()
+                if cls.journal is not None:
+                    cls.journal.reset()
+                    cls.journal.append_many(rows)
+                cls.trade_store.extend(rows)
+                cls.trading_details = cls.trade_store.symbols
+                for listener in cls.reload_listeners:
+                    listener()
+            logging.debug('trade activity now written to temp memory !')
+            return True
         except Exception as why:
+            logging.error(why)
+            return False
+
+    @classmethod
+    def export_columns(cls, directory: str) -> str:
+        """
+        writes the trade store and per-stock totals/VWSPs as .npy columns plus manifest.json to directory,
+        for research tools to open with load_columns or numpy.load(mmap_mode="r"); trading only waits while the columns
+        are copied, the files are written after
+        """
+        try:
+            with trade_shards.all_locks():
+                snapshot, exported_at_ns = snapshot_trade_store(cls.trade_store), datetime_to_ns(service_clock.now())
+            manifest = write_export(snapshot, directory, exported_at_ns)
+            logging.info(f"{manifest['trades']} trades of {len(manifest['symbols'])} stocks exported to {directory}")
+            return "Success"
+        except OSError as why:
+            logging.warning(f"Trades not exported to {directory}: {why}")
+            return "Failure"
+
+    @staticmethod
+    def load_columns(directory: str, use_numpy: bool = True) -> ColumnarExport:
+        """
+        memory-mapped, read-only view of an export_columns directory, raises OSError/ValueError for a missing or bad one
+        """
+        return ColumnarExport(directory, use_numpy)
+
+    @classmethod
+    def read_activity_from_localmem(cls) -> dict[str, SymbolTrades]:
+        """
+        {symbol: trades} view of the trade store, each SymbolTrades still offers the old
+        {timestamp: TradeModel}-style .items()/.values() but keeps trades that share a timestamp
+        """
+        cls.trading_details = cls.trade_store.symbols
+        if not cls.trading_details:
             logging.warning("No record present in local memory: Please add trade records!")
-            return cls.trading_details
+        return cls.trading_details
 
 
 class StockService:
     """
     settings calculations and operations on stocks
     """
-    config_stocks_list = {}
+    config_stocks_list = SymbolRegistry()  # {symbol: StockView}, typed columns with a row per configured stock
+    config_version = 0  # bumped on every config change, the parameter table is rebuilt lazily
+    config_lock = threading.Lock()
+    vwsp_engine = VWSPEngine(FileDatabase, trade_shards, service_clock)
+    bar_engine = BarEngine(FileDatabase, trade_shards)  # 1m/5m/1h/1d OHLCV bars per stock
+    parameter_table = None
 
     @classmethod
     def stock_config_operations(cls, stock_symbol, stock_type, last_dividend, fixed_dividend=0, par_value=0):
-        stock_model_obj = StockModel()
-        gbce_index_model_obj = GBCEIndexModel()
-        stock_model_obj.set_stock_symbol(stock_symbol)
-        gbce_index_model_obj.index_constituents.add(stock_symbol)
-        stock_model_obj.set_stock_type(stock_type)
-        stock_model_obj.set_last_dividend(last_dividend)
-        stock_model_obj.set_fixed_dividend(fixed_dividend)
-        stock_model_obj.set_par_value(par_value)
-        cls.config_stocks_list[stock_symbol] = stock_model_obj
+        with cls.config_lock:
+            cls.config_stocks_list.upsert(stock_symbol, stock_type, last_dividend, fixed_dividend, par_value)
+            cls.config_version += 1
+        query_cache.bump_config(stock_symbol)
+        query_cache.bump(stock_symbol)
 
-    @staticmethod
-    def volume_weighted_stock_price(symbol: str, interval_in_mins = 5) -> tuple[str, float]:
+    @classmethod
+    def update_stock_config(cls, stocks: Iterable[list]) -> int:
+        """
+        adds or updates many [symbol, type, last dividend, fixed dividend, par value] stocks at once,
+        e.g. intraday reference data, returns the number applied
+        """
+        with cls.config_lock:
+            applied = cls.config_stocks_list.update_many(stocks)
+            cls.config_version += 1
+        query_cache.invalidate()
+        return applied
+
+    @classmethod
+    def load_stock_config(cls, filename: str = stock_config_file, snapshot_file: str = None) -> int:
+        """
+        configures every stock of a config file, returns the number of stocks in it
+        with snapshot_file the parsed registry is cached there as one binary file and read back instead of the file
+        while the file keeps its size and mtime, so large universes start without parsing CSV
+        """
+        config_file = FileDatabase.config_path(filename)
+        if snapshot_file is not None:
+            snapshot_file = FileDatabase.config_path(snapshot_file)
+        registry = None
+        if snapshot_file is not None and os.path.isfile(config_file):
+            config_stat = os.stat(config_file)
+            registry = SymbolRegistry.load_snapshot(snapshot_file, config_stat.st_size, config_stat.st_mtime_ns)
+        if registry is None:
+            registry = SymbolRegistry()
+            registry.update_many(FileDatabase.stream_stock_metadata(filename))
+            if snapshot_file is not None and os.path.isfile(config_file):
+                try:
+                    registry.save_snapshot(snapshot_file, config_stat.st_size, config_stat.st_mtime_ns)
+                except OSError as why:
+                    logging.warning(f"Config snapshot {snapshot_file} not written: {why}")
+        with cls.config_lock:
+            if not cls.config_stocks_list:
+                cls.config_stocks_list = registry
+            else:
+                cls.config_stocks_list.update_many(registry.rows())
+            cls.config_version += 1
+        query_cache.invalidate()
+        return len(registry)
+
+    @classmethod
+    def stock_parameter_table(cls) -> StockParameterTable:
+        if cls.parameter_table is None or cls.parameter_table.config_version != cls.config_version:
+            cls.parameter_table = StockParameterTable(cls.config_stocks_list)
+            cls.parameter_table.config_version = cls.config_version
+        return cls.parameter_table
+
+    @classmethod
+    @instrumented(service_metrics, "vwsp")
+    def volume_weighted_stock_price(cls, symbol: str, interval_in_mins = 5) -> tuple[str, float]:
+        now = service_clock.now()
+        now_ns = datetime_to_ns(now)
+        key, version = ("vwsp", symbol, interval_in_mins), query_cache.version(symbol)
+        vol_wt_price = query_cache.get(key, version, now_ns)
+        if vol_wt_price is not MISS:
+            return "Success", vol_wt_price
         try:
-            # reading file data to collect all the trade records until now
-            trading_details = FileDatabase().read_activity_from_localmem()
-            # filtering out the data, gives data for the stock symbol we need
-            symbol_trade_details = trading_details[symbol]
-
-            difference_datetime = datetime.now() - timedelta(minutes=interval_in_mins)
-            total_quantity_shares = 0
-            share_quantity_trade_sum = 0
-            # calculates volume weighted trade for given stock symbol and returns it
-            for time, trade_obj in symbol_trade_details.items():
-                if time >= difference_datetime:
-                    total_quantity_shares += trade_obj.get_quantity_shares()
-                    share_quantity_trade_sum += (trade_obj.get_quantity_shares() * trade_obj.get_trade_price())
-            vol_wt_price = share_quantity_trade_sum / total_quantity_shares
+            if interval_in_mins in cls.vwsp_engine.default_intervals_in_mins:
+                # rolling window kept up to date by record_trade, only trades inside the window are held
+                window = cls.vwsp_engine.get_window(symbol, interval_in_mins)
+                if window is None:
+                    raise KeyError(symbol)
+                # calculates volume weighted trade for given stock symbol and returns it
+                vol_wt_price, valid_until_ns = window.volume_weighted_price_until(now)
+            else:
+                # any other interval is added up from the pre-aggregated bars
+                start_ns = datetime_to_ns(now - timedelta(minutes=interval_in_mins))
+                window = cls.bar_engine.window_summary(symbol, start_ns, 2**63 - 1, now_ns - start_ns)
+                if window is None:
+                    raise KeyError(symbol)
+                summary, valid_until_ns = window
+                vol_wt_price = summary.vwap()
+            query_cache.put(key, version, vol_wt_price, now_ns, valid_until_ns)
             return "Success", vol_wt_price
         except KeyError as KE:
             # No trades yet for provided stock symbol
@@ -116,10 +345,129 @@ class StockService:
             # Either no trade is done in last 5 mins or calculation makes it 0.0.
             logging.warning(f"Either no trades located for {symbol} , or calculation results in 0.0 !!")
             vol_wt_price = 0
+            query_cache.put(key, version, vol_wt_price, now_ns)  # nothing can come into the window but a new trade
             return "Success", vol_wt_price
 
     @classmethod
+    @instrumented(service_metrics, "trade_summary")
+    def trade_summary(cls, symbol: str, start: datetime, end: datetime = None) -> tuple[str, dict]:
+        """
+        open/high/low/close, volume, notional, vwap, trade count and buy/sell volume of one stock's trades
+        with start <= timestamp < end (no upper bound when end is None), added up from the pre-aggregated bars
+        """
+        summary = cls.bar_engine.summary(symbol, datetime_to_ns(start), datetime_to_ns(end) if end is not None else 2**63 - 1)
+        if summary is None:
+            logging.warning(f"Trades for given stock symbol: {symbol} have never been recorded! Please add records ... ")
+            return "Failure", None
+        return "Success", summary.as_dict()
+
+    @staticmethod
+    def traded_symbol_trades(symbol: str) -> SymbolTrades | None:
+        symbol_trades = FileDatabase.trade_store.symbols.get(symbol)
+        if symbol_trades is None:
+            logging.warning(f"Trades for given stock symbol: {symbol} have never been recorded! Please add records ... ")
+        return symbol_trades
+
+    @classmethod
+    @instrumented(service_metrics, "trades_between")
+    def trades_between(cls, symbol: str, start: datetime, end: datetime = None) -> tuple[str, List[dict]]:
+        """
+        trades of one stock with start <= timestamp < end (no upper bound when end is None) in timestamp order,
+        found through the sorted timestamp index in O(log n + k); only trades still held in memory
+        the shard lock is held while the rows are found and copied, the dicts are built after
+        """
+        with trade_shards.lock_for(symbol):
+            symbol_trades = cls.traded_symbol_trades(symbol)
+            if symbol_trades is None:
+                return "Failure", []
+            trades = symbol_trades.copy_rows(symbol_trades.rows_between(datetime_to_ns(start),
+                                                                        datetime_to_ns(end) if end is not None else None))
+        return "Success", [trade.as_dict() for trade in trades]
+
+    @classmethod
+    @instrumented(service_metrics, "side_summary")
+    def side_summary(cls, symbol: str, start: datetime, end: datetime = None) -> tuple[str, dict]:
+        """
+        {"BUY": {...}, "SELL": {...}} volume, notional, vwap (None without volume) and trade count per side
+        for one stock's trades with start <= timestamp < end, added up from a copy made under the shard lock
+        """
+        with trade_shards.lock_for(symbol):
+            symbol_trades = cls.traded_symbol_trades(symbol)
+            if symbol_trades is None:
+                return "Failure", None
+            trades = symbol_trades.copy_rows(symbol_trades.rows_between(datetime_to_ns(start),
+                                                                        datetime_to_ns(end) if end is not None else None))
+        side_totals = trades.side_totals(range(len(trades)))
+        return "Success", {side: {"volume": quantity, "notional": notional, "vwap": notional / quantity if quantity else None,
+                                  "trades": trades} for side, (quantity, notional, trades) in side_totals.items()}
+
+    @classmethod
+    @instrumented(service_metrics, "latest_trades")
+    def latest_trades(cls, symbol: str, count: int = 10) -> tuple[str, List[dict]]:
+        """
+        the last count trades of one stock in timestamp order
+        """
+        with trade_shards.lock_for(symbol):
+            symbol_trades = cls.traded_symbol_trades(symbol)
+            if symbol_trades is None:
+                return "Failure", []
+            trades = symbol_trades.copy_rows(symbol_trades.latest_rows(count))
+        return "Success", [trade.as_dict() for trade in trades]
+
+    @classmethod
+    @instrumented(service_metrics, "largest_trades")
+    def largest_trades(cls, symbol: str, count: int = 10, start: datetime = None, end: datetime = None) -> tuple[str, List[dict]]:
+        """
+        the count trades of one stock with the most shares, largest first, over the whole history held in memory
+        or only start <= timestamp < end
+        """
+        with trade_shards.lock_for(symbol):
+            symbol_trades = cls.traded_symbol_trades(symbol)
+            if symbol_trades is None:
+                return "Failure", []
+            trades = symbol_trades.copy_rows(symbol_trades.largest_rows(count, datetime_to_ns(start) if start is not None else None,
+                                                                        datetime_to_ns(end) if end is not None else None))
+        return "Success", [trade.as_dict() for trade in trades]
+
+    @classmethod
+    def ohlcv_bars(cls, symbol: str, resolution: str = "1m", start: datetime = None, end: datetime = None) -> tuple[str, List[dict]]:
+        """
+        bars of one resolution (1m, 5m, 1h or 1d) for one stock, buckets starting from start (whole history when None)
+        and before end (no upper bound when None)
+        """
+        if resolution not in cls.bar_engine.resolutions:
+            logging.warning(f"Bar resolution {resolution} is not one of {list(cls.bar_engine.resolutions)}")
+            return "Failure", []
+        bars = cls.bar_engine.bars(symbol, resolution, datetime_to_ns(start) if start is not None else -2**63,
+                                   datetime_to_ns(end) if end is not None else 2**63 - 1)
+        return "Success", [bar.as_dict() for bar in bars]
+
+    @classmethod
+    def volume_weighted_stock_prices_partitioned(cls, symbols: List[str] = None, start: datetime = None, end: datetime = None,
+                                                 max_workers: int = None) -> tuple[str, dict]:
+        """
+        {symbol: VWSP} over the whole history (or start <= timestamp < end) of every traded stock (or of symbols),
+        computed on a process pool for large histories; notional sums are exact, so results match a single pass
+        writers are held off only while the trades are copied into shared memory
+        """
+        try:
+            with trade_shards.all_locks():
+                shared_columns = SharedTradeColumns(FileDatabase.trade_store, symbols)
+            with shared_columns:
+                totals = PartitionedAnalytics(max_workers).totals(shared_columns, datetime_to_ns(start) if start else None,
+                                                                  datetime_to_ns(end) if end else None)
+            return "Success", PartitionedAnalytics.vwsps(totals)
+        except (OSError, RuntimeError) as why:
+            logging.error(f"Partitioned VWSP failed: {why!r}")
+            return "Failure", {}
+
+    @classmethod
+    @instrumented(service_metrics, "dividend_yield")
     def calculate_dividend_yield(cls, stock_symbol: str, price: float) -> tuple[str, int]:
+        key, version = ("dividend_yield", stock_symbol, price), query_cache.config_version(stock_symbol)
+        dividend_yield = query_cache.get(key, version)
+        if dividend_yield is not MISS:
+            return "Success", dividend_yield
         if price < 0:
             logging.warning("Re-enter price, price can not be less or equal to zero!")
             return "Failure", 0
@@ -139,6 +487,7 @@ class StockService:
                     fixed_dividend = stock_detail.get_fixed_dividend()
                     par_value = stock_detail.get_par_value()
                     dividend_yield = (fixed_dividend * par_value) / price
+                query_cache.put(key, version, dividend_yield)
                 return "Success", dividend_yield
             except ZeroDivisionError as ZDE:
                 logging.warning(ZDE)
@@ -148,8 +497,13 @@ class StockService:
             return "Failure", 0
     
     @classmethod
+    @instrumented(service_metrics, "pe_ratio")
     def calculate_pe_ratio(cls, stock_symbol: str, price: float):
         # calculate dividend for given price and stock
+        key, version = ("pe_ratio", stock_symbol, price), query_cache.config_version(stock_symbol)
+        pe_ratio = query_cache.get(key, version)
+        if pe_ratio is not MISS:
+            return "Success", pe_ratio
         try:
             stock_detail = cls.config_stocks_list[stock_symbol]
         except KeyError as KE:
@@ -162,8 +516,25 @@ class StockService:
         except ZeroDivisionError as ZDE:
             # dividend can be zero, resulting in pe_ratio of zero
             pe_ratio = 0
+        query_cache.put(key, version, pe_ratio)
         return "Success", pe_ratio
 
+    @classmethod
+    def calculate_dividend_yield_batch(cls, stock_symbols, prices) -> tuple:
+        """
+        dividend yields for arrays of symbols and prices (or one symbol against many prices, or vice versa)
+        returns (yields, valid), failures that calculate_dividend_yield would report are NaN with valid False
+        uses NumPy arrays when NumPy is installed, array.array columns otherwise
+        """
+        return cls.stock_parameter_table().dividend_yield(stock_symbols, prices)
+
+    @classmethod
+    def calculate_pe_ratio_batch(cls, stock_symbols, prices) -> tuple:
+        """
+        P/E ratios for arrays of symbols and prices, returns (ratios, valid) like calculate_dividend_yield_batch
+        """
+        return cls.stock_parameter_table().pe_ratio(stock_symbols, prices)
+
 
 class TradeService:
     """
@@ -171,59 +542,433 @@ class TradeService:
     """
 
     @staticmethod
-    def record_trade(symbol, quantity, buy_or_sell, trade_price, timestamp=datetime.now()) -> str:
+    @instrumented(service_metrics, "record_trade")
+    def record_trade(symbol, quantity, buy_or_sell, trade_price, timestamp: datetime = None) -> str:
         """
-        Writes trade activity to local memory
+        Writes trade activity to local memory, timestamped now (service_clock) unless a timestamp is given
         """
+        if timestamp is None:
+            timestamp = service_clock.now()
         if symbol not in StockService.config_stocks_list:
             logging.warning(f"Stock symbol {symbol} not present in index config file({stock_config_file}) provided!")
             return "Failure"
         try:
-            # read from file/db
-            file_obj = FileDatabase()
-            trading_details = file_obj.read_activity_from_localmem()
-
+            TradeService.trade_to_row((symbol, quantity, buy_or_sell, trade_price, timestamp), timestamp)  # checked before any write
             trade_model_obj = TradeModel()
             trade_model_obj.set_quantity_shares(quantity)
             trade_model_obj.set_trade_type(buy_or_sell)
             trade_model_obj.set_trade_price(trade_price)
             trade_model_obj.set_timestamp(timestamp)
-            if not trading_details or symbol not in trading_details:
-                trading_details[symbol] = {}
-            trading_details[symbol][timestamp] = trade_model_obj
 
-            # write to file/db
-            file_obj.write_activity_to_localmem(trading_details)
+            # append to file/db, trades in other shards are recorded in parallel
+            with trade_shards.lock_for(symbol):
+                if not FileDatabase.append_trade(symbol, trade_model_obj):
+                    return "Failure"
+                timestamp_ns = datetime_to_ns(timestamp)
+                StockService.vwsp_engine.on_trade(symbol, timestamp_ns, quantity, trade_price)
+                StockService.bar_engine.on_trade(symbol, timestamp_ns, buy_or_sell, quantity, trade_price)
+                GBCEIndex.index_engine.on_trade(symbol, quantity, trade_price)
+                query_cache.bump(symbol)
+            service_metrics.increment("trades.recorded")
+            subscription_hub.notify((symbol,))
+            RetentionService.record_activity(1)
             return "Success"
 
         except Exception as Except:
             logging.warning(Except)
             return "Failure"
 
+    @staticmethod
+    def subscribe_vwsp(symbol: str, callback=None, interval_in_mins=5, min_interval: float = 0.0) -> Subscription:
+        """
+        pushes the stock's VWSP after its trades, to callback(update) on the dispatcher thread or to
+        `async for update in subscription`; updates are {"topic": "vwsp", "name": symbol, "value", "time"}
+        a burst of trades is coalesced into one recomputation, unchanged values are not pushed
+        and a subscriber gets at most one update per min_interval seconds (the latest one)
+        """
+        def latest_vwsp():
+            status, vol_wt_price = StockService.volume_weighted_stock_price(symbol, interval_in_mins)
+            return vol_wt_price if status == "Success" else None
+        return subscription_hub.subscribe(("vwsp", symbol, interval_in_mins), latest_vwsp, symbol, callback, min_interval)
+
+    @staticmethod
+    def subscribe_index(name: str = "ALL_SHARE", callback=None, min_interval: float = 0.0) -> Subscription:
+        """
+        pushes the All Share Index (or a named custom index) after trades, like subscribe_vwsp
+        """
+        def latest_index():
+            if name == "ALL_SHARE":
+                return GBCEIndex.all_share_index()
+            status, index_value = GBCEIndex.index_value(name)
+            return index_value
+        return subscription_hub.subscribe(("index", name), latest_index, None, callback, min_interval)
+
+    @staticmethod
+    def unsubscribe(subscription: Subscription) -> None:
+        """
+        stops the updates, an async iterator over the subscription ends
+        """
+        subscription_hub.unsubscribe(subscription)
+
+    ingestion_pool = None  # thread pool behind record_trades_concurrently, created on first use
+    ingestion_pool_size = 0
+    ingestion_pool_lock = threading.Lock()  # a pool is not shut down while another call is handing it work
+
+    @staticmethod
+    def trade_to_row(trade: tuple, now: datetime) -> tuple:
+        """
+        (symbol, timestamp_ns, type, price, quantity) row for a (symbol, quantity, buy_or_sell, trade_price[, timestamp]) trade,
+        raises TypeError/ValueError/OverflowError for a trade the int64/float64 columns can not hold as given
+        """
+        symbol, quantity, buy_or_sell, trade_price = trade[:4]
+        timestamp = trade[4] if len(trade) > 4 else now
+        if not isinstance(timestamp, datetime):
+            raise TypeError(f"timestamp must be a datetime, not {timestamp!r}")
+        if timestamp.utcoffset() is not None:
+            raise ValueError(f"timestamp {timestamp.isoformat()} has a time zone, trade times are naive")
+        timestamp_ns, trade_price, quantity = datetime_to_ns(timestamp), float(trade_price), operator.index(quantity)
+        if not math.isfinite(trade_price):
+            raise ValueError(f"trade price must be finite, not {trade_price}")
+        if not -2**63 <= quantity < 2**63 or not -2**63 <= timestamp_ns < 2**63:
+            raise OverflowError(f"quantity {quantity} or timestamp {timestamp.isoformat()} out of the int64 range")
+        return symbol, timestamp_ns, buy_or_sell, trade_price, quantity
+
+    @classmethod
+    def trades_to_rows(cls, trades: Iterable[tuple]) -> tuple[List[tuple], List[int], dict]:
+        """
+        (rows, positions, rejected) for (symbol, quantity, buy_or_sell, trade_price[, timestamp]) trades: a
+        (symbol, timestamp_ns, type, price, quantity) row and its position in the batch for every trade to record,
+        and {position: why} for the malformed trades; trades in stocks missing from the config are dropped
+        """
+        now = service_clock.now()
+        rows, positions, rejected = [], [], {}
+        for position, trade in enumerate(trades):
+            # typed up front, one trade at a time, so a bad trade is left out before anything is stored
+            try:
+                rows.append(cls.trade_to_row(trade, now))
+                positions.append(position)
+            except (TypeError, ValueError, ArithmeticError) as why:
+                rejected[position] = repr(why)
+        if rejected:
+            logging.warning(f"{len(rejected)} malformed trades rejected, the first: {next(iter(rejected.values()))}")
+            service_metrics.increment("trades.rejected", len(rejected))
+
+        # symbols are checked against the config once per batch rather than once per trade
+        unknown_symbols = StockService.config_stocks_list.missing({row[0] for row in rows})
+        if unknown_symbols:
+            logging.warning(f"Stock symbols {sorted(unknown_symbols)} not present in index config file({stock_config_file}) provided, "
+                            f"their trades are skipped!")
+            kept = [number for number, row in enumerate(rows) if row[0] not in unknown_symbols]
+            service_metrics.increment("trades.skipped", len(rows) - len(kept))
+            rows, positions = [rows[number] for number in kept], [positions[number] for number in kept]
+        return rows, positions, rejected
+
+    @staticmethod
+    def record_shard_rows(shard: int, rows: List[tuple]) -> bool:
+        """
+        writes rows whose symbols all belong to one shard, under that shard's lock
+        """
+        try:
+            with trade_shards.locks[shard]:
+                if not FileDatabase.append_trades(rows):
+                    return False
+                StockService.vwsp_engine.on_trades(rows)
+                StockService.bar_engine.on_trades(rows)
+                GBCEIndex.index_engine.on_trades(rows)
+                query_cache.bump_many({row[0] for row in rows})
+            subscription_hub.notify(row[0] for row in rows)
+            return True
+
+        except Exception as Except:
+            logging.warning(Except)
+            return False
+
+    @classmethod
+    @instrumented(service_metrics, "record_trades")
+    def record_trades(cls, trades: Iterable[tuple]) -> tuple[str, int]:
+        """
+        Writes a batch of (symbol, quantity, buy_or_sell, trade_price[, timestamp]) trades in one go per shard
+        trades in stocks missing from the config are skipped, malformed trades are rejected (the batch then reports
+        Failure) while the other trades are still recorded; returns the number of trades recorded
+        """
+        rows, _, rejected = cls.trades_to_rows(trades)
+        recorded = 0
+        for shard, shard_rows in trade_shards.group_rows(rows).items():
+            if not cls.record_shard_rows(shard, shard_rows):
+                service_metrics.increment("trades.recorded", recorded)
+                return "Failure", recorded
+            recorded += len(shard_rows)
+        service_metrics.increment("trades.recorded", recorded)
+        RetentionService.record_activity(recorded)
+        return ("Failure" if rejected else "Success"), recorded
+
+    @classmethod
+    @instrumented(service_metrics, "record_trades_each")
+    def record_trades_each(cls, trades: Iterable[tuple]) -> tuple[str, List[str | None]]:
+        """
+        record_trades with a result per trade, for callers that answer every trade on its own (the gateway, batch mode):
+        None for a recorded trade, otherwise why it was not recorded; a shard that fails to write fails only its trades
+        Success once every trade is recorded
+        """
+        trades = list(trades)
+        rows, positions, rejected = cls.trades_to_rows(trades)
+        results = [f"unknown symbol {trade[0]}" for trade in trades]  # what is left over once the others are settled
+        for position, why in rejected.items():
+            results[position] = f"bad record_trade request: {why}"
+        recorded = 0
+        for shard, numbered in trade_shards.group_rows([(row[0], number) for number, row in enumerate(rows)]).items():
+            written = cls.record_shard_rows(shard, [rows[number] for _, number in numbered])
+            for _, number in numbered:
+                results[positions[number]] = None if written else "trade not stored, its shard failed to write"
+            recorded += len(numbered) if written else 0
+        service_metrics.increment("trades.recorded", recorded)
+        RetentionService.record_activity(recorded)
+        return ("Success" if recorded == len(trades) else "Failure"), results
+
+    @classmethod
+    @instrumented(service_metrics, "record_trades_concurrently")
+    def record_trades_concurrently(cls, trades: Iterable[tuple], max_workers: int = None) -> tuple[str, int]:
+        """
+        record_trades for multi-symbol feeds: the batch is split by shard and the shards are written on a thread pool,
+        trades of one symbol keep their order, malformed trades are rejected like in record_trades
+        a call with another max_workers replaces the pool, the old one finishes its work and lets its threads go
+        """
+        rows, _, rejected = cls.trades_to_rows(trades)
+        max_workers = max_workers or os.cpu_count()
+        rows_by_shard = trade_shards.group_rows(rows)
+        with cls.ingestion_pool_lock:
+            if cls.ingestion_pool is None or cls.ingestion_pool_size != max_workers:
+                if cls.ingestion_pool is not None:
+                    cls.ingestion_pool.shutdown(wait=False)
+                cls.ingestion_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+                cls.ingestion_pool_size = max_workers
+            results = cls.ingestion_pool.map(cls.record_shard_rows, rows_by_shard.keys(), rows_by_shard.values())
+        recorded = sum(len(shard_rows) for shard_rows, ok in zip(rows_by_shard.values(), results) if ok)
+        service_metrics.increment("trades.recorded", recorded)
+        RetentionService.record_activity(recorded)
+        return ("Success" if recorded == len(rows) and not rejected else "Failure"), recorded
+
+    @classmethod
+    def import_trades_from_file(cls, filename: str, file_format: str = None, batch_size: int = 100000) -> tuple[str, List[dict]]:
+        """
+        streams a CSV/NDJSON trade file through record_trades in batches of batch_size trades
+        returns per-batch stats: trades recorded, trades skipped, seconds taken and throughput
+        """
+        batch_stats = []
+        try:
+            trades = FileDatabase.stream_trades_from_file(filename, file_format)
+            while True:
+                start = time.perf_counter()
+                batch = list(islice(trades, batch_size))
+                if not batch:
+                    break
+                status, recorded = cls.record_trades(batch)
+                seconds = time.perf_counter() - start
+                batch_stats.append({"batch": len(batch_stats) + 1, "recorded": recorded, "skipped": len(batch) - recorded,
+                                    "seconds": seconds, "trades_per_sec": len(batch) / seconds if seconds else 0.0})
+                if status != "Success":  # the batch's good trades are in, its stats say how many
+                    return "Failure", batch_stats
+                logging.info(f"import batch {len(batch_stats)}: {recorded} trades recorded in {seconds:.3f}s "
+                             f"({batch_stats[-1]['trades_per_sec']:.0f} trades/s)")
+            return "Success", batch_stats
+        except (OSError, KeyError, ValueError) as why:
+            logging.error(f"Trade import from {filename} stopped: {why!r}")
+            return "Failure", batch_stats
+
 class GBCEIndex:
     """
     Calculations on the Global Beverage Corporation Exchange Index
     """
-    trading_details = {}
+    index_engine = IndexEngine(FileDatabase, trade_shards)
+    index_registry = IndexRegistry(index_engine)  # named sector sub-indices and client baskets
 
     @classmethod
+    @instrumented(service_metrics, "all_share_index")
     def all_share_index(cls) -> float:
         """
         calculates a geometric mean of the Volume Weighted Stock Price for all stocks in the GBCE
         note this V-W price is NOT for 5mins only, it's for the whole population!
         """
-        cls.trading_details = FileDatabase().read_activity_from_localmem()
-        if not cls.trading_details:
+        version = query_cache.version()
+        gbce_all_share_index = query_cache.get(("all_share_index",), version)
+        if gbce_all_share_index is not MISS:
+            return gbce_all_share_index
+        gbce_all_share_index = cls.index_engine.value()
+        if gbce_all_share_index is None:
             logging.warning("Empty records, no trade done!")
-            return None
-        total_stock_count = 0
-        total_price = 0
+            return gbce_all_share_index
+        query_cache.put(("all_share_index",), version, gbce_all_share_index)
+        return gbce_all_share_index
 
-        for stock in cls.trading_details:
-            for time, traded_share in cls.trading_details[stock].items():
-                total_stock_count += traded_share.get_quantity_shares()
-                total_price += (traded_share.get_quantity_shares() * traded_share.get_trade_price())
+    @classmethod
+    def define_index(cls, name: str, constituents: Iterable[str], weights: dict = None) -> str:
+        """
+        adds (or redefines) a named index over configured stocks, each weighted 1 unless weights gives a positive weight
+        it is kept up to date alongside the All Share Index, defining more indices does not slow down recording trades
+        """
+        gbce_index_model_obj = GBCEIndexModel(name, constituents, weights)
+        unknown_symbols = StockService.config_stocks_list.missing(gbce_index_model_obj.index_constituents)
+        if not gbce_index_model_obj.index_constituents or unknown_symbols:
+            logging.warning(f"Index {name} needs constituents from the index config file({stock_config_file}), "
+                            f"not {sorted(unknown_symbols) or 'none'}!")
+            return "Failure"
+        try:
+            if set(gbce_index_model_obj.weights).difference(gbce_index_model_obj.index_constituents) or \
+                    not all(float(weight) > 0 for weight in gbce_index_model_obj.weights.values()):
+                raise ValueError("weights have to be positive and for constituents only")
+        except (TypeError, ValueError) as why:
+            logging.warning(f"Index {name} not defined: {why}")
+            return "Failure"
+        cls.index_registry.define(gbce_index_model_obj)
+        return "Success"
 
-        gbce_all_share_index = pow(total_price, 1/total_stock_count) 
+    @classmethod
+    def remove_index(cls, name: str) -> str:
+        return "Success" if cls.index_registry.remove(name) else "Failure"
 
+    @classmethod
+    @instrumented(service_metrics, "index_value")
+    def index_value(cls, name: str) -> tuple[str, float]:
+        """
+        weighted geometric mean of the whole-population VWSPs of a named index's traded constituents
+        """
+        try:
+            index_value = cls.index_registry.value(name)
+        except KeyError:
+            logging.warning(f"Index {name} has not been defined!")
+            return "Failure", None
+        if index_value is None:
+            logging.warning(f"No constituent of index {name} has been traded yet!")
+            return "Failure", None
+        return "Success", index_value
+
+    @classmethod
+    def index_values(cls) -> dict:
+        """
+        {name: value} of every named index, None for an index none of whose constituents has been traded
+        """
+        return cls.index_registry.values()
+
+    @classmethod
+    def all_share_index_partitioned(cls, max_workers: int = None) -> float:
+        """
+        all_share_index recomputed from scratch over every trade on a process pool, e.g. for month-end checks
+        of the incrementally maintained value
+        """
+        status, vwsps = StockService.volume_weighted_stock_prices_partitioned(max_workers=max_workers)
+        if status != "Success":
+            return None
+        gbce_all_share_index = PartitionedAnalytics.all_share_index(vwsps)
+        if gbce_all_share_index is None:
+            logging.warning("Empty records, no trade done!")
         return gbce_all_share_index
+
+
+class RetentionService:
+    """
+    keeps memory flat through a trading day: raw trades older than the horizon are folded into per-stock sums
+    (whole-history VWSP and the All Share Index stay exact, the OHLCV bars keep every bucket) and dropped from memory,
+    after being appended to a spill file on disk unless the trade journal already holds them
+    """
+    horizon = None  # timedelta, retention is off while None
+    spill = None  # TradeJournal the dropped trades are appended to
+    compact_every_trades = 100000
+    trades_since_compaction = 0
+    lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, horizon: timedelta = None, spill_file: str = None, compact_every_trades: int = 100000) -> str:
+        """
+        horizon None switches retention off, it can not be shorter than the rolling VWSP window
+        """
+        longest_window = max(StockService.vwsp_engine.default_intervals_in_mins)
+        if horizon is not None and horizon < timedelta(minutes=longest_window):
+            logging.warning(f"Retention horizon {horizon} is shorter than the {longest_window} minute VWSP window!")
+            return "Failure"
+        with cls.lock:
+            if cls.spill is not None:
+                cls.spill.close()
+            cls.spill = TradeJournal(spill_file) if spill_file else None
+            cls.horizon, cls.compact_every_trades, cls.trades_since_compaction = horizon, compact_every_trades, 0
+        return "Success"
+
+    @classmethod
+    def record_activity(cls, trades: int) -> None:
+        """
+        called after trades were recorded, compacts once another compact_every_trades have come in
+        """
+        if cls.horizon is None:
+            return
+        with cls.lock:
+            cls.trades_since_compaction += trades
+            if cls.trades_since_compaction < cls.compact_every_trades:
+                return
+            cls.trades_since_compaction = 0
+        cls.compact()
+
+    @classmethod
+    def compact(cls, now: datetime = None, symbols: Iterable[str] = None) -> dict:
+        """
+        compacts the trades older than now (service_clock) minus the horizon, one stock and shard lock at a time,
+        of every stock or only of symbols
+        returns {"compacted": trades dropped by this run, "resident": trades still in memory}
+        """
+        compacted = 0
+        if cls.horizon is not None:
+            cutoff_ns = datetime_to_ns((now or service_clock.now()) - cls.horizon)
+            trade_store = FileDatabase.trade_store
+            for symbol in list(trade_store.symbols if symbols is None else symbols):
+                with trade_shards.lock_for(symbol):
+                    symbol_trades = trade_store.symbols.get(symbol)
+                    if symbol_trades is None:
+                        continue
+                    StockService.bar_engine.symbol_series(symbol)  # bars have to hold the trades before they leave memory
+                    with StockService.bar_engine.updating((symbol,)):  # rows move under lock-free bar readers
+                        dropped = symbol_trades.compact_before(cutoff_ns)
+                    if dropped:
+                        query_cache.bump(symbol)  # whole-history results are unchanged, bar-rounded VWSP edges may not be
+                    if dropped and cls.spill is not None and FileDatabase.journal is None:
+                        try:
+                            cls.spill.append_many((symbol, *row) for row in dropped)
+                        except (OSError, ValueError) as why:
+                            logging.error(f"Compacted trades of {symbol} not spilled to {cls.spill.path}: {why!r}")
+                compacted += len(dropped)
+            service_metrics.increment("trades.compacted", compacted)
+        return {"compacted": compacted, "resident": len(FileDatabase.trade_store)}
+
+
+class StatsService:
+    """
+    latency and counters of the service calls plus the size of the trade store
+    """
+
+    @staticmethod
+    def stats() -> dict:
+        """
+        {"latency": {operation: histogram summary in microseconds}, "counters": {...}, "store": {...}, "cache": {...}}
+        failed calls of an operation are counted as "<operation>.failures"
+        """
+        stats = service_metrics.snapshot()
+        trade_store = FileDatabase.trade_store
+        stats["store"] = {"symbols": len(trade_store.symbols), "trades": len(trade_store), "bytes": trade_store.nbytes(),
+                          "compacted_trades": trade_store.compacted_trades(),
+                          "journal_records": len(FileDatabase.journal) if FileDatabase.journal is not None else None}
+        stats["cache"] = query_cache.stats()
+        return stats
+
+    @classmethod
+    def dump_stats(cls, filename: str) -> str:
+        """
+        writes stats() to filename as JSON
+        """
+        try:
+            dump(cls.stats(), filename)
+            return "Success"
+        except OSError as why:
+            logging.warning(f"Stats not written to {filename}: {why}")
+            return "Failure"
+
+    @staticmethod
+    def reset_stats() -> None:
+        service_metrics.reset()
+        query_cache.reset_stats()
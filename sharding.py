@@ -0,0 +1,47 @@
+import threading
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class TradeShards:
+    """
+    splits the symbol space into shards with one lock each: all writes for a symbol happen under its shard lock,
+    so trades in symbols on different shards are recorded in parallel and never lose each other's updates
+    """
+
+    def __init__(self, shard_count: int = 64):
+        self.shard_count = shard_count
+        self.locks = [threading.Lock() for _ in range(shard_count)]
+        self.shards = {}  # {symbol: shard}, memoised, crc32 keeps the mapping stable across processes
+
+    def shard_of(self, symbol: str) -> int:
+        shard = self.shards.get(symbol)
+        if shard is None:
+            shard = self.shards[symbol] = zlib.crc32(symbol.encode()) % self.shard_count
+        return shard
+
+    def lock_for(self, symbol: str) -> threading.Lock:
+        return self.locks[self.shard_of(symbol)]
+
+    def group_rows(self, rows: list) -> dict:
+        """
+        {shard: rows} for (symbol, ...) rows, input order is kept within each shard
+        """
+        rows_by_shard = defaultdict(list)
+        for row in rows:
+            rows_by_shard[self.shard_of(row[0])].append(row)
+        return rows_by_shard
+
+    @contextmanager
+    def all_locks(self):
+        """
+        holds every shard lock, for operations that replace the whole trade store
+        """
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self.locks):
+                lock.release()
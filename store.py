@@ -0,0 +1,365 @@
+from array import array
+from bisect import bisect_left, insort
+from heapq import merge, nlargest
+from itertools import chain, islice
+from math import fsum
+from operator import index, le, mul
+from typing import Iterable, Iterator, List
+from models import TradeView, SIDE_CODES, SIDE_NAMES, ns_to_datetime
+
+
+def exact_partials(values) -> list:
+    """
+    floats whose exact sum is the exact sum of values: fsum, then fsum of what it rounded away, until nothing is left
+    fsum over the partials of several groups of values is the same correctly rounded total as one fsum over all of them
+    """
+    values = list(values)
+    partials = []
+    while True:
+        partial = fsum(chain(values, (-earlier for earlier in partials)))
+        if partial == 0.0:
+            return partials
+        partials.append(partial)
+
+
+class SortedRows:
+    """
+    rows of one stock's trades ordered by a column (timestamps or quantities), ties in arrival order:
+    a sorted array of row numbers plus a sorted tail of the rows appended since, rows are inserted into the tail
+    as lookups find them and the tail is merged into the array once it outgrows a sixteenth of it,
+    so a lookup costs O(log n + k) plus the insertion of rows appended since the last lookup
+    the (sorted rows, rows they cover, sorted tail, rows covered in all) state is replaced as a whole, readers need no lock
+    """
+    fold_after = 1024
+
+    def __init__(self, column: str):
+        self.column = column
+        self.state = (array('q'), 0, array('q'), 0)
+
+    def sorted_rows(self, symbol_trades) -> tuple:
+        """
+        (sorted rows, sorted tail) covering every row, after taking in the rows appended since the last lookup
+        """
+        rows, indexed, tail, covered = self.state
+        count = len(symbol_trades)
+        if covered == count:
+            return rows, tail
+        key = getattr(symbol_trades, self.column).__getitem__
+        if count - indexed > max(self.fold_after, len(rows) >> 4):
+            # merge is stable, so rows keep arrival order within a value: array, then tail, then the new rows
+            rows, tail = array('q', merge(rows, tail, sorted(range(covered, count), key=key), key=key)), array('q')
+            self.state = rows, count, tail, count
+            return rows, tail
+        tail = array('q', tail)  # copied, a reader may still be looking at the published tail
+        for row in range(covered, count):
+            insort(tail, row, key=key)  # after equal values, so ties stay in arrival order
+        self.state = rows, indexed, tail, count
+        return rows, tail
+
+    def between(self, symbol_trades, low, high) -> list:
+        """
+        rows with low <= value < high (no upper bound for None) in column order
+        """
+        rows, tail = self.sorted_rows(symbol_trades)
+        key = getattr(symbol_trades, self.column).__getitem__
+        found = []
+        for sorted_rows in (rows, tail):
+            first = bisect_left(sorted_rows, low, key=key)
+            found.append(sorted_rows[first:len(sorted_rows) if high is None else bisect_left(sorted_rows, high, first, key=key)])
+        if not found[1]:
+            return found[0].tolist()
+        return list(merge(*found, key=key))
+
+    def largest(self, symbol_trades, count: int) -> list:
+        """
+        the count rows with the largest values, largest first (the latest arrival first among equal values)
+        """
+        if count <= 0:
+            return []
+        rows, tail = self.sorted_rows(symbol_trades)
+        key = getattr(symbol_trades, self.column).__getitem__
+        return nlargest(count, chain(rows[-count:], tail[-count:]), key=lambda row: (key(row), row))
+
+
+class SymbolTrades:
+    """
+    columnar trades of one stock: int64 epoch-ns timestamps, float64 prices, int64 quantities and a 1-byte side
+    row i of every column is the i-th trade recorded, trades sharing a timestamp are all kept
+    ordered stays True while every trade arrived at/after the one before it, time range lookups then binary search
+    the columns directly, otherwise a sorted timestamp index is kept; a quantity index serves the largest trades
+    trades older than the retention horizon are folded into the compacted_* sums and dropped from the columns
+    """
+    __slots__ = ('symbol', 'timestamps', 'prices', 'quantities', 'sides', 'ordered', 'time_index', 'size_index',
+                 'compacted_trades', 'compacted_quantity', 'compacted_notional', 'compacted_until_ns')
+
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        self.timestamps = array('q')
+        self.prices = array('d')
+        self.quantities = array('q')
+        self.sides = array('b')
+        self.ordered = True
+        self.time_index = None  # SortedRows over timestamps, built on the first range query once trades came out of order
+        self.size_index = None  # SortedRows over quantities, built on the first largest-trades query
+        self.compacted_trades = 0
+        self.compacted_quantity = 0
+        self.compacted_notional = []  # exact partials of quantity * price over the compacted trades
+        self.compacted_until_ns = -2**63  # every compacted trade is older than this
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, row: int) -> TradeView:
+        if row < 0:
+            row += len(self.timestamps)
+        if not 0 <= row < len(self.timestamps):
+            raise IndexError(row)
+        return TradeView(self, row)
+
+    def __iter__(self) -> Iterator[TradeView]:
+        return (TradeView(self, row) for row in range(len(self.timestamps)))
+
+    def append(self, timestamp_ns: int, buy_or_sell: str, trade_price: float, quantity: int) -> None:
+        # convert before touching any column so a bad value can not leave the columns different lengths
+        quantity, trade_price, timestamp_ns = index(quantity), float(trade_price), index(timestamp_ns)
+        self.quantities.append(quantity)  # the only append that can still fail (int64 overflow), so it goes first
+        if self.ordered and self.timestamps and timestamp_ns < self.timestamps[-1]:
+            self.ordered = False
+        self.timestamps.append(timestamp_ns)
+        self.prices.append(trade_price)
+        self.sides.append(SIDE_CODES.get(buy_or_sell, 0))
+
+    def truncate(self, length: int, ordered: bool) -> None:
+        """
+        drops every row from length on and puts ordered back, undoing appends that failed part way
+        """
+        for column in (self.timestamps, self.prices, self.quantities, self.sides):
+            del column[length:]
+        self.ordered = ordered
+        self.time_index = self.size_index = None
+
+    def refresh_order(self) -> None:
+        """
+        recomputes ordered, for writers that fill the columns directly
+        """
+        timestamps = self.timestamps
+        self.ordered = all(map(le, timestamps, islice(timestamps, 1, None)))
+        self.time_index = self.size_index = None
+
+    def values(self) -> Iterator[TradeView]:
+        return iter(self)
+
+    def items(self) -> Iterator[tuple]:
+        """
+        (timestamp, trade) pairs, for callers written against the old {timestamp: TradeModel} dict
+        """
+        return ((ns_to_datetime(self.timestamps[row]), TradeView(self, row)) for row in range(len(self.timestamps)))
+
+    def rows_between(self, start_ns: int, end_ns: int = None) -> range | list:
+        """
+        rows with start_ns <= timestamp < end_ns (no upper bound for None) in timestamp order
+        """
+        timestamps = self.timestamps
+        if self.ordered:
+            first = bisect_left(timestamps, start_ns)
+            return range(first, len(timestamps) if end_ns is None else bisect_left(timestamps, end_ns, first))
+        if self.time_index is None:
+            self.time_index = SortedRows('timestamps')
+        return self.time_index.between(self, start_ns, end_ns)
+
+    def latest_rows(self, count: int) -> range | list:
+        """
+        rows of the last count trades in timestamp order
+        """
+        if self.ordered:
+            return range(max(len(self.timestamps) - count, 0), len(self.timestamps))
+        if self.time_index is None:
+            self.time_index = SortedRows('timestamps')
+        return self.time_index.largest(self, count)[::-1]
+
+    def largest_rows(self, count: int, start_ns: int = None, end_ns: int = None) -> list:
+        """
+        rows of the count trades with the most shares, largest first; over the whole history through the
+        quantity index in O(log n + count), within start_ns <= timestamp < end_ns by a pass over that range
+        """
+        if start_ns is not None or end_ns is not None:
+            quantities = self.quantities
+            return nlargest(count, self.rows_between(-2**63 if start_ns is None else start_ns, end_ns),
+                            key=lambda row: (quantities[row], row))
+        if self.size_index is None:
+            self.size_index = SortedRows('quantities')
+        return self.size_index.largest(self, count)
+
+    def copy_rows(self, rows) -> 'SymbolTrades':
+        """
+        detached SymbolTrades holding rows of this one in the order given, for readers that build their results
+        after letting go of the shard lock; a range of rows is sliced straight out of the columns
+        """
+        copy = SymbolTrades(self.symbol)
+        columns = (self.timestamps, self.prices, self.quantities, self.sides)
+        if isinstance(rows, range) and rows.step == 1:
+            copy.timestamps, copy.prices, copy.quantities, copy.sides = (column[rows.start:rows.stop] for column in columns)
+        else:
+            copy.timestamps, copy.prices, copy.quantities, copy.sides = (
+                array(column.typecode, map(column.__getitem__, rows)) for column in columns)
+        copy.refresh_order()
+        return copy
+
+    def side_totals(self, rows: Iterable[int]) -> dict:
+        """
+        {side: (shares, quantity * price, trades)} for the BUY and SELL trades among rows
+        """
+        totals = {side: [0, [], 0] for side in SIDE_NAMES.values() if side}
+        sides, prices, quantities = self.sides, self.prices, self.quantities
+        for row in rows:
+            side_totals = totals.get(SIDE_NAMES[sides[row]])
+            if side_totals is not None:
+                side_totals[0] += quantities[row]
+                side_totals[1].append(quantities[row] * prices[row])
+                side_totals[2] += 1
+        return {side: (quantity, fsum(notionals), trades) for side, (quantity, notionals, trades) in totals.items()}
+
+    def total_quantity(self) -> int:
+        return sum(self.quantities) + self.compacted_quantity
+
+    def total_notional(self) -> float:
+        return fsum(chain(map(mul, self.quantities, self.prices), self.compacted_notional))
+
+    def compact_before(self, cutoff_ns: int) -> List[tuple]:
+        """
+        folds the trades older than cutoff_ns into the compacted sums, so whole-history totals stay exact,
+        and drops them from the columns; returns the dropped (timestamp_ns, type, price, quantity) rows
+        """
+        timestamps, prices, quantities, sides = self.timestamps, self.prices, self.quantities, self.sides
+        if self.ordered:
+            evicted = range(bisect_left(timestamps, cutoff_ns))
+        else:
+            evicted = [row for row in range(len(timestamps)) if timestamps[row] < cutoff_ns]
+        self.compacted_until_ns = max(self.compacted_until_ns, cutoff_ns)
+        if not evicted:
+            return []
+        self.compacted_trades += len(evicted)
+        self.compacted_quantity += sum(quantities[row] for row in evicted)
+        self.compacted_notional = exact_partials(chain(self.compacted_notional, (quantities[row] * prices[row] for row in evicted)))
+        dropped = [(timestamps[row], SIDE_NAMES[sides[row]], prices[row], quantities[row]) for row in evicted]
+        self.time_index = self.size_index = None  # row numbers move
+        if self.ordered:
+            for column in (timestamps, prices, quantities, sides):
+                del column[:len(evicted)]
+        else:
+            evicted = set(evicted)
+            kept = [row for row in range(len(timestamps)) if row not in evicted]
+            self.timestamps, self.prices, self.quantities, self.sides = (
+                array(column.typecode, [column[row] for row in kept]) for column in (timestamps, prices, quantities, sides))
+            self.refresh_order()
+        return dropped
+
+    def nbytes(self) -> int:
+        return sum(column.itemsize * len(column) for column in (self.timestamps, self.prices, self.quantities, self.sides))
+
+
+class TradeStore:
+    """
+    in-memory columnar trade store, one SymbolTrades per stock, append-only
+    """
+
+    def __init__(self):
+        self.symbols = {}  # {symbol: SymbolTrades}
+
+    def __len__(self):
+        return sum(len(symbol_trades) for symbol_trades in self.symbols.values())
+
+    def __contains__(self, symbol: str) -> bool:
+        symbol_trades = self.symbols.get(symbol)
+        return symbol_trades is not None and (len(symbol_trades) > 0 or symbol_trades.compacted_trades > 0)
+
+    def clear(self) -> None:
+        self.symbols = {}
+
+    def symbol_trades(self, symbol: str) -> SymbolTrades:
+        symbol_trades = self.symbols.get(symbol)
+        if symbol_trades is None:
+            symbol_trades = self.symbols.setdefault(symbol, SymbolTrades(symbol))  # atomic next to other writers
+        return symbol_trades
+
+    def append(self, symbol: str, timestamp_ns: int, buy_or_sell: str, trade_price: float, quantity: int) -> None:
+        self.symbol_trades(symbol).append(timestamp_ns, buy_or_sell, trade_price, quantity)
+
+    def extend(self, rows: Iterable[tuple]) -> None:
+        """
+        appends (symbol, timestamp_ns, type, price, quantity) rows, all or none: when a row fails every stock
+        is truncated back to where it was before the batch and the error is raised
+        """
+        before = {}  # {symbol: (rows, ordered)} ahead of the batch
+        try:
+            for symbol, timestamp_ns, buy_or_sell, trade_price, quantity in rows:
+                symbol_trades = self.symbol_trades(symbol)
+                if symbol not in before:
+                    before[symbol] = len(symbol_trades), symbol_trades.ordered
+                symbol_trades.append(timestamp_ns, buy_or_sell, trade_price, quantity)
+        except BaseException:
+            for symbol, (length, ordered) in before.items():
+                self.symbols[symbol].truncate(length, ordered)
+            raise
+
+    def rows_between(self, symbol: str, start_ns: int, end_ns: int = None) -> tuple:
+        """
+        (SymbolTrades, rows) for the trades of one stock with start_ns <= timestamp < end_ns (no upper bound for None),
+        rows in timestamp order, found by binary search in O(log n + k)
+        """
+        symbol_trades = self.symbols.get(symbol)
+        if symbol_trades is None:
+            return None, []
+        return symbol_trades, symbol_trades.rows_between(start_ns, end_ns)
+
+    def rows_since(self, symbol: str, since_ns: int) -> tuple:
+        """
+        (SymbolTrades, rows) for the trades of one stock at/after since_ns, rows in timestamp order
+        """
+        return self.rows_between(symbol, since_ns)
+
+    def trades_since(self, symbol: str, since_ns: int) -> List[TradeView]:
+        """
+        trades of one stock at/after since_ns in timestamp order
+        """
+        symbol_trades, rows = self.rows_since(symbol, since_ns)
+        return [TradeView(symbol_trades, row) for row in rows]
+
+    def latest_trades(self, symbol: str, count: int) -> List[TradeView]:
+        """
+        the last count trades of one stock in timestamp order
+        """
+        symbol_trades = self.symbols.get(symbol)
+        if symbol_trades is None:
+            return []
+        return [TradeView(symbol_trades, row) for row in symbol_trades.latest_rows(count)]
+
+    def largest_trades(self, symbol: str, count: int, start_ns: int = None, end_ns: int = None) -> List[TradeView]:
+        """
+        the count trades of one stock with the most shares, largest first; over the whole history through the
+        quantity index in O(log n + count), within start_ns <= timestamp < end_ns by a pass over that range
+        """
+        symbol_trades = self.symbols.get(symbol)
+        if symbol_trades is None:
+            return []
+        return [TradeView(symbol_trades, row) for row in symbol_trades.largest_rows(count, start_ns, end_ns)]
+
+    def side_totals(self, symbol: str, start_ns: int, end_ns: int = None) -> dict:
+        """
+        {side: (shares, quantity * price, trades)} for the BUY and SELL trades of one stock with start_ns <= timestamp < end_ns
+        """
+        symbol_trades, rows = self.rows_between(symbol, start_ns, end_ns)
+        return (symbol_trades or SymbolTrades(symbol)).side_totals(rows)
+
+    def totals(self) -> dict:
+        """
+        {symbol: (total quantity, total quantity * price)}, compacted trades included
+        """
+        return {symbol: (symbol_trades.total_quantity(), symbol_trades.total_notional())
+                for symbol, symbol_trades in self.symbols.items() if len(symbol_trades) or symbol_trades.compacted_trades}
+
+    def compacted_trades(self) -> int:
+        return sum(symbol_trades.compacted_trades for symbol_trades in self.symbols.values())
+
+    def nbytes(self) -> int:
+        return sum(symbol_trades.nbytes() for symbol_trades in self.symbols.values())
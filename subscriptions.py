@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable
+
+
+class Subscription:
+    """
+    one consumer of a topic: a callback run on the dispatcher thread, or an async iterator (async for update in subscription)
+    updates are {"topic", "name", "value", "time"} dicts; only the latest value is kept, so a slow consumer
+    skips values rather than queueing them, and none is delivered within min_interval seconds of the last one
+    """
+
+    def __init__(self, hub, topic, callback: Callable = None, min_interval: float = 0.0):
+        self.hub = hub
+        self.topic = topic
+        self.callback = callback
+        self.min_interval = min_interval
+        self.last_delivered = None  # monotonic time of the last delivery
+        self.delivered_value = None
+        self.pending = None  # latest update held back by the throttle
+        self.latest = None
+        self.sequence = 0  # deliveries so far, async iterators skip wakeups without a new one
+        self.waiters = []  # [(loop, asyncio.Event)] of async iterators
+        self.closed = False
+
+    def due(self, now: float) -> float:
+        """
+        monotonic time from which the next update can be delivered
+        """
+        return now if self.last_delivered is None else self.last_delivered + self.min_interval
+
+    def offer(self, update: dict, now: float) -> None:
+        """
+        called on the dispatcher thread with a freshly computed update, delivered now or held until due
+        """
+        if update["value"] == self.delivered_value:
+            self.pending = None  # back where the subscriber already is
+            return
+        if now < self.due(now):
+            self.pending = update
+            return
+        self.deliver(update, now)
+
+    def deliver(self, update: dict, now: float) -> None:
+        self.pending = None
+        self.last_delivered = now
+        self.delivered_value = update["value"]
+        self.latest = update
+        self.sequence += 1
+        if self.callback is not None:
+            try:
+                self.callback(update)
+            except Exception as why:
+                logging.warning(f"Subscriber to {self.topic} failed on an update: {why!r}")
+        for loop, event in list(self.waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    def close(self) -> None:
+        self.hub.unsubscribe(self)
+
+    def __aiter__(self):
+        return self.updates()
+
+    async def updates(self):
+        loop, event = asyncio.get_running_loop(), asyncio.Event()
+        self.waiters.append((loop, event))
+        seen = 0
+        try:
+            while True:
+                if self.sequence == seen:
+                    if self.closed:
+                        return
+                    await event.wait()
+                    event.clear()
+                    continue
+                seen = self.sequence
+                yield self.latest
+        finally:
+            self.waiters.remove((loop, event))
+
+
+class Topic:
+    """
+    a value subscribers share, computed at most once per dispatch however many trades moved it
+    """
+
+    def __init__(self, key: tuple, compute: Callable, symbol: str = None):
+        self.key = key
+        self.compute = compute  # () -> value, None when there is nothing to deliver
+        self.symbol = symbol  # trades in this stock move the value, None for values every trade can move
+        self.subscribers = []
+
+
+class SubscriptionHub:
+    """
+    pushes VWSP and index values to subscribers after trades
+    recording a trade only marks the topics it can move; a dispatcher thread recomputes each marked topic once
+    (latest value wins) when one of its subscribers is due, and hands the value to every subscriber
+    """
+
+    def __init__(self, clock):
+        self.clock = clock  # stamps the updates
+        self.condition = threading.Condition()
+        self.topics = {}  # {key: Topic}
+        self.symbol_topics = {}  # {symbol: [Topic]}
+        self.market_topics = []  # topics moved by any trade
+        self.dirty = set()  # keys of topics marked since they were last computed
+        self.thread = None
+
+    def subscribe(self, key: tuple, compute: Callable, symbol: str = None, callback: Callable = None,
+                  min_interval: float = 0.0) -> Subscription:
+        """
+        subscribes to the topic key (created with compute and symbol on first use), the current value is pushed first
+        """
+        with self.condition:
+            topic = self.topics.get(key)
+            if topic is None:
+                topic = self.topics[key] = Topic(key, compute, symbol)
+                if symbol is None:
+                    self.market_topics.append(topic)
+                else:
+                    self.symbol_topics.setdefault(symbol, []).append(topic)
+            subscription = Subscription(self, key, callback, min_interval)
+            topic.subscribers.append(subscription)
+            self.dirty.add(key)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="subscriptions", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.condition:
+            topic = self.topics.get(subscription.topic)
+            if topic is not None and subscription in topic.subscribers:
+                topic.subscribers.remove(subscription)
+                if not topic.subscribers:
+                    del self.topics[topic.key]
+                    self.dirty.discard(topic.key)
+                    (self.market_topics if topic.symbol is None else self.symbol_topics[topic.symbol]).remove(topic)
+        subscription.closed = True
+        for loop, event in list(subscription.waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    def notify(self, symbols) -> None:
+        """
+        called after trades in symbols were recorded
+        """
+        if not self.topics:
+            return
+        with self.condition:
+            for symbol in symbols:
+                for topic in self.symbol_topics.get(symbol, ()):
+                    self.dirty.add(topic.key)
+            self.dirty.update(topic.key for topic in self.market_topics)
+            self.condition.notify()
+
+    def dispatch(self, now: float) -> float | None:
+        """
+        computes the marked topics that have a subscriber due and delivers held-back updates that came due,
+        returns the monotonic time of the next held-back delivery, None if nothing is waiting
+        """
+        with self.condition:
+            self.dirty.intersection_update(self.topics)
+            topics = [self.topics[key] for key in self.dirty]
+            subscribers = [subscription for topic in self.topics.values() for subscription in topic.subscribers
+                           if subscription.pending is not None]
+        next_due = None
+        for topic in topics:
+            subscriptions = list(topic.subscribers)
+            due = min((subscription.due(now) for subscription in subscriptions), default=now)
+            if due > now:  # nobody can take an update yet, the topic stays marked
+                next_due = due if next_due is None else min(next_due, due)
+                continue
+            with self.condition:
+                self.dirty.discard(topic.key)
+            try:
+                value = topic.compute()
+            except Exception as why:
+                logging.warning(f"Subscription topic {topic.key} not computed: {why!r}")
+                continue
+            if value is None:
+                continue
+            update = {"topic": topic.key[0], "name": topic.key[1], "value": value, "time": self.clock.now()}
+            for subscription in subscriptions:
+                subscription.offer(update, now)
+        for subscription in subscribers + [subscription for topic in topics for subscription in topic.subscribers]:
+            if subscription.pending is None:
+                continue
+            if subscription.due(now) <= now:
+                subscription.deliver(subscription.pending, now)
+            else:
+                next_due = subscription.due(now) if next_due is None else min(next_due, subscription.due(now))
+        return next_due
+
+    def run(self) -> None:
+        next_due = None
+        while True:
+            with self.condition:
+                while not self.dirty and next_due is None:
+                    self.condition.wait()
+                if next_due is not None and not self.dirty:
+                    self.condition.wait(max(next_due - time.monotonic(), 0))
+            next_due = self.dispatch(time.monotonic())
+            if next_due is not None and self.dirty:
+                # marked topics wait for a throttled subscriber, sleep until then rather than spin
+                with self.condition:
+                    self.condition.wait(max(next_due - time.monotonic(), 0))
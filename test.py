@@ -1,6 +1,38 @@
+import asyncio
+import io
+import json
+import math
+import os
 import random
+import tempfile
+import threading
+import time
 import unittest
-from services import StockService, TradeService, GBCEIndex, FileDatabase
+from datetime import datetime, timedelta, timezone
+from services import StockService, TradeService, GBCEIndex, FileDatabase, StatsService
+from journal import TradeJournal, JOURNAL_HEADER, JOURNAL_RECORD
+from store import TradeStore, SymbolTrades
+from models import datetime_to_ns, TradeView
+from gateway import TradeGateway
+from benchmark import SyntheticMarket, latency_summary
+from metrics import LatencyHistogram
+from commands import execute, execute_batch
+from main import run_batch
+from replay import ReplayEngine
+from services import service_clock, RetentionService, query_cache, trade_shards
+from cache import QueryCache, MISS
+from analytics import ChangeLog
+from registry import SymbolRegistry, MAX_STOCK_TYPES
+from partitioned import PartitionedAnalytics, SharedTradeColumns, exact_partials
+import export
+from export import write_column
+
+
+def setUpModule():
+    stock_details_list = FileDatabase.load_stock_metadata_from_file()
+    for stock in stock_details_list:
+        StockService().stock_config_operations(*stock)
+    print("\nStock config/metadata populated from file for testing!")
 
 
 class TestHardcodedCases(unittest.TestCase):
@@ -22,7 +54,8 @@ class TestHardcodedCases(unittest.TestCase):
         print('\n')
         status, vwsp = StockService.volume_weighted_stock_price("RUM")
         print(f"(5min)Volume-weighted Stock price for {"RUM"}: {vwsp}")
-        self.assertEqual(vwsp, 500, "error in StockService.volume_weighted_stock_price calc")
+        # both trades were stamped with service_clock.now() when recorded, so both are inside the 5 minute window
+        self.assertAlmostEqual(vwsp, (100 * 499 + 100000 * 500) / 100100, 9, "error in StockService.volume_weighted_stock_price calc")
     
     def test_dividend_yield_calc_manualinputs(self):
         print('\n')
@@ -108,6 +141,971 @@ class TestExpectedFailCases(unittest.TestCase):
         self.assertEqual(status, "Failure", "StockService.calculate_pe_ratio didn't fail for {self.bad_ticker}")
 
 
+class TestTradeLog(unittest.TestCase):
+    prices = [5, 827, 47, 29.6]
+
+    def setUpClass():
+        StockService().stock_config_operations('GIN', 'Preferred', 8, 0.02, 100)
+
+    def test_record_trade_appends_one_row(self):
+        before = len(FileDatabase.read_symbol_trades("GIN"))
+        for price in self.prices:
+            status = TradeService.record_trade("GIN", 10, "SELL", price)
+            self.assertEqual(status, "Success", "error in TradeService.record_trade")
+        symbol_trades = FileDatabase.read_symbol_trades("GIN")
+        self.assertEqual(len(symbol_trades), before + len(self.prices), "trades missing from the trade log")
+        self.assertEqual([trade.get_trade_price() for trade in symbol_trades[-len(self.prices):]], self.prices)
+
+    def test_same_timestamp_trades_kept_compactly(self):
+        timestamp = datetime(2024, 1, 2, 10, 0, 0, 123456)
+        symbol_trades = FileDatabase.trade_store.symbol_trades("GIN")
+        before, before_bytes = len(symbol_trades), symbol_trades.nbytes()
+        TradeService.record_trade("GIN", 3, "BUY", 1.5, timestamp)
+        TradeService.record_trade("GIN", 4, "SELL", 2.5, timestamp)
+        self.assertEqual(len(symbol_trades), before + 2, "same-timestamp trade lost")
+        self.assertEqual(symbol_trades.nbytes() - before_bytes, 2 * 25, "trade columns should cost 25 bytes a trade")
+        trade_obj = symbol_trades[-1]
+        self.assertEqual((trade_obj.get_trade_type(), trade_obj.get_trade_price(), trade_obj.get_quantity_shares(),
+                          trade_obj.get_timestamp()), ("SELL", 2.5, 4, timestamp))
+        self.assertEqual(str(trade_obj), f"type:SELL, price:2.5, quantity:4, time:{timestamp}")
+        self.assertFalse(hasattr(trade_obj, "__dict__"))
+
+
+class TestRollingVWSP(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('CIDER', 'Common', 4)
+        StockService().stock_config_operations('SIDRA', 'Common', 4)
+
+    def test_vwsp_concurrent_windows(self):
+        now = datetime.now()
+        TradeService.record_trade("CIDER", 10, "BUY", 100, now - timedelta(minutes=30))
+        TradeService.record_trade("CIDER", 30, "SELL", 200, now - timedelta(minutes=10))
+        TradeService.record_trade("CIDER", 10, "BUY", 300, now - timedelta(minutes=1))
+        status, vwsp_5 = StockService.volume_weighted_stock_price("CIDER")
+        self.assertEqual((status, vwsp_5), ("Success", 300))
+        status, vwsp_15 = StockService.volume_weighted_stock_price("CIDER", 15)
+        self.assertEqual(vwsp_15, (30 * 200 + 10 * 300) / 40)
+        status, vwsp_60 = StockService.volume_weighted_stock_price("CIDER", 60)
+        self.assertEqual(vwsp_60, (10 * 100 + 30 * 200 + 10 * 300) / 50)
+        # windows already registered keep up with new trades
+        TradeService.record_trade("CIDER", 40, "BUY", 400, now)
+        status, vwsp_15 = StockService.volume_weighted_stock_price("CIDER", 15)
+        self.assertEqual(vwsp_15, (30 * 200 + 10 * 300 + 40 * 400) / 80)
+
+    def test_future_dated_trade_keeps_window(self):
+        now = datetime.now()
+        TradeService.record_trade("SIDRA", 10, "BUY", 100, now - timedelta(minutes=1))
+        # a trade stamped ahead of the clock does not expire trades still inside the window at now
+        TradeService.record_trade("SIDRA", 10, "SELL", 200, now + timedelta(minutes=10))
+        self.assertEqual(StockService.volume_weighted_stock_price("SIDRA"), ("Success", 150))
+        self.assertEqual(StockService.volume_weighted_stock_price("SIDRA", 15), ("Success", 150))
+
+
+class TestGBCEIndex(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('PERRY', 'Common', 2)
+
+    def test_gbce_index_is_geometric_mean_of_vwsp(self):
+        for price in [20, 80]:
+            TradeService.record_trade("PERRY", 50, "BUY", price)
+        vwsps = [notional / quantity for quantity, notional in FileDatabase.trade_totals().values() if quantity]
+        expected = math.exp(sum(math.log(vwsp) for vwsp in vwsps) / len(vwsps))
+        self.assertAlmostEqual(GBCEIndex.all_share_index(), expected, 9, "error in GBCEIndex.all_share_index")
+        self.assertEqual(GBCEIndex.index_engine.constituent_price("PERRY"), 50)
+
+
+class TestBulkIngestion(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('STOUT', 'Common', 3)
+        StockService().stock_config_operations('PORTER', 'Common', 3)
+        StockService().stock_config_operations('MEZCAL', 'Common', 3)
+
+    def test_record_trades_batch(self):
+        now = datetime.now()
+        trades = [("STOUT", 10, "BUY", 20, now), ("STOUT", 30, "SELL", 40, now), ("IMPOSSIBLERANDOMSTOCK", 5, "BUY", 1, now)]
+        status, recorded = TradeService.record_trades(trades)
+        self.assertEqual((status, recorded), ("Success", 2), "error in TradeService.record_trades")
+        status, vwsp = StockService.volume_weighted_stock_price("STOUT")
+        self.assertEqual(vwsp, (10 * 20 + 30 * 40) / 40)
+
+    def test_malformed_trades_rejected_one_by_one(self):
+        now = datetime(2024, 3, 4, 10, 0)
+        trades = [("MEZCAL", 10, "BUY", 7.0, now), ("MEZCAL", 2 ** 63, "BUY", 7.0, now),
+                  ("MEZCAL", 20, "SELL", 8.0, now.replace(tzinfo=timezone.utc)), ("MEZCAL", 5, "BUY", math.nan, now),
+                  ("MEZCAL", 30, "SELL", 9.0, now)]
+        self.assertEqual(TradeService.record_trades(trades), ("Failure", 2))
+        self.assertEqual(len(FileDatabase.trade_store.symbols['MEZCAL']), 2)
+        self.assertEqual(FileDatabase.trade_totals()['MEZCAL'], (40, 10 * 7.0 + 30 * 9.0))
+        self.assertEqual(GBCEIndex.index_engine.constituent_price('MEZCAL'), (10 * 7.0 + 30 * 9.0) / 40)
+        self.assertEqual(TradeService.record_trade("MEZCAL", 2 ** 63, "BUY", 7.0, now), "Failure")
+        self.assertEqual(len(FileDatabase.trade_store.symbols['MEZCAL']), 2)
+
+        store = TradeStore()
+        store.extend([("A", 1, "BUY", 1.0, 1), ("B", 2, "SELL", 2.0, 2)])
+        self.assertRaises(OverflowError, store.extend, [("A", 0, "BUY", 1.0, 3), ("C", 3, "BUY", 1.0, 1), ("B", 4, "BUY", 1.0, 2 ** 63)])
+        self.assertEqual([(symbol, len(store.symbols[symbol]), store.symbols[symbol].ordered) for symbol in "ABC"],
+                         [("A", 1, True), ("B", 1, True), ("C", 0, True)])
+        self.assertEqual({len(column) for column in (store.symbols["B"].timestamps, store.symbols["B"].prices,
+                                                     store.symbols["B"].quantities, store.symbols["B"].sides)}, {1})
+
+    def test_import_trades_from_csv_and_ndjson(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_file = os.path.join(tmp_dir, "trades.csv")
+            with open(csv_file, "w") as trade_file:
+                trade_file.write("symbol,quantity,type,price,timestamp\n")
+                trade_file.writelines(f"porter,{quantity},buy,{quantity / 2},2024-01-02T10:00:00\n" for quantity in range(1, 251))
+            ndjson_file = os.path.join(tmp_dir, "trades.ndjson")
+            with open(ndjson_file, "w") as trade_file:
+                trade_file.write('{"symbol": "PORTER", "quantity": 7, "type": "SELL", "price": 3.5}\n')
+                trade_file.write('{"symbol": "IMPOSSIBLERANDOMSTOCK", "quantity": 7, "type": "SELL", "price": 3.5}\n')
+            before = len(FileDatabase.read_symbol_trades("PORTER"))
+            status, batch_stats = TradeService.import_trades_from_file(csv_file, batch_size=100)
+            self.assertEqual(status, "Success", "error in TradeService.import_trades_from_file")
+            self.assertEqual([batch["recorded"] for batch in batch_stats], [100, 100, 50])
+            status, batch_stats = TradeService.import_trades_from_file(ndjson_file)
+            self.assertEqual((batch_stats[0]["recorded"], batch_stats[0]["skipped"]), (1, 1))
+            self.assertEqual(len(FileDatabase.read_symbol_trades("PORTER")), before + 251)
+
+
+class TestBatchAnalytics(unittest.TestCase):
+    symbols = ["RUM", "GIN", "RUM", "GIN", "IMPOSSIBLERANDOMSTOCK"]
+    prices = [50, 20, 0, -4, 10]
+
+    def setUpClass():
+        StockService().stock_config_operations('RUM', 'Common', 5)
+        StockService().stock_config_operations('GIN', 'Preferred', 8, 0.02, 100)
+
+    def assert_matches_scalar(self, values, valid, scalar_calc):
+        for symbol, price, value, ok in zip(self.symbols, self.prices, values, valid):
+            status, expected = scalar_calc(symbol, price)
+            self.assertEqual(bool(ok), status == "Success", f"batch status differs for {symbol} @ {price}")
+            if ok:
+                self.assertAlmostEqual(float(value), expected, 12)
+            else:
+                self.assertTrue(math.isnan(value))
+
+    def test_dividend_yield_batch(self):
+        values, valid = StockService.calculate_dividend_yield_batch(self.symbols, self.prices)
+        self.assert_matches_scalar(values, valid, StockService.calculate_dividend_yield)
+
+    def test_pe_ratio_batch(self):
+        values, valid = StockService.calculate_pe_ratio_batch(self.symbols, self.prices)
+        self.assert_matches_scalar(values, valid, StockService.calculate_pe_ratio)
+        values, valid = StockService.calculate_pe_ratio_batch("RUM", [5, 10, 15])
+        self.assertEqual(list(values), [1, 2, 3])
+
+
+class TestTradeJournal(unittest.TestCase):
+
+    def test_journal_replay_and_tail_recovery(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            journal_file = os.path.join(tmp_dir, "trades.journal")
+            journal = TradeJournal(journal_file)
+            journal.append("RUM", 1_000, "BUY", 10.5, 7)
+            journal.append_many([("GIN", 2_000, "SELL", 3.25, 9), ("RUM", 3_000, "SELL", 11.0, 1)])
+            journal.close()
+            with open(journal_file, "ab") as journal_handle:
+                journal_handle.write(b"\x01" * (JOURNAL_RECORD.size // 2))  # torn write from a crash
+
+            journal = TradeJournal(journal_file)
+            self.assertEqual(len(journal), 3, "intact records lost in tail recovery")
+            self.assertEqual(os.path.getsize(journal_file), JOURNAL_HEADER.size + 3 * JOURNAL_RECORD.size)
+            trade_store = TradeStore()
+            self.assertEqual(journal.replay(trade_store), 3)
+            journal.close()
+            self.assertEqual(list(trade_store.symbols["RUM"].timestamps), [1_000, 3_000])
+            gin_trade = trade_store.symbols["GIN"][0]
+            self.assertEqual((gin_trade.type, gin_trade.trade_price, gin_trade.quantity_of_shares), ("SELL", 3.25, 9))
+
+    def test_journal_drops_corrupt_tail_record(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            journal_file = os.path.join(tmp_dir, "trades.journal")
+            journal = TradeJournal(journal_file)
+            journal.append_many([("RUM", 1_000, "BUY", 10.5, 7), ("RUM", 2_000, "BUY", 10.0, 3)])
+            journal.close()
+            with open(journal_file, "r+b") as journal_handle:
+                journal_handle.seek(-10, os.SEEK_END)
+                journal_handle.write(b"\xff")
+            journal = TradeJournal(journal_file)
+            self.assertEqual(len(journal), 1, "record failing its checksum should be dropped")
+            journal.close()
+
+    def test_restart_rebuilds_analytics_from_journal(self):
+        StockService().stock_config_operations('PALINKA', 'Common', 2)
+        StockService().stock_config_operations('TUICA', 'Preferred', 3, 0.02, 100)
+        now = datetime.now()
+        trades = [(('PALINKA', 'TUICA')[step % 2], 10 * (step + 1), ('BUY', 'SELL')[step % 3 == 0], 4.0 + step,
+                   now - timedelta(minutes=step, seconds=30)) for step in range(12)]
+        saved_symbols = FileDatabase.trade_store.symbols  # open_journal replaces the store, the other tests' trades come back after
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                journal_file = os.path.join(tmp_dir, "trades.journal")
+                self.assertEqual(FileDatabase.open_journal(journal_file), 0)
+                TradeService.record_trades(trades[1:])
+                TradeService.record_trade(*trades[0])
+
+                def analytics():
+                    return (StockService.volume_weighted_stock_price('PALINKA'), StockService.volume_weighted_stock_price('TUICA', 15),
+                            GBCEIndex.all_share_index(), StockService.trade_summary('PALINKA', now - timedelta(hours=1)),
+                            StockService.trade_summary('TUICA', now - timedelta(minutes=7), now))
+                before = analytics()
+                FileDatabase.close_journal()
+                self.assertEqual(FileDatabase.open_journal(journal_file), len(trades))  # restart
+                self.assertEqual(analytics(), before)
+                FileDatabase.close_journal()
+        finally:
+            with trade_shards.all_locks():
+                FileDatabase.trade_store.symbols = saved_symbols
+                for listener in FileDatabase.reload_listeners:
+                    listener()
+
+
+class TestConcurrentIngestion(unittest.TestCase):
+    symbols = ["KVASS", "MEAD", "SAKE", "BRAGOT", "SAHTI", "GRUIT"]  # traded by no other test, exact values elsewhere stay put
+
+    def setUpClass():
+        for symbol in TestConcurrentIngestion.symbols:
+            StockService().stock_config_operations(symbol, 'Common', 1)
+
+    def test_threads_do_not_lose_trades(self):
+        before = {symbol: len(FileDatabase.trade_store.symbol_trades(symbol)) for symbol in self.symbols}
+        now = datetime.now()
+
+        def writer(symbol):
+            for quantity in range(1, 201):
+                TradeService.record_trade(symbol, quantity, "BUY", 10, now)
+
+        def reader(stop):
+            while not stop.is_set():
+                StockService.volume_weighted_stock_price(random.choice(self.symbols))
+                GBCEIndex.all_share_index()
+
+        stop = threading.Event()
+        readers = [threading.Thread(target=reader, args=(stop,)) for _ in range(2)]
+        writers = [threading.Thread(target=writer, args=(symbol,)) for symbol in self.symbols for _ in range(2)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        stop.set()
+        for thread in readers:
+            thread.join()
+        for symbol in self.symbols:
+            self.assertEqual(len(FileDatabase.trade_store.symbol_trades(symbol)), before[symbol] + 400, f"{symbol} trades lost")
+
+        status, recorded = TradeService.record_trades_concurrently(
+            [(symbol, 5, "SELL", 20, now) for symbol in self.symbols for _ in range(50)], max_workers=4)
+        self.assertEqual((status, recorded), ("Success", 300), "error in TradeService.record_trades_concurrently")
+        pool = TradeService.ingestion_pool
+        self.assertEqual(TradeService.record_trades_concurrently([(self.symbols[0], 5, "SELL", 20, now)], max_workers=2), ("Success", 1))
+        self.assertIsNot(TradeService.ingestion_pool, pool)
+        self.assertRaises(RuntimeError, pool.submit, int)  # the replaced pool was shut down
+        index_value = GBCEIndex.all_share_index()
+        vwsps = [notional / quantity for quantity, notional in FileDatabase.trade_totals().values() if quantity]
+        self.assertAlmostEqual(index_value, math.exp(sum(map(math.log, vwsps)) / len(vwsps)), 9)
+
+
+class TestTradeGateway(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('SOJU', 'Common', 2)
+
+    def test_pipelined_requests(self):
+        requests = [{"id": quantity, "op": "record_trade", "symbol": "soju", "quantity": quantity, "type": "BUY", "price": 4}
+                    for quantity in range(1, 51)]
+        requests += [{"id": "vwsp", "op": "vwsp", "symbol": "SOJU"}, {"id": "pe", "op": "pe_ratio", "symbol": "SOJU", "price": 8},
+                     {"id": "bad", "op": "record_trade", "symbol": "SOJU", "quantity": "lots", "type": "BUY", "price": 4}]
+
+        async def exchange():
+            gateway = TradeGateway(port=0)
+            await gateway.start()
+            reader, writer = await asyncio.open_connection(gateway.host, gateway.port)
+            writer.write(b"".join(json.dumps(request).encode() + b"\n" for request in requests))
+            await writer.drain()
+            responses = [json.loads(await reader.readline()) for _ in requests]
+            writer.close()
+            await gateway.close()
+            return responses
+
+        responses = asyncio.run(exchange())
+        self.assertEqual([response["id"] for response in responses], [request["id"] for request in requests])
+        self.assertTrue(all(response["status"] == "Success" for response in responses[:-1]))
+        self.assertAlmostEqual(responses[-3]["result"], 4, 9, "trades pipelined ahead of the query should be visible to it")
+        self.assertAlmostEqual(responses[-2]["result"], 4, 9)
+        self.assertEqual(responses[-1]["status"], "Failure")
+
+    def test_bad_requests_fail_alone(self):
+        StockService().stock_config_operations('MOONSHINE', 'Common', 2)
+        trade = '{"op": "record_trade", "symbol": "MOONSHINE", "type": "BUY", "price": 3, '
+        lines = ['{"id": 1, "op": "latest_trades", "symbol": "MOONSHINE", "count": 1e400}',
+                 '{"id": 2, "op": "vwsp", "symbol": "MOONSHINE", "interval_in_mins": 1e400}',
+                 trade + '"id": 3, "quantity": 10, "timestamp": "2014-01-06T10:00:00"}',
+                 trade + '"id": 4, "quantity": 20, "timestamp": "2014-01-06T10:00:00+01:00"}',
+                 trade + '"id": 5, "quantity": 9223372036854775808, "timestamp": "2014-01-06T10:00:01"}',
+                 trade + '"id": 6, "quantity": 30, "timestamp": "2014-01-06T10:00:02"}',
+                 '{"id": 7, "op": "latest_trades", "symbol": "MOONSHINE", "count": 5}']
+
+        async def exchange():
+            gateway = TradeGateway(port=0)
+            await gateway.start()
+            reader, writer = await asyncio.open_connection(gateway.host, gateway.port)
+            writer.write("".join(line + "\n" for line in lines).encode())
+            await writer.drain()
+            responses = [json.loads(await reader.readline()) for _ in lines]
+            writer.close()
+            await gateway.close()
+            return responses
+
+        responses = asyncio.run(exchange())
+        self.assertEqual([(response["id"], response["status"]) for response in responses],
+                         [(1, "Failure"), (2, "Failure"), (3, "Success"), (4, "Failure"), (5, "Failure"), (6, "Success"),
+                          (7, "Success")])
+        self.assertEqual([trade["quantity"] for trade in responses[-1]["result"]], [10, 30])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_market_is_seeded(self):
+        trades = list(SyntheticMarket(seed=7, symbol_count=5, burstiness=0.5).trades(2000))
+        self.assertEqual(trades, list(SyntheticMarket(seed=7, symbol_count=5, burstiness=0.5).trades(2000)))
+        self.assertNotEqual(trades, list(SyntheticMarket(seed=8, symbol_count=5, burstiness=0.5).trades(2000)))
+        self.assertEqual([trade[4] for trade in trades], sorted(trade[4] for trade in trades))
+        self.assertTrue(all(trade[3] > 0 and trade[1] > 0 for trade in trades))
+        bursts = sum(later[4] - earlier[4] < timedelta(microseconds=20) for earlier, later in zip(trades, trades[1:]))
+        self.assertGreater(bursts, 800)
+        summary = latency_summary([0.001] * 99 + [0.1])
+        self.assertAlmostEqual(summary["p50_us"], 1000)
+        self.assertAlmostEqual(summary["p99_us"], 100000)
+
+
+class TestStats(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('TODDY', 'Common', 3)
+
+    def test_service_stats(self):
+        before = StatsService.stats()
+        self.assertEqual(TradeService.record_trade('TODDY', 10, 'BUY', 6.0, datetime.now()), "Success")
+        self.assertEqual(TradeService.record_trade('NOSUCH', 10, 'BUY', 6.0, datetime.now()), "Failure")
+        self.assertEqual(TradeService.record_trades([('TODDY', 5, 'SELL', 6.5), ('NOSUCH', 1, 'BUY', 1.0)]), ("Success", 1))
+        StockService.calculate_pe_ratio('TODDY', 6.0)
+        GBCEIndex.all_share_index()
+        stats = StatsService.stats()
+        counters = before["counters"]
+        self.assertEqual(stats["counters"]["trades.recorded"] - counters.get("trades.recorded", 0), 2)
+        self.assertEqual(stats["counters"]["trades.skipped"] - counters.get("trades.skipped", 0), 1)
+        self.assertEqual(stats["counters"]["record_trade.failures"] - counters.get("record_trade.failures", 0), 1)
+        self.assertEqual(stats["latency"]["record_trade"]["count"] - before["latency"]["record_trade"]["count"], 2)
+        self.assertGreater(stats["latency"]["pe_ratio"]["count"], 0)
+        self.assertEqual(stats["store"]["trades"] - before["store"]["trades"], 2)
+
+        histogram = LatencyHistogram()
+        for duration_ns in range(1, 100001):
+            histogram.record(duration_ns)
+        self.assertLessEqual(abs(histogram.quantile_ns(0.5) - 50000) / 50000, 0.25)
+        self.assertEqual(histogram.quantile_ns(1.0), 100000)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stats_file = os.path.join(tmp_dir, "stats.json")
+            self.assertEqual(StatsService.dump_stats(stats_file), "Success")
+            with open(stats_file) as dumped:
+                self.assertIn("record_trade", json.load(dumped)["latency"])
+
+
+class TestOHLCVBars(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('KEFIR', 'Common', 1)
+        StockService().stock_config_operations('AYRAN', 'Common', 1)
+
+    def test_window_summaries_match_raw_trades(self):
+        rand = random.Random(12)
+        start = datetime(2024, 3, 4, 23, 0, 0)
+        trades = [('KEFIR', rand.randint(1, 100), rand.choice(('BUY', 'SELL')), round(rand.uniform(1, 50), 2),
+                   start + timedelta(seconds=rand.randint(0, 3 * 3600), microseconds=rand.randint(0, 999999)))
+                  for _ in range(2000)]
+        TradeService.record_trades(sorted(trades[:1500], key=lambda trade: trade[4]))
+        for trade in trades[1500:]:  # late trades, out of timestamp order
+            TradeService.record_trade(*trade)
+        ordered = sorted(trades, key=lambda trade: trade[4])
+        for _ in range(200):
+            window_start = start + timedelta(seconds=rand.uniform(-60, 3 * 3600))
+            window_end = window_start + timedelta(seconds=rand.choice([30, 90, 600, 3700, 20000]) * rand.random())
+            inside = [trade for trade in ordered if window_start <= trade[4] < window_end]
+            status, summary = StockService.trade_summary('KEFIR', window_start, window_end)
+            self.assertEqual(status, "Success")
+            self.assertEqual(summary["trades"], len(inside))
+            self.assertEqual(summary["volume"], sum(trade[1] for trade in inside))
+            self.assertEqual(summary["buy_volume"], sum(trade[1] for trade in inside if trade[2] == 'BUY'))
+            self.assertAlmostEqual(summary["notional"], sum(trade[1] * trade[3] for trade in inside), 6)
+            if inside:
+                self.assertEqual((summary["open"], summary["close"]), (inside[0][3], inside[-1][3]))
+                self.assertEqual((summary["high"], summary["low"]), (max(trade[3] for trade in inside), min(trade[3] for trade in inside)))
+
+        status, hourly = StockService.ohlcv_bars('KEFIR', '1h')
+        self.assertEqual([bar["start"] for bar in hourly], [start + timedelta(hours=hour) for hour in range(4)][:len(hourly)])
+        self.assertEqual(sum(bar["trades"] for bar in hourly), 2000)
+        status, daily = StockService.ohlcv_bars('KEFIR', '1d')
+        self.assertEqual([bar["start"] for bar in daily], [datetime(2024, 3, 4), datetime(2024, 3, 5)])
+        self.assertEqual(StockService.ohlcv_bars('KEFIR', '7m'), ("Failure", []))
+        reply = execute({"op": "bars", "symbol": "kefir", "resolution": "1d", "start": "2024-03-05T00:00:00"})
+        self.assertEqual((reply["status"], len(reply["result"]), reply["result"][0]["start"]), ("Success", 1, "2024-03-05T00:00:00"))
+
+    def test_bar_reads_do_not_wait_for_writers(self):
+        start = datetime(2024, 5, 6, 10, 0, 0)
+        TradeService.record_trade('AYRAN', 10, 'BUY', 2.0, start)
+        whole_day = (start - timedelta(hours=1), start + timedelta(hours=1))
+        StockService.trade_summary('AYRAN', *whole_day)  # builds the bars
+        replies = []
+        with trade_shards.lock_for('AYRAN'):  # a writer in the middle of a trade
+            reader = threading.Thread(target=lambda: replies.extend((StockService.trade_summary('AYRAN', *whole_day),
+                                                                     StockService.ohlcv_bars('AYRAN', '1m'))))
+            reader.start()
+            reader.join(5)
+            self.assertFalse(reader.is_alive(), "bar reads should not take the shard lock")
+        self.assertEqual((replies[0][1]["trades"], len(replies[1][1])), (1, 1))
+
+        def writer():
+            for second in range(1, 3001):
+                TradeService.record_trade('AYRAN', second % 7 + 1, ('BUY', 'SELL')[second % 2], 2.0 + second % 13, start + timedelta(seconds=second % 900))
+        writing = threading.Thread(target=writer)
+        writing.start()
+        seen = 0
+        while writing.is_alive():
+            status, summary = StockService.trade_summary('AYRAN', start + timedelta(seconds=30), whole_day[1])
+            self.assertGreaterEqual(summary["trades"], seen)  # never a bar caught half way through an update
+            self.assertEqual(summary["volume"], summary["buy_volume"] + summary["sell_volume"])
+            if summary["volume"]:
+                self.assertTrue(summary["low"] - 1e-9 <= summary["vwap"] <= summary["high"] + 1e-9)
+            seen = summary["trades"]
+        writing.join()
+        self.assertEqual(StockService.trade_summary('AYRAN', *whole_day)[1]["trades"], 3001)
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('ARAK', 'Common', 2)
+        StockService().stock_config_operations('RAKI', 'Common', 2)
+
+    def test_default_timestamp_is_taken_per_trade(self):
+        service_clock.set(datetime(2016, 5, 1, 9, 0))
+        TradeService.record_trade('RAKI', 1, 'BUY', 1.0)
+        service_clock.set(datetime(2016, 5, 1, 9, 30))
+        TradeService.record_trade('RAKI', 1, 'BUY', 1.0)
+        service_clock.release()
+        self.assertEqual([trade.get_timestamp() for trade in FileDatabase.read_symbol_trades('RAKI')],
+                         [datetime(2016, 5, 1, 9, 0), datetime(2016, 5, 1, 9, 30)])
+
+    def test_replay_tape_under_simulated_clock(self):
+        rand = random.Random(5)
+        start = datetime(2015, 6, 1, 10, 0, 0)
+        tape = sorted((('ARAK', rand.randint(1, 50), 'BUY', round(rand.uniform(10, 20), 2), start + timedelta(seconds=rand.uniform(0, 1200)))
+                       for _ in range(300)), key=lambda trade: trade[4])
+
+        def expected_vwsp(now):
+            inside = [trade for trade in tape if now - timedelta(minutes=5) <= trade[4] <= now]
+            return sum(trade[1] * trade[3] for trade in inside) / sum(trade[1] for trade in inside) if inside else None
+
+        readings = list(ReplayEngine(['ARAK'], sample_every=timedelta(minutes=1)).run(tape[:150]))
+        self.assertEqual([reading["time"] for reading in readings], [start + timedelta(minutes=minute) for minute in range(len(readings))])
+        self.assertEqual(readings[-1]["time"], start + timedelta(minutes=int((tape[149][4] - start).total_seconds() // 60)))
+        for reading in readings:
+            vwsp, expected = reading["vwsp"]["ARAK"], expected_vwsp(reading["time"])
+            self.assertTrue(vwsp == expected if expected is None else abs(vwsp - expected) < 1e-9)
+            self.assertIsNotNone(reading["index"])
+
+        readings = list(ReplayEngine().run(tape[150:]))
+        self.assertEqual(len(readings), 150)
+        for reading in readings:
+            self.assertEqual(reading["status"], "Success")
+            self.assertAlmostEqual(reading["vwsp"], expected_vwsp(reading["time"]), 9)
+        self.assertFalse(service_clock.simulated)
+        self.assertEqual(len(FileDatabase.read_symbol_trades('ARAK')), 300)
+
+
+class TestPartitionedAnalytics(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('PULQUE', 'Common', 2)
+
+    def test_partitions_merge_exactly(self):
+        rand = random.Random(9)
+        values = [rand.uniform(-1, 1) * 10 ** rand.randint(-20, 20) for _ in range(5000)]
+        partials = [partial for chunk in range(0, 5000, 700) for partial in exact_partials(values[chunk:chunk + 700])]
+        self.assertEqual(math.fsum(partials), math.fsum(values))
+
+        start = datetime(2014, 2, 3, 9, 0)
+        TradeService.record_trades([('PULQUE', rand.randint(1, 10 ** 6), 'SELL', rand.uniform(0.01, 1000), start + timedelta(seconds=second))
+                                    for second in range(500)])
+        with SharedTradeColumns(FileDatabase.trade_store) as shared_columns:
+            totals = PartitionedAnalytics(max_workers=2, chunk_rows=37).totals(shared_columns)
+            window = PartitionedAnalytics(max_workers=2, chunk_rows=37).totals(
+                shared_columns, datetime_to_ns(start + timedelta(seconds=100)), datetime_to_ns(start + timedelta(seconds=200)))
+        for symbol, (quantity, notional) in FileDatabase.trade_totals().items():
+            self.assertEqual(totals[symbol][:2], (quantity, notional))
+        inside = FileDatabase.read_symbol_trades('PULQUE', start + timedelta(seconds=100))[:100]
+        self.assertEqual(window['PULQUE'], (sum(trade.get_quantity_shares() for trade in inside),
+                                            math.fsum(trade.get_quantity_shares() * trade.get_trade_price() for trade in inside), 100))
+        status, vwsps = StockService.volume_weighted_stock_prices_partitioned(['PULQUE'], max_workers=2)
+        quantity, notional = FileDatabase.trade_totals()['PULQUE']
+        self.assertEqual(vwsps, {'PULQUE': notional / quantity})
+        self.assertAlmostEqual(GBCEIndex.all_share_index_partitioned(max_workers=2), GBCEIndex.all_share_index(), 9)
+
+
+class TestRetention(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('CHICHA', 'Common', 2)
+        StockService().stock_config_operations('ARRACK', 'Common', 2)
+
+    def test_compaction_keeps_whole_history_exact(self):
+        rand = random.Random(3)
+        start = datetime(2012, 7, 2, 9, 0)
+        trades = [('CHICHA', rand.randint(1, 1000), rand.choice(('BUY', 'SELL')), rand.uniform(1, 100), start + timedelta(seconds=second * 7))
+                  for second in range(2000)]
+        TradeService.record_trades(trades)
+        now = trades[-1][4]
+        totals_before = FileDatabase.trade_totals()
+        index_before = GBCEIndex.all_share_index()
+        status, day_before = StockService.trade_summary('CHICHA', start, now + timedelta(seconds=1))
+        self.assertEqual(RetentionService.configure(timedelta(minutes=1)), "Failure")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spill_file = os.path.join(tmp_dir, "spill.journal")
+            self.assertEqual(RetentionService.configure(timedelta(minutes=30), spill_file), "Success")
+            bytes_before = FileDatabase.trade_store.symbols['CHICHA'].nbytes()
+            result = RetentionService.compact(now, ['CHICHA'])  # the other tests' trades stay as they are
+            RetentionService.configure(None)
+            spilled = list(TradeJournal(spill_file).records())
+        resident = FileDatabase.read_symbol_trades('CHICHA')
+        self.assertEqual(len(resident), len([trade for trade in trades if trade[4] >= now - timedelta(minutes=30)]))
+        self.assertEqual(result["compacted"], 2000 - len(resident))
+        self.assertEqual(len(spilled), 2000 - len(resident))
+        self.assertLess(FileDatabase.trade_store.symbols['CHICHA'].nbytes(), bytes_before / 5)
+        self.assertEqual(FileDatabase.trade_totals(), totals_before)
+        self.assertEqual(GBCEIndex.all_share_index(), index_before)
+        self.assertEqual(StockService.trade_summary('CHICHA', start, now + timedelta(seconds=1)), ("Success", day_before))
+        status, vwsps = StockService.volume_weighted_stock_prices_partitioned(['CHICHA'], max_workers=1)
+        self.assertEqual(vwsps['CHICHA'], totals_before['CHICHA'][1] / totals_before['CHICHA'][0])
+        TradeService.record_trade('CHICHA', 10, 'BUY', 50.0, now + timedelta(seconds=1))
+        quantity, notional = totals_before['CHICHA']
+        self.assertEqual(FileDatabase.trade_totals()['CHICHA'], (quantity + 10, math.fsum(
+            [trade[1] * trade[3] for trade in trades] + [500.0])))
+
+    def test_bar_vwsp_survives_compaction_mid_read(self):
+        start = datetime(2012, 7, 3, 9, 0)
+        trades = [('ARRACK', 10 + minute, 'BUY', 2.0 + minute, start + timedelta(minutes=minute)) for minute in range(10)]
+        TradeService.record_trades(trades)
+        now = start + timedelta(minutes=10)
+        inside = [trade for trade in trades if trade[4] >= now - timedelta(minutes=7)]
+        read_symbol_rows = FileDatabase.read_symbol_rows
+
+        def compacted_after_read(symbol, since_ns, until_ns=None):
+            found = read_symbol_rows(symbol, since_ns, until_ns)
+            if until_ns is None and FileDatabase.trade_store.symbols['ARRACK'].timestamps:  # the cache validity read
+                compaction = threading.Thread(target=RetentionService.compact, args=(now + timedelta(days=1), ['ARRACK']))
+                compaction.start()
+                compaction.join()
+            return found  # rows of trades that are gone now
+        service_clock.set(now)
+        RetentionService.configure(timedelta(minutes=30))
+        FileDatabase.read_symbol_rows = compacted_after_read
+        try:
+            status, vwsp = StockService.volume_weighted_stock_price('ARRACK', 7)
+        finally:
+            FileDatabase.read_symbol_rows = classmethod(read_symbol_rows.__func__)
+            RetentionService.configure(None)
+            service_clock.release()
+        self.assertEqual(len(FileDatabase.trade_store.symbols['ARRACK']), 0)
+        self.assertEqual(status, "Success")
+        self.assertAlmostEqual(vwsp, sum(trade[1] * trade[3] for trade in inside) / sum(trade[1] for trade in inside), 9)
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('HYDROMEL', 'Common', 2)
+
+    def test_lru_eviction(self):
+        cache = QueryCache(max_entries=2)
+        for symbol in ('A', 'B'):
+            cache.put(("vwsp", symbol, 5), cache.version(symbol), symbol.lower())
+        self.assertEqual(cache.get(("vwsp", 'A', 5), cache.version('A')), 'a')
+        cache.put(("vwsp", 'C', 5), cache.version('C'), 'c')
+        self.assertIs(cache.get(("vwsp", 'B', 5), cache.version('B')), MISS)
+        cache.bump('A')
+        self.assertIs(cache.get(("vwsp", 'A', 5), cache.version('A')), MISS)
+        self.assertEqual(cache.get(("vwsp", 'C', 5), cache.version('C')), 'c')
+        cache.put(("vwsp", 'D', 5), cache.version('D'), 'd', valid_from_ns=10, valid_until_ns=20)
+        self.assertEqual(cache.get(("vwsp", 'D', 5), cache.version('D'), 20), 'd')
+        self.assertIs(cache.get(("vwsp", 'D', 5), cache.version('D'), 21), MISS)
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"], cache.stats()["evictions"]), (3, 3, 1))
+
+    def test_results_follow_trades_config_and_time(self):
+        start = datetime(2013, 5, 6, 10, 0)
+        service_clock.set(start)
+        try:
+            TradeService.record_trade('HYDROMEL', 100, 'BUY', 10.0, start - timedelta(minutes=4))
+            TradeService.record_trade('HYDROMEL', 100, 'SELL', 20.0, start - timedelta(minutes=1))
+            hits = query_cache.stats()["hits"]
+            self.assertEqual(StockService.volume_weighted_stock_price('HYDROMEL'), ("Success", 15.0))
+            self.assertEqual(StockService.volume_weighted_stock_price('HYDROMEL'), ("Success", 15.0))
+            self.assertEqual(StockService.volume_weighted_stock_price('HYDROMEL', 15), ("Success", 15.0))
+            self.assertEqual(StockService.volume_weighted_stock_price('HYDROMEL', 15), ("Success", 15.0))
+            self.assertEqual(query_cache.stats()["hits"] - hits, 2)
+
+            # the first trade ages out of the 5 minute window, a newer one changes both windows
+            service_clock.set(start + timedelta(minutes=2))
+            self.assertEqual(StockService.volume_weighted_stock_price('HYDROMEL'), ("Success", 20.0))
+            TradeService.record_trade('HYDROMEL', 200, 'BUY', 30.0, start + timedelta(minutes=2))
+            self.assertEqual(StockService.volume_weighted_stock_price('HYDROMEL'), ("Success", 80 / 3))
+            self.assertEqual(StockService.volume_weighted_stock_price('HYDROMEL', 15), ("Success", 22.5))
+            service_clock.set(start + timedelta(minutes=20))
+            self.assertEqual(StockService.volume_weighted_stock_price('HYDROMEL', 15), ("Success", 0))
+
+            self.assertEqual(StockService.calculate_dividend_yield('HYDROMEL', 4.0), ("Success", 0.5))
+            self.assertEqual(StockService.calculate_pe_ratio('HYDROMEL', 4.0), ("Success", 2.0))
+            hits = query_cache.stats()["hits"]
+            for quantity in range(1, 11):  # trades do not move config-only results
+                TradeService.record_trade('HYDROMEL', quantity, 'BUY', 30.0, start + timedelta(minutes=20))
+                self.assertEqual(StockService.calculate_dividend_yield('HYDROMEL', 4.0), ("Success", 0.5))
+                self.assertEqual(StockService.calculate_pe_ratio('HYDROMEL', 4.0), ("Success", 2.0))
+            self.assertEqual(query_cache.stats()["hits"] - hits, 20)
+            StockService.stock_config_operations('HYDROMEL', 'Common', 1)
+            self.assertEqual(StockService.calculate_dividend_yield('HYDROMEL', 4.0), ("Success", 0.25))
+            self.assertEqual(StockService.calculate_pe_ratio('HYDROMEL', 4.0), ("Success", 4.0))
+
+            index = GBCEIndex.all_share_index()
+            self.assertEqual(GBCEIndex.all_share_index(), index)
+            TradeService.record_trade('HYDROMEL', 400, 'BUY', 1000.0)
+            self.assertGreater(GBCEIndex.all_share_index(), index)
+            self.assertEqual(GBCEIndex.all_share_index(), GBCEIndex.index_engine.value())
+        finally:
+            service_clock.release()
+
+
+class TestBatchMode(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('CHAI', 'Common', 4)
+
+    def test_script_runs_in_order(self):
+        script = ["# trades first, queries see them",
+                  "record_trade CHAI 100 BUY 10 2013-09-02T10:00:00",
+                  '{"op": "record_trade", "id": "b", "symbol": "chai", "quantity": 300, "type": "SELL", "price": 20, "timestamp": "2013-09-02T10:01:00"}',
+                  "record_trade NOSUCH 1 BUY 1",
+                  "record_trade CHAI 1.5 BUY 1",
+                  "",
+                  "trade_summary CHAI 2013-09-02T09:00:00 2013-09-02T11:00:00",
+                  "dividend_yield CHAI 8",
+                  "pe_ratio CHAI",
+                  "nosuchop CHAI",
+                  "[1, 2]"]
+        replies = list(execute_batch(script))
+        self.assertEqual([reply["id"] for reply in replies], [2, "b", 4, 5, 7, 8, 9, 10, 11])
+        self.assertEqual([reply["status"] for reply in replies],
+                         ["Success", "Success", "Failure", "Failure", "Success", "Success", "Failure", "Failure", "Failure"])
+        self.assertEqual((replies[4]["result"]["volume"], replies[4]["result"]["vwap"]), (400, 17.5))
+        self.assertEqual(replies[5]["result"], 0.5)
+
+        script = ['{"op": "record_trade", "symbol": "CHAI", "quantity": 10, "type": "BUY", "price": 1e400}',
+                  "record_trade CHAI 20 BUY 6 2013-09-03T10:00:00+02:00",
+                  "record_trade CHAI 30 SELL 7 2013-09-03T10:00:00",
+                  "record_trade CHAI 9223372036854775808 SELL 7 2013-09-03T10:00:01",
+                  '{"op": "record_trade", "symbol": "CHAI", "quantity": 5, "type": "BUY", "price": 10' + "0" * 400 + '}',
+                  '{"op": "latest_trades", "symbol": "CHAI", "count": 1e400}',
+                  "latest_trades CHAI 1"]
+        replies = list(execute_batch(script))
+        self.assertEqual([reply["status"] for reply in replies], ["Failure", "Failure", "Success", "Failure", "Failure", "Failure", "Success"])
+        self.assertEqual([(trade["quantity"], trade["price"]) for trade in replies[-1]["result"]], [(30, 7)])
+
+        output = io.StringIO()
+        self.assertEqual(run_batch(io.StringIO("dividend_yield CHAI 2\nvwsp NOSUCH\n"), output), 1)
+        self.assertEqual([json.loads(line)["status"] for line in output.getvalue().splitlines()], ["Success", "Failure"])
+
+
+class TestTradeQueries(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('TEPACHE', 'Common', 1)
+
+    def test_queries_match_a_scan(self):
+        rand = random.Random(11)
+        start = datetime(2013, 10, 7, 9, 0)
+        # arrivals jitter by up to a minute, so the symbol needs the timestamp index
+        trades = [('TEPACHE', rand.randint(1, 500), rand.choice(('BUY', 'SELL')), round(rand.uniform(1, 50), 2),
+                   start + timedelta(seconds=second * 3 + rand.randint(0, 60))) for second in range(3000)]
+        for first in range(0, 3000, 700):  # several batches, so queries also see rows appended since the last fold
+            TradeService.record_trades(trades[first:first + 700])
+            t1, t2 = start + timedelta(minutes=20), start + timedelta(minutes=45)
+            recorded = sorted(trades[:first + 700], key=lambda trade: trade[4])  # stable: arrival order within a timestamp
+            inside = [trade for trade in recorded if t1 <= trade[4] < t2]
+            status, found = StockService.trades_between('TEPACHE', t1, t2)
+            self.assertEqual([(trade["timestamp"], trade["quantity"], trade["type"], trade["price"]) for trade in found],
+                             [(trade[4], trade[1], trade[2], trade[3]) for trade in inside])
+            status, latest = StockService.latest_trades('TEPACHE', 5)
+            self.assertEqual([(trade["timestamp"], trade["quantity"]) for trade in latest], [(trade[4], trade[1]) for trade in recorded[-5:]])
+            status, largest = StockService.largest_trades('TEPACHE', 7)
+            self.assertEqual([trade["quantity"] for trade in largest], sorted((trade[1] for trade in recorded), reverse=True)[:7])
+            status, largest = StockService.largest_trades('TEPACHE', 3, t1, t2)
+            self.assertEqual([trade["quantity"] for trade in largest], sorted((trade[1] for trade in inside), reverse=True)[:3])
+
+        status, sides = StockService.side_summary('TEPACHE', t1, t2)
+        for side in ("BUY", "SELL"):
+            side_trades = [trade for trade in inside if trade[2] == side]
+            self.assertEqual(sides[side]["volume"], sum(trade[1] for trade in side_trades))
+            self.assertEqual(sides[side]["trades"], len(side_trades))
+            self.assertAlmostEqual(sides[side]["vwap"], math.fsum(trade[1] * trade[3] for trade in side_trades) / sides[side]["volume"], 9)
+        self.assertEqual(StockService.side_summary('NOSUCH', t1), ("Failure", None))
+        reply = execute({"op": "latest_trades", "symbol": "tepache", "count": 1})
+        self.assertEqual(reply["result"][0]["timestamp"], recorded[-1][4].isoformat())
+
+    def test_results_built_outside_the_shard_lock(self):
+        start = datetime(2013, 10, 8, 9, 0)
+        TradeService.record_trades([('TEPACHE', 100 - second, 'BUY', 2.0, start + timedelta(seconds=second)) for second in range(50)])
+        lock, as_dict, built = trade_shards.lock_for('TEPACHE'), TradeView.as_dict, []
+
+        def unlocked_as_dict(trade):
+            built.append(lock.locked())
+            return as_dict(trade)
+        TradeView.as_dict = unlocked_as_dict
+        try:
+            self.assertEqual(len(StockService.trades_between('TEPACHE', start)[1]), 50)
+            self.assertEqual([trade["quantity"] for trade in StockService.latest_trades('TEPACHE', 2)[1]], [52, 51])
+            self.assertEqual([trade["quantity"] for trade in StockService.largest_trades('TEPACHE', 2, start)[1]], [100, 99])
+        finally:
+            TradeView.as_dict = as_dict
+        self.assertEqual((len(built), any(built)), (54, False))
+        self.assertEqual(StockService.side_summary('TEPACHE', start)[1]["BUY"]["trades"], 50)
+
+    def test_index_tail_stays_sorted_between_folds(self):
+        rand = random.Random(5)
+        symbol_trades = SymbolTrades('LOOSE')
+        for arrival in range(6000):  # a query after every few out-of-order trades
+            symbol_trades.append(arrival * 10 + rand.randint(-500, 500), 'BUY', 1.0, rand.randint(1, 50))
+            if arrival % 3:
+                continue
+            low = rand.randint(0, arrival * 10 + 1)
+            high = low + rand.randint(0, 2000)
+            timestamps = symbol_trades.timestamps
+            self.assertEqual(list(symbol_trades.rows_between(low, high)),
+                             sorted((row for row in range(len(timestamps)) if low <= timestamps[row] < high), key=timestamps.__getitem__))
+            if symbol_trades.ordered:
+                continue
+            rows, indexed, tail, covered = symbol_trades.time_index.state
+            self.assertEqual((covered, len(rows), len(tail)), (len(timestamps), indexed, covered - indexed))
+            self.assertLessEqual(len(tail), max(symbol_trades.time_index.fold_after, len(rows) >> 4) + 3)
+        quantities = symbol_trades.quantities
+        self.assertEqual(symbol_trades.largest_rows(10), sorted(range(len(quantities)), key=lambda row: (quantities[row], row))[:-11:-1])
+
+
+class TestIndexRegistry(unittest.TestCase):
+    symbols = ['CHANGAA', 'MAKGEOLLI', 'BAIJIU', 'SHOCHU']
+
+    def setUpClass():
+        for symbol in TestIndexRegistry.symbols:
+            StockService().stock_config_operations(symbol, 'Common', 2)
+
+    def expected(self, weights: dict) -> float | None:
+        totals = FileDatabase.trade_totals()
+        prices = {symbol: totals[symbol][1] / totals[symbol][0] for symbol in weights if symbol in totals}
+        if not prices:
+            return None
+        return math.exp(math.fsum(weights[symbol] * math.log(price) for symbol, price in prices.items())
+                        / math.fsum(weights[symbol] for symbol in prices))
+
+    def test_change_log(self):
+        change_log = ChangeLog(capacity=4)
+        for symbol in "ABCAB":
+            change_log.append(symbol)
+        self.assertEqual(change_log.since(3), ({"A", "B"}, 5))
+        self.assertEqual(change_log.since(0), (None, 5))  # the oldest half is gone
+
+    def test_custom_indices_follow_trades(self):
+        self.assertEqual(GBCEIndex.define_index("SPIRITS", ['BAIJIU', 'SHOCHU']), "Success")
+        self.assertEqual(GBCEIndex.define_index("RICE", ['CHANGAA', 'MAKGEOLLI', 'SHOCHU'], {'CHANGAA': 3, 'SHOCHU': 0.5}), "Success")
+        self.assertEqual(GBCEIndex.define_index("BAD", ['CHANGAA', 'NOSUCH']), "Failure")
+        self.assertEqual(GBCEIndex.define_index("BAD", ['CHANGAA'], {'CHANGAA': -1}), "Failure")
+        self.assertEqual(GBCEIndex.index_value("SPIRITS"), ("Failure", None))
+        self.assertEqual(GBCEIndex.index_value("NOSUCH"), ("Failure", None))
+        for basket in range(200):  # many more indices leave the trades and the other indices alone
+            GBCEIndex.define_index(f"BASKET{basket}", self.symbols[basket % 4:] or self.symbols)
+        rand = random.Random(5)
+        start = datetime(2013, 11, 4, 9, 0)
+        for batch in range(5):
+            trades = [(rand.choice(self.symbols), rand.randint(1, 100), 'BUY', rand.uniform(1, 30), start + timedelta(seconds=batch * 100 + second))
+                      for second in range(100)]
+            if batch % 2:
+                for trade in trades:
+                    TradeService.record_trade(*trade)
+            else:
+                TradeService.record_trades(trades)
+            status, rice = GBCEIndex.index_value("RICE")
+            self.assertAlmostEqual(rice, self.expected({'CHANGAA': 3.0, 'MAKGEOLLI': 1.0, 'SHOCHU': 0.5}), 9)
+        self.assertAlmostEqual(GBCEIndex.index_value("SPIRITS")[1], self.expected({'BAIJIU': 1.0, 'SHOCHU': 1.0}), 9)
+        values = GBCEIndex.index_values()
+        self.assertAlmostEqual(values["BASKET3"], self.expected({'SHOCHU': 1.0}), 9)
+        self.assertEqual(execute({"op": "index", "name": "RICE"})["result"], GBCEIndex.index_value("RICE")[1])
+        TradeService.record_trade('SHOCHU', 10, 'SELL', 0.0, start)
+        self.assertAlmostEqual(GBCEIndex.index_value("SPIRITS")[1], self.expected({'BAIJIU': 1.0, 'SHOCHU': 1.0}), 9)
+        for basket in range(200):
+            GBCEIndex.remove_index(f"BASKET{basket}")
+        self.assertNotIn("BASKET3", GBCEIndex.index_values())
+
+
+class TestSymbolRegistry(unittest.TestCase):
+
+    def test_config_file_snapshot_and_updates(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config_file, snapshot_file = os.path.join(tmp_dir, "universe.csv"), os.path.join(tmp_dir, "universe.snapshot")
+            with open(config_file, "w") as config:
+                config.write("stock_symbol,stock_type,last_dividend,fixed_dividend,par_value\n")
+                config.write("".join(f"UNIV{number},{'Preferred' if number % 2 else 'Common'},{number},0.02,100\n" for number in range(1000)))
+            self.assertEqual(FileDatabase.load_stock_metadata_from_file(config_file)[1], ["UNIV1", "Preferred", 1.0, 0.02, 100.0])
+            self.assertEqual(StockService.load_stock_config(config_file, snapshot_file), 1000)
+            config_stat = os.stat(config_file)
+            snapshot = SymbolRegistry.load_snapshot(snapshot_file, config_stat.st_size, config_stat.st_mtime_ns)
+            self.assertEqual(list(snapshot.rows())[:2], [["UNIV0", "Common", 0.0, 0.02, 100.0], ["UNIV1", "Preferred", 1.0, 0.02, 100.0]])
+            self.assertIsNone(SymbolRegistry.load_snapshot(snapshot_file, config_stat.st_size + 1, config_stat.st_mtime_ns))
+            self.assertEqual(StockService.load_stock_config(config_file, snapshot_file), 1000)  # read back from the snapshot
+
+        self.assertEqual(StockService.calculate_dividend_yield('UNIV4', 8.0), ("Success", 0.5))
+        self.assertEqual(StockService.calculate_dividend_yield('UNIV5', 8.0), ("Success", 0.25))
+        self.assertEqual(StockService.update_stock_config([["UNIV4", "Common", 2, 0, 100], ["UNIV1000", "Common", 1, 0, 0]]), 2)
+        self.assertEqual(StockService.calculate_dividend_yield('UNIV4', 8.0), ("Success", 0.25))
+        self.assertEqual(StockService.calculate_pe_ratio('UNIV1000', 8.0), ("Success", 8.0))
+        yields, valid = StockService.calculate_dividend_yield_batch(['UNIV4', 'UNIV5', 'NOSUCH'], 8.0)
+        self.assertEqual((list(yields[:2]), list(valid)), ([0.25, 0.25], [True, True, False]))
+        self.assertEqual(StockService.config_stocks_list['UNIV5'].get_stock_type(), "Preferred")
+        self.assertEqual(StockService.config_stocks_list.missing(['UNIV5', 'NOSUCH', 'UNIV1000']), {'NOSUCH'})
+
+    def test_stock_types_past_int8(self):
+        registry = SymbolRegistry()
+        registry.update_many([f"KIND{number}", f"Type{number}", 1, 0, 0] for number in range(300))
+        self.assertEqual((registry.stock_type(registry.row_of("KIND299")), len(registry.stock_types)), ("Type299", 300))
+        registry.stock_types.extend(f"Filler{number}" for number in range(MAX_STOCK_TYPES - 300))
+        self.assertRaises(ValueError, registry.upsert, "KIND300", "OneTooMany", 1)
+        self.assertRaises(ValueError, registry.upsert, "KIND300", "Common", "no dividend")
+        self.assertEqual((len(registry), len(registry.type_ids), len(registry.stock_types)), (300, 300, MAX_STOCK_TYPES))
+        self.assertNotIn("OneTooMany", registry.type_codes)
+
+
+class TestSubscriptions(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('KOMBUCHA', 'Common', 1)
+        StockService().stock_config_operations('KEFIRWATER', 'Common', 1)
+
+    def test_vwsp_callbacks_coalesce(self):
+        updates, arrived = [], threading.Event()
+
+        def on_update(update):
+            updates.append(update)
+            arrived.set()
+        subscription = TradeService.subscribe_vwsp('KOMBUCHA', on_update)
+        throttled_updates = []
+        throttled = TradeService.subscribe_vwsp('KOMBUCHA', throttled_updates.append, min_interval=0.5)
+        try:
+            TradeService.record_trade('KOMBUCHA', 100, 'BUY', 4.0)
+            self.assertTrue(arrived.wait(5))
+            self.assertEqual((updates[0]["topic"], updates[0]["name"], updates[0]["value"]), ("vwsp", 'KOMBUCHA', 4.0))
+            for price in range(5, 105):
+                TradeService.record_trade('KOMBUCHA', 100, 'BUY', float(price))
+            TradeService.record_trades([('KEFIRWATER', 10, 'SELL', 1.0)])  # other stocks do not wake the subscription
+            expected = StockService.volume_weighted_stock_price('KOMBUCHA')[1]
+            deadline = time.monotonic() + 5
+            while (not throttled_updates or throttled_updates[-1]["value"] != expected) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual((updates[-1]["value"], throttled_updates[-1]["value"]), (expected, expected))
+            self.assertLessEqual(len(throttled_updates), 3)  # the first trade, then at most one per 0.5s
+            self.assertEqual(len(updates), len({update["value"] for update in updates}))
+        finally:
+            TradeService.unsubscribe(subscription)
+            throttled.close()
+        TradeService.record_trade('KOMBUCHA', 100, 'BUY', 1000.0)
+        delivered = len(updates)
+        time.sleep(0.2)
+        self.assertEqual(len(updates), delivered)
+
+    def test_index_async_iterator(self):
+        async def follow_index() -> list:
+            subscription = TradeService.subscribe_index()
+            values = []
+            async for update in subscription:
+                values.append(update["value"])
+                if len(values) == 1:
+                    TradeService.record_trade('KEFIRWATER', 1000, 'BUY', 500.0)
+                else:
+                    subscription.close()
+            return values
+
+        values = asyncio.run(asyncio.wait_for(follow_index(), 5))
+        self.assertEqual(len(values), 2)
+        self.assertNotEqual(values[0], values[1])
+        self.assertEqual(values[1], GBCEIndex.all_share_index())
+
+
+class TestColumnarExport(unittest.TestCase):
+
+    def setUpClass():
+        StockService().stock_config_operations('BOZA', 'Common', 3)
+
+    def test_export_loads_back_zero_copy(self):
+        start = datetime(2011, 3, 1, 9, 0)
+        trades = [('BOZA', 10 + second, ('BUY', 'SELL')[second % 2], 5.0 + second / 4, start + timedelta(seconds=second))
+                  for second in range(500)]
+        trades.append(('BOZA', 7, 'BUY', 3.0, start - timedelta(hours=1)))  # out of order, exported as recorded
+        TradeService.record_trades(trades)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.assertEqual(FileDatabase.export_columns(tmp_dir), "Success")
+            totals = FileDatabase.trade_totals()
+            for use_numpy in (True, False):
+                export = FileDatabase.load_columns(tmp_dir, use_numpy)
+                self.assertEqual(len(export), len(FileDatabase.trade_store))
+                self.assertEqual(export.symbols, sorted(FileDatabase.trade_store.symbols))
+                columns = export.trades('BOZA')
+                self.assertEqual([int(timestamp) for timestamp in columns["timestamps"]],
+                                 [datetime_to_ns(trade[4]) for trade in trades])
+                self.assertEqual([float(price) for price in columns["prices"]], [trade[3] for trade in trades])
+                self.assertEqual([int(quantity) for quantity in columns["quantities"]], [trade[1] for trade in trades])
+                self.assertEqual([export.manifest["sides"][str(int(side))] for side in columns["sides"]],
+                                 [trade[2] for trade in trades])
+                aggregates = export.aggregates('BOZA')
+                self.assertEqual((aggregates["total_quantities"], aggregates["total_notionals"]), totals['BOZA'])
+                self.assertEqual(aggregates["trade_counts"], len(trades))
+                self.assertEqual(aggregates["vwsps"], totals['BOZA'][1] / totals['BOZA'][0])
+                del export, columns  # the maps must be released before the directory goes
+            with open(os.path.join(tmp_dir, "prices.npy"), "ab") as prices:
+                prices.write(b"\0" * 8)
+            self.assertRaises(ValueError, FileDatabase.load_columns, tmp_dir)
+
+    def test_trading_continues_while_export_is_written(self):
+        start = datetime(2011, 3, 2, 9, 0)
+        TradeService.record_trade('BOZA', 10, 'BUY', 5.0, start)
+        exported_trades, recorded = len(FileDatabase.trade_store), []
+
+        def trade_while_writing(*args):
+            if not recorded:
+                trading = threading.Thread(target=lambda: recorded.append(
+                    TradeService.record_trade('BOZA', 20, 'SELL', 6.0, start + timedelta(seconds=1))))
+                trading.start()
+                trading.join(5)
+                self.assertFalse(trading.is_alive(), "trades should not wait for the export files")
+            return write_column(*args)
+        export.write_column = trade_while_writing
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                self.assertEqual(FileDatabase.export_columns(tmp_dir), "Success")
+                with open(os.path.join(tmp_dir, "manifest.json")) as manifest_file:
+                    self.assertEqual(json.load(manifest_file)["trades"], exported_trades)  # the snapshot, not the trade after it
+        finally:
+            export.write_column = write_column
+        self.assertEqual(len(recorded), 1)
+        self.assertEqual(len(FileDatabase.trade_store), exported_trades + 1)
+
+
 if __name__ == '__main__':    
     def suite():
         """
@@ -127,13 +1125,47 @@ if __name__ == '__main__':
         suite.addTest(TestHardcodedCases('test_volume_weighted_stock_price_manualinputs'))
         suite.addTest(TestHardcodedCases('test_dividend_yield_calc_manualinputs'))
         suite.addTest(TestHardcodedCases('test_pe_ratio_calc_manualinputs'))
+        suite.addTest(TestTradeLog('test_record_trade_appends_one_row'))
+        suite.addTest(TestTradeLog('test_same_timestamp_trades_kept_compactly'))
+        suite.addTest(TestRollingVWSP('test_vwsp_concurrent_windows'))
+        suite.addTest(TestRollingVWSP('test_future_dated_trade_keeps_window'))
+        suite.addTest(TestGBCEIndex('test_gbce_index_is_geometric_mean_of_vwsp'))
+        suite.addTest(TestBulkIngestion('test_record_trades_batch'))
+        suite.addTest(TestBulkIngestion('test_malformed_trades_rejected_one_by_one'))
+        suite.addTest(TestBulkIngestion('test_import_trades_from_csv_and_ndjson'))
+        suite.addTest(TestBatchAnalytics('test_dividend_yield_batch'))
+        suite.addTest(TestBatchAnalytics('test_pe_ratio_batch'))
+        suite.addTest(TestTradeJournal('test_journal_replay_and_tail_recovery'))
+        suite.addTest(TestTradeJournal('test_journal_drops_corrupt_tail_record'))
+        suite.addTest(TestTradeJournal('test_restart_rebuilds_analytics_from_journal'))
+        suite.addTest(TestConcurrentIngestion('test_threads_do_not_lose_trades'))
+        suite.addTest(TestTradeGateway('test_pipelined_requests'))
+        suite.addTest(TestTradeGateway('test_bad_requests_fail_alone'))
+        suite.addTest(TestBenchmark('test_synthetic_market_is_seeded'))
+        suite.addTest(TestStats('test_service_stats'))
+        suite.addTest(TestOHLCVBars('test_window_summaries_match_raw_trades'))
+        suite.addTest(TestOHLCVBars('test_bar_reads_do_not_wait_for_writers'))
+        suite.addTest(TestReplay('test_default_timestamp_is_taken_per_trade'))
+        suite.addTest(TestReplay('test_replay_tape_under_simulated_clock'))
+        suite.addTest(TestPartitionedAnalytics('test_partitions_merge_exactly'))
+        suite.addTest(TestRetention('test_compaction_keeps_whole_history_exact'))
+        suite.addTest(TestRetention('test_bar_vwsp_survives_compaction_mid_read'))
+        suite.addTest(TestQueryCache('test_lru_eviction'))
+        suite.addTest(TestQueryCache('test_results_follow_trades_config_and_time'))
+        suite.addTest(TestBatchMode('test_script_runs_in_order'))
+        suite.addTest(TestTradeQueries('test_queries_match_a_scan'))
+        suite.addTest(TestTradeQueries('test_results_built_outside_the_shard_lock'))
+        suite.addTest(TestTradeQueries('test_index_tail_stays_sorted_between_folds'))
+        suite.addTest(TestIndexRegistry('test_change_log'))
+        suite.addTest(TestIndexRegistry('test_custom_indices_follow_trades'))
+        suite.addTest(TestSymbolRegistry('test_config_file_snapshot_and_updates'))
+        suite.addTest(TestSymbolRegistry('test_stock_types_past_int8'))
+        suite.addTest(TestSubscriptions('test_vwsp_callbacks_coalesce'))
+        suite.addTest(TestSubscriptions('test_index_async_iterator'))
+        suite.addTest(TestColumnarExport('test_export_loads_back_zero_copy'))
+        suite.addTest(TestColumnarExport('test_trading_continues_while_export_is_written'))
         return suite
 
-    stock_details_list = FileDatabase.load_stock_metadata_from_file()
-    for stock in stock_details_list:
-        StockService().stock_config_operations(*stock)
-    print("\nStock config/metadata populated from file for testing!")
-    
     custom_suite = suite()
     runner = unittest.TextTestRunner()
     runner.run(custom_suite)
\ No newline at end of file